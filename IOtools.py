@@ -10,8 +10,14 @@ Created on Mon Mar 31 15:35:08 2014
 from __future__ import division
 import scipy as sp
 import tifffile as tifffile
+import sys
 import os
 import re
+import tempfile
+import functools
+import collections
+
+import instrumentation
 
 """ a collection of IO functions """ 
 
@@ -24,7 +30,7 @@ def get_np_dtype(mhd_dtype):
     
     dtype_map = {'MET_FLOAT': 'float32',
                  'MET_DOUBLE': 'float64',
-                 'MET_UCHAR':' uint8',
+                 'MET_UCHAR': 'uint8',
                  'MET_CHAR': 'int8',
                  'MET_USHORT': 'uint16',
                  'MET_SHORT': 'int16',
@@ -49,26 +55,291 @@ def get_mhd_dtype(dtype):
     
     return dtype_map[dtype]
 
+def staged(name=None):
+    """ as instrumentation.timed: records each call of the function as a stage.
+    instrumentation.timed can't be used in this module, as instrumentation
+    imports it, so the stage is looked up when the function is called """
+    def decorator(func):
+        stage_name = func.__name__ if name is None else name
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with instrumentation.stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#==============================================================================
+# IO counter
+#==============================================================================
+### IO counter
+""" counts the bytes and files read and written by the functions of this 
+module, per process. bytes_saved is what was avoided compared to the former
+TIFF round trip when writing the elastix inputs. artifact_bytes/files are the
+side products kept for inspection only (see artifact_level in 
+xyt_movement_correction_lib) """
+
+io_counter_keys = ['bytes_read','bytes_written','files_read','files_written','bytes_saved','artifact_bytes','artifact_files','cache_hits','cache_misses','frames_resumed','frames_warm_started','warm_start_fallbacks']
+io_counter = dict([(key,0) for key in io_counter_keys])
+
+def count_io(**kwargs):
+    """ adds the keyword values to the IO counter, e.g. count_io(bytes_read=10) """
+    for key, value in kwargs.items():
+        io_counter[key] += int(value)
+
+def get_io_counter():
+    """ returns a copy of the current IO counter """
+    return dict(io_counter)
+
+def reset_io_counter():
+    for key in io_counter_keys:
+        io_counter[key] = 0
+
+def io_counter_diff(after,before):
+    """ the IO that happened between two get_io_counter() calls """
+    return dict([(key,after[key] - before[key]) for key in io_counter_keys])
+
+def format_io_counter(counter):
+    """ one line summary of an IO counter (or a diff of two) """
+    MB = 2.0**20
+    line = "%.1f MB read (%i files), %.1f MB written (%i files), %.1f MB saved, %.1f MB artifacts (%i files)" % (
+        counter['bytes_read'] / MB, counter['files_read'],
+        counter['bytes_written'] / MB, counter['files_written'],
+        counter['bytes_saved'] / MB,
+        counter['artifact_bytes'] / MB, counter['artifact_files'])
+    if counter['cache_hits'] or counter['cache_misses']:
+        line += ", transform cache %i hits %i misses" % (counter['cache_hits'], counter['cache_misses'])
+    if counter['frames_resumed']:
+        line += ", %i frames resumed" % counter['frames_resumed']
+    if counter['frames_warm_started']:
+        line += ", %i frames warm started (%i fell back)" % (counter['frames_warm_started'], counter['warm_start_fallbacks'])
+    return line
+
+#==============================================================================
+# tiff index
+#==============================================================================
+### tiff index
+""" an optional sidecar file next to a tiff stack (path + '.index.npz'), holding
+the offset of the data of each page, the page shape (y,x) and dtype, together
+with the size and modification time of the stack. Later reads of the stack take
+the data directly from these offsets (memory mapped or with seeks), without
+parsing the pages. The index is rebuilt when the stack was changed.
+
+Only stacks of uncompressed pages of one shape and type are indexed. For other
+stacks, the index records that they can't be indexed (offsets None), so that
+they are not parsed for it again on each read. Switched on by the environment
+variable MOCO_TIFF_INDEX=1 or by setting tiff_index """
+
+tiff_index = os.environ.get('MOCO_TIFF_INDEX','0') == '1'
+
+def get_tiff_index_path(path):
+    return path + '.index.npz'
+
+def make_tiff_index(path):
+    """ reads the page layout of a tiff stack into an index dict (offsets,
+    shape, dtype, size, mtime). Returns None if the pages can not be read
+    directly """
+    stat = os.stat(path)
+    tif = tifffile.TIFFfile(path)
+    page = tif.pages[0]
+    offsets = []
+    for p in tif.pages:
+        if p.memmap_offset is None or p.shape != page.shape or p._dtype != page._dtype:
+            return None
+        offsets.append(p.memmap_offset)
+    return {'offsets': sp.array(offsets,dtype='int64'),
+            'shape': tuple(page.shape),
+            'dtype': sp.dtype(tif.byte_order + page._dtype),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime}
+
+def write_tiff_index(path,index):
+    """ writes the index next to the stack. The file is written under a
+    temporary name and renamed, concurrent readers never see a partial index.
+    Fails silently if the directory is not writable """
+    index_path = get_tiff_index_path(path)
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_',suffix='.npz',dir=os.path.dirname(os.path.abspath(path)))
+        fh = os.fdopen(fd,'wb')
+        try:
+            if index['offsets'] is None:
+                sp.savez(fh, size=index['size'], mtime=index['mtime'])
+            else:
+                sp.savez(fh, offsets=index['offsets'], shape=sp.array(index['shape'],dtype='int64'),
+                         dtype=index['dtype'].str, size=index['size'], mtime=index['mtime'])
+        finally:
+            fh.close()
+        os.rename(tmp_path,index_path)
+    except (IOError, OSError):
+        pass
+
+def read_tiff_index(path):
+    """ the index of the stack if a valid one exists, None else. Its offsets
+    are None if the stack can't be indexed """
+    try:
+        stat = os.stat(path)
+        npz = sp.load(get_tiff_index_path(path))
+        try:
+            if 'offsets' not in npz.files:
+                index = {'offsets': None,
+                         'size': int(npz['size']),
+                         'mtime': float(npz['mtime'])}
+            else:
+                index = {'offsets': npz['offsets'],
+                         'shape': tuple([int(i) for i in npz['shape']]),
+                         'dtype': sp.dtype(str(npz['dtype'])),
+                         'size': int(npz['size']),
+                         'mtime': float(npz['mtime'])}
+        finally:
+            npz.close()
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    if index['size'] != stat.st_size or index['mtime'] != stat.st_mtime:
+        return None
+    return index
+
+def get_tiff_index(path):
+    """ reads the index of the stack, (re)builds and writes it if there is no
+    valid one. None if the stack can not be indexed """
+    index = read_tiff_index(path)
+    if index is None:
+        index = make_tiff_index(path)
+        if index is None:
+            stat = os.stat(path)
+            index = {'offsets': None, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        write_tiff_index(path,index)
+    if index['offsets'] is None:
+        return None
+    return index
+
+def read_indexed_pages(path, index, frames=None, memmap=False):
+    """ the pages of an indexed stack as a (t,y,x) array, as tifffile returns
+    them. frames: list of page indices, all pages if None. With memmap, evenly
+    spaced pages are returned as a read only view of the memory mapped file,
+    else the pages are read one by one """
+    offsets = index['offsets'] if frames is None else index['offsets'][frames]
+    shape = index['shape']
+    dtype = index['dtype']
+    count = int(sp.prod(shape))
+    size = count * dtype.itemsize
+    
+    if memmap and len(offsets) > 0:
+        stride = offsets[1] - offsets[0] if len(offsets) > 1 else size
+        if stride >= size and sp.all(sp.diff(offsets) == stride):
+            mapped = sp.memmap(path, dtype=sp.uint8, mode='r', offset=int(offsets[0]),
+                               shape=(int(stride) * (len(offsets)-1) + size,))
+            strides = [dtype.itemsize]
+            for i in reversed(shape[1:]):
+                strides.insert(0, strides[0] * i)
+            return sp.ndarray((len(offsets),) + shape, dtype, mapped, strides=(int(stride),) + tuple(strides))
+    
+    data = sp.empty((len(offsets),) + shape, dtype=dtype)
+    fh = open(path,'rb')
+    try:
+        for i, offset in enumerate(offsets):
+            fh.seek(offset)
+            data[i] = sp.fromfile(fh, dtype=dtype, count=count).reshape(shape)
+    finally:
+        fh.close()
+    return data
+
 #==============================================================================
 # readers 
 #==============================================================================
 ### readers
 
+# number of threads decoding the pages of compressed tiff stacks in parallel
+# (see tifffile.TIFFfile.asarray)
+tiff_decode_workers = int(os.environ.get('MOCO_DECODE_WORKERS',1))
+
+@staged()
 def read_tiff(path):
     """ reads a tiff file from the path as a np array and changes its 
     dimensions to x y """
     data = tifffile.imread(path)
     data = data.T
+    count_io(bytes_read=data.nbytes, files_read=1)
     return data
     
-def read_tiffstack(path):
+def get_frame_indices(frames, n_frames):
+    """ the list of frame indices selected by frames (None for all, a slice or
+    a sequence of indices) out of n_frames """
+    if frames is None:
+        return range(n_frames)
+    if isinstance(frames, slice):
+        return range(n_frames)[frames]
+    return list(frames)
+
+def probe_tiffstack(path):
+    """ shape (x,y,t) and dtype of a tiff stack, without reading image data:
+    from its index (see get_tiff_index) if there is one, else from the first
+    page """
+    index = read_tiff_index(path) if tiff_index else None
+    if index is not None and index['offsets'] is not None:
+        shape = index['shape'][::-1] + (len(index['offsets']),)
+        return shape, index['dtype'].newbyteorder('=')
+    tif = tifffile.TIFFfile(path)
+    page = tif.pages[0]
+    return tuple(page.shape[::-1]) + (len(tif.pages),), sp.dtype(page.dtype)
+
+@staged()
+def read_tiffstack(path,memmap=False,frames=None):
     """ converts a tiff stack (image x y dimensions, individual tiff pages t)
-    into a 3d np array, dimensions are (x,y,t)"""
-    
-    data = tifffile.TIFFfile(path).asarray()
+    into a 3d np array, dimensions are (x,y,t)
+    
+    frames: a slice or a list of frame indices, only these frames are read.
+    The result is then (x,y,len(frames)), also for a single frame
+    
+    if memmap is True and the stack is uncompressed, a read only (x,y,t) view
+    of the memory mapped file is returned. Nothing is read until it is
+    accessed, and then only the accessed frames. Other stacks are decoded as
+    without memmap. 
+    
+    with tiff_index, the pages are located with the sidecar index of the
+    stack (see get_tiff_index) """
+    
+    index = get_tiff_index(path) if tiff_index else None
+    if index is not None:
+        if frames is not None:
+            frames = get_frame_indices(frames, len(index['offsets']))
+        data = read_indexed_pages(path, index, frames=frames, memmap=memmap)
+        if frames is None and len(data) == 1:
+            data = data[0] # as tifffile
+    else:
+        tif = tifffile.TIFFfile(path)
+        if frames is not None:
+            frames = get_frame_indices(frames, len(tif.pages))
+        data = tif.asarray(key=frames, memmap=memmap, workers=tiff_decode_workers)
+    if frames is not None and data.ndim == 2:
+        data = data[sp.newaxis]
+    mapped = isinstance(data.base,sp.memmap)
     data = data.swapaxes(0,2) # moves t to last dim. tifffile reads pages as first dim
+    if mapped:
+        count_io(files_read=1)
+    else:
+        count_io(bytes_read=data.nbytes, files_read=1)
     return data
     
+def iter_tiffstack(path, frames=None):
+    """ generator over the frames of a tiff stack, each as a (x,y) array. Only
+    one page is read at a time. frames: a slice or a list of page indices, all
+    pages if None """
+    index = get_tiff_index(path) if tiff_index else None
+    if index is not None:
+        for frame in get_frame_indices(frames, len(index['offsets'])):
+            with instrumentation.stage('iter_tiffstack'):
+                data = read_indexed_pages(path, index, frames=[frame])[0].T
+                count_io(bytes_read=data.nbytes)
+            yield data
+        count_io(files_read=1)
+        return
+    tif = tifffile.TIFFfile(path)
+    for frame in get_frame_indices(frames, len(tif.pages)):
+        with instrumentation.stage('iter_tiffstack'):
+            data = tif.pages[frame].asarray().T
+            count_io(bytes_read=data.nbytes)
+        yield data
+    count_io(files_read=1)
+
 def read_3dtiff(path):
     """ missing docstring """
     data = tifffile.TIFFfile(path).asarray()
@@ -93,42 +364,145 @@ def read_lsm(path,color=False):
        
     return Data_cut_rot
     
-def read_mhd(mhd_path):
-    """ reads the data from an mhd file and returns a np array. The data
-    type to read is specified from the tifffile module by the tiff reading 
-    capabilities. Based on code from the pirt library. 
-        
-    see: https://bitbucket.org/almarklein/pirt"""
-    
+def read_mhd_header(mhd_path):
+    """ reads the 'Key = value' lines of an mhd header into a dict (values as
+    strings). For ElementDataFile = LOCAL, the position at which the data
+    starts is stored under 'LocalDataOffset' """
+    header = {}
+    fh = open(mhd_path,'rb')
+    try:
+        while True:
+            line = fh.readline()
+            if not line:
+                break
+            key, _, value = line.decode('utf-8').partition('=')
+            header[key.strip()] = value.strip()
+            if key.strip() == 'ElementDataFile':
+                header['LocalDataOffset'] = fh.tell()
+                break
+    finally:
+        fh.close()
+    return header
+
+def get_mhd_layout(mhd_path):
+    """ where and how the data of an mhd file are stored: returns the path of
+    the raw file, the shape in file order (C order, slowest first, channels
+    last), the dtype, the offset of the data in the raw file in bytes and the
+    number of channels """
     # Load description from mhd file
-    mhd = open(mhd_path,'r').read()
-    
-    # Get data filename and load raw data
-    raw_path = re.findall('ElementDataFile = (.+)',mhd)[0]
+    header = read_mhd_header(mhd_path)
     
+    # Get data filename
+    raw_path = header['ElementDataFile']
+    if raw_path == 'LOCAL':
+        raw_path = mhd_path
+        
     # if the path in the mhd is not an absolute path, make it one
-    if raw_path[0] != '/':
+    elif raw_path[0] != '/':
         raw_path = os.path.join(os.path.dirname(mhd_path),os.path.basename(raw_path))
         
-    # get dimensions
-    dimensions = sp.int16(re.findall('DimSize = (.+)',mhd)[0].split())
+    # get dimensions, in file order (x fastest)
+    dimensions = [int(d) for d in header['DimSize'].split()]
+    channels = int(header.get('ElementNumberOfChannels',1))
     
     # get correct datatype mapping    
-    mhd_dtype = re.findall('ElementType = (.+)',mhd)[0]
-    dtype = get_np_dtype(mhd_dtype)
+    dtype = sp.dtype(get_np_dtype(header['ElementType']))
+    if header.get('ElementByteOrderMSB','False').lower() == 'true':
+        dtype = dtype.newbyteorder('>')
+    else:
+        dtype = dtype.newbyteorder('<')
+    
+    shape = dimensions[::-1] # C order, slowest first
+    if channels > 1:
+        shape = shape + [channels]
+    nbytes = int(sp.prod(shape)) * dtype.itemsize
+    
+    # start of the data in the raw file
+    if raw_path == mhd_path:
+        offset = header['LocalDataOffset']
+    else:
+        offset = 0
+    header_size = int(header.get('HeaderSize',0))
+    if header_size == -1: # data are the last bytes of the file
+        offset = os.path.getsize(raw_path) - nbytes
+    else:
+        offset += header_size
+    return raw_path, shape, dtype, offset, channels
+
+def mhd_complete(mhd_path):
+    """ True if the mhd file exists, its header is readable and its raw file
+    holds all the data the header announces. For checking the outputs of
+    elastix/transformix before reading them """
+    try:
+        raw_path, shape, dtype, offset, channels = get_mhd_layout(mhd_path)
+        nbytes = int(sp.prod(shape)) * dtype.itemsize
+        return offset >= 0 and os.path.getsize(raw_path) >= offset + nbytes
+    except (IOError, OSError, KeyError, ValueError):
+        return False
+
+@staged()
+def read_mhd(mhd_path,mmap=False):
+    """ reads the data from an mhd file and returns a np array. The data
+    type to read is specified from the tifffile module by the tiff reading 
+    capabilities. Based on code from the pirt library. 
+    
+    2d data is returned as (x,y), 3d as (x,y,z). Vector valued data (e.g. the
+    deformationField.mhd of transformix, ElementNumberOfChannels > 1) gets the
+    channels as the last dimension: (x,y,c) or (x,y,z,c).
+    
+    if mmap is True, the raw file is not read but memory mapped (read only),
+    so only the parts of the data that are accessed are read from disk. The
+    HeaderSize field is honoured in both cases.
+        
+    see: https://bitbucket.org/almarklein/pirt"""
+    
+    raw_path, shape, dtype, offset, channels = get_mhd_layout(mhd_path)
+    nbytes = int(sp.prod(shape)) * dtype.itemsize
     
     # read and reshape
-    fh = open(raw_path, 'rb')
-    data = sp.frombuffer(fh.read(),dtype = dtype)
+    if mmap:
+        data = sp.memmap(raw_path, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+        count_io(files_read=2)
+    else:
+        fh = open(raw_path, 'rb')
+        try:
+            fh.seek(offset)
+            data = sp.frombuffer(fh.read(nbytes),dtype = dtype)
+        finally:
+            fh.close()
+        data = sp.reshape(data,shape)
+        count_io(bytes_read=data.nbytes, files_read=2)
+    
+    # reverse the spatial axes, the channels stay last
+    n_dims = len(shape) - int(channels > 1)
+    axes = range(n_dims)[::-1]
+    if channels > 1:
+        axes.append(n_dims)
+    return data.transpose(axes)
     
-    if len(dimensions) == 2:
-        data_reshape = sp.reshape(data,(dimensions[1],dimensions[0]))
-        data_reshape = data_reshape.T
-    if len(dimensions) == 3: # FIXME
-        sys.exit()
-        data_reshape = sp.reshape(data,(dimensions[2],dimensions[1],dimensions[0]))
-               
-    return data_reshape
+
+def parse_parameter_value(value):
+    """ converts a single entry of an elastix parameter line: quoted strings
+    are returned without quotes, numbers as int or float """
+    if value.startswith('"'):
+        return value.strip('"')
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def read_transform_parameters(path):
+    """ reads an elastix parameter or TransformParameters file into an ordered
+    dict. Each (Key value1 value2 ...) line becomes an entry Key: [value1, value2, ...],
+    comments (//) are ignored """
+    parameters = collections.OrderedDict()
+    for line in open(path,'r'):
+        line = line.split('//')[0].strip()
+        if not(line.startswith('(') and line.endswith(')')):
+            continue
+        fields = re.findall('"[^"]*"|[^\s"]+',line[1:-1])
+        parameters[fields[0]] = [parse_parameter_value(v) for v in fields[1:]]
+    return parameters
     
 
 #==============================================================================
@@ -136,70 +510,131 @@ def read_mhd(mhd_path):
 #==============================================================================
 ### writers
     
+class TstackWriter(object):
+    """ writes a tiff stack frame by frame, so that the stack never has to be
+    in memory: frames are appended to the file as they are given, the file is
+    finished on close (see tifffile.TiffWriter, which also switches to BigTIFF
+    for files above 4 GB). Can be used in a with statement. """
+    
+    def __init__(self,path):
+        self.path = path
+        self.tif = tifffile.TiffWriter(path)
+    
+    @staged('TstackWriter.append')
+    def append(self,data):
+        """ appends a (x,y) frame or a (x,y,t) block of frames """
+        if data.ndim == 2:
+            data = data[:,:,sp.newaxis]
+        for frame in range(data.shape[2]):
+            self.tif.save(data[:,:,frame].T) # tifffile gets y x
+    
+    @staged('TstackWriter.close')
+    def close(self):
+        if self.tif is None:
+            return
+        self.tif.close()
+        self.tif = None
+        count_io(bytes_written=os.path.getsize(self.path), files_written=1)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+@staged()
 def save_tstack(data,path):
     """ saves an ndarray to a tiff file with the z axes in the pages. There is 
-    some confusion about the axes. read_lsm loads the correct x y z dims"""
-
-    # tifffile.imsave gets z y x
-    datac = data.copy()
-    datac = datac.swapaxes(0,2) # 
-        
-    tifffile.imsave(path,datac)
-    pass
+    some confusion about the axes. read_lsm loads the correct x y z dims.
+    The frames are written one by one, without a copy of the stack """
+    with TstackWriter(path) as writer:
+        writer.append(data)
 
+@staged()
 def save_tiff(data,path):
     """ using the tifffile library to save a xy image array to a tiff, preserving
     correct xy order"""
     
     tifffile.imsave(path,data.T)
+    count_io(bytes_written=os.path.getsize(path), files_written=1)
     pass
 
-def save_mhd(data,path,dtype=None):
+@staged()
+def save_mhd(data,path,dtype=None,buffer=None,append=False):
     """ writes np array to an mhd specified by path. the raw file is written
-    with the same name.
+    with the same name. data can have any number of dimensions, 2d (x,y) and
+    3d (x,y,z) data are written such that read_mhd returns them in the same
+    order. 
+    
+    if buffer is given, the (transposed) data is cast into it before writing,
+    instead of allocating a new array for the dtype conversion. It needs to 
+    have the transposed shape of data, and its dtype is written. 
+    
+    if append is True and the mhd exists already, data is appended to the raw
+    file along the last dimension and the header is updated. data can either be
+    a single frame (one dimension less than the file) or a block of frames. 
+    Appending a frame to a 2d file makes it a 3d stack. This allows to write a
+    stack frame by frame, without ever having it in memory.
     """
-
-    # does the data have the right structure?
-    # fixme for n dimensionality
-    if len(data.shape) == 2:
-        data = data.T
-    if len(data.shape) == 3:
-        sys.exit()
-        # fixme this needs to be fixed empiricaly
-        pass
+    
+    # path preparations        
+    mhd_path = path
+    raw_path = os.path.splitext(mhd_path)[0] + '.raw'    
+    
+    # file order is x fastest: the transpose of the (x,y,...) array
+    data = data.T
 
     # converts to chosen dtype
-    if dtype:
+    if buffer is not None:
+        buffer[...] = data
+        data = buffer
+    elif dtype:
         data = data.astype(dtype)
+    
+    # file dimensions, x first
+    dimsize = list(data.shape[::-1])
+    mode = 'wb'
+    if append and os.path.exists(mhd_path):
+        header = read_mhd_header(mhd_path)
+        file_dimsize = [int(d) for d in header['DimSize'].split()]
+        if header['ElementType'] != get_mhd_dtype(str(data.dtype)):
+            raise ValueError("can't append " + str(data.dtype) + " to " + header['ElementType'] + " file " + mhd_path)
+        if len(dimsize) == len(file_dimsize) == 2:
+            # a 2d image becomes the first frame of a stack
+            file_dimsize = file_dimsize + [1]
+        if len(dimsize) == len(file_dimsize) - 1:
+            # a single frame
+            dimsize = dimsize + [1]
+        if dimsize[:-1] != file_dimsize[:-1]:
+            raise ValueError("can't append data of size " + str(dimsize) + " to " + str(file_dimsize) + " in " + mhd_path)
+        dimsize = file_dimsize[:-1] + [file_dimsize[-1] + dimsize[-1]]
+        mode = 'ab'
         
     # left for possible future implementations
-    resolution = sp.ones(len(data.shape))
-    
-    # path preparations        
-    mhd_path = path
-    raw_path = os.path.splitext(mhd_path)[0] + '.raw'    
+    resolution = sp.ones(len(dimsize))
     
     # metadata preparations
     lines = ["NDims = <ndims>",
              "DimSize = <dimsize>",
              "ElementSpacing = <resolution>",
-             "Position = 0 0",
+             "Position = <position>",
              "ElementByteOrderMSB = False",
              "ElementType = <mhd_dtype>",
              "ElementDataFile = <raw_path>"]
     text = '\n'.join(lines)
 
     # changing the fields
-    text = text.replace('<ndims>', str(len(data.shape)))
-    text = text.replace('<dimsize>', ' '.join([str(s) for s in data.shape[::-1]]))
+    text = text.replace('<ndims>', str(len(dimsize)))
+    text = text.replace('<dimsize>', ' '.join([str(s) for s in dimsize]))
     text = text.replace('<raw_path>', raw_path)
-    text = text.replace('<resolution>', ' '.join([str(r) for r in resolution[::-1]]))
+    text = text.replace('<resolution>', ' '.join([str(r) for r in resolution]))
+    text = text.replace('<position>', ' '.join(['0'] * len(dimsize)))
     text = text.replace('<mhd_dtype>', get_mhd_dtype(str(data.dtype)))
 
-    # write raw
-    f = open(raw_path, 'wb')
+    # write raw, tofile writes in C order independent of the memory layout
+    f = open(raw_path, mode)
     try:
-        f.write(data.data)
+        data.tofile(f)
     finally:
         f.close()
         
@@ -209,6 +644,28 @@ def save_mhd(data,path,dtype=None):
         f.write(text.encode('utf-8'))
     finally:
         f.close()
+    
+    count_io(bytes_written=data.nbytes + len(text), files_written=2)
+    pass
+
+def write_transform_parameters(parameters,path):
+    """ writes a dict as returned by read_transform_parameters to an elastix 
+    parameter file, which can be read by elastix (-t0) and transformix (-tp) """
+    lines = []
+    for key, values in parameters.items():
+        fields = []
+        for value in values:
+            if isinstance(value,basestring):
+                fields.append('"' + value + '"')
+            else:
+                fields.append(repr(value))
+        lines.append('(' + ' '.join([key] + fields) + ')')
+    
+    f = open(path, 'w')
+    try:
+        f.write('\n'.join(lines) + '\n')
+    finally:
+        f.close()
     pass
 
 #==============================================================================
@@ -0,0 +1,630 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Feb 10 11:02:47 2015
+
+@author: georg
+"""
+
+from __future__ import division
+
+"""
+SUMMARY: registration backends. The pipeline functions in
+xyt_movement_correction_lib only call register() and transform() of a backend,
+so they can run on different engines:
+
+ElastixBackend: the elastix/transformix binaries, called as subprocesses. This
+    is the default and what all results so far were computed with.
+NativeBackend: affine registrations are computed in-process by the
+    native_registration module, everything else is passed to elastix.
+FakeBackend: no registration at all, applies known shifts. Deterministic and
+    fast, so the pipeline and the benchmarks can run on machines without
+    elastix.
+CachedBackend: wraps any of the above, registrations are looked up in a
+    persistent transform_cache.TransformCache before they are computed.
+CheckpointBackend: wraps any of the above, finished frames are recorded in
+    their output directory, so a rerun of a killed trial only computes the
+    missing frames.
+
+All backends follow the elastix conventions: the registration of a frame
+leaves a TransformParameters.0.txt in outpath, which transform() of any backend
+(and transformix) can apply later. A registration can start from an initial
+transform (a TransformParameters file, as elastix -t0), e.g. the translation
+found by phase correlation. Next to it, the final metric value of the
+registration is recorded as FinalMetricValue.txt (see read_final_metric), by
+all backends but the fake one.
+
+The backend is chosen at runtime with the backend kwarg of the pipeline
+functions, or for the whole process by the environment variable MOCO_BACKEND
+(elastix, native or fake).
+"""
+
+#==============================================================================
+# IMPORTS
+#==============================================================================
+import scipy as sp
+
+import os
+import re
+import hashlib
+import subprocess
+import threading
+import collections
+
+import IOtools as io
+import instrumentation
+import native_registration
+import transform_cache
+import transform_parameters
+
+#==============================================================================
+### CONSTANTS DECLARATIONS
+#==============================================================================
+
+# which side products of elastix/transformix are generated and kept:
+# full: everything, incl. tif dumps of the results and deformation fields
+# transforms: TransformParameters and the elastix/transformix outputs only
+# none: TransformParameters only, all image files are removed after reading
+artifact_levels = ['none','transforms','full']
+
+#==============================================================================
+### HELPERS
+#==============================================================================
+
+class RegistrationError(Exception):
+    """ elastix or transformix failed, timed out or left incomplete results """
+    pass
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        pass
+
+def get_transform_name(parameter_filepath):
+    """ the Transform entry of an elastix parameter file, e.g. AffineTransform """
+    return io.read_transform_parameters(parameter_filepath)['Transform'][0]
+
+def frame_index(outpath):
+    """ frame number from the per frame output directory name frame_i_n, None
+    if outpath is not a per frame directory """
+    match = re.match('frame_(\d+)_\d+$',os.path.basename(os.path.normpath(outpath)))
+    if match:
+        return int(match.group(1))
+    return None
+
+def make_transform_parameters(transform, parameters, shape, center=None):
+    """ a minimal elastix TransformParameters dict for a translation or an
+    affine transform of images of shape, that transformix can apply """
+    tp = collections.OrderedDict()
+    tp['Transform'] = [transform]
+    tp['NumberOfParameters'] = [len(parameters)]
+    tp['TransformParameters'] = [float(p) for p in parameters]
+    tp['InitialTransformParametersFileName'] = ['NoInitialTransform']
+    tp['HowToCombineTransforms'] = ['Compose']
+    tp['FixedImageDimension'] = [2]
+    tp['MovingImageDimension'] = [2]
+    tp['FixedInternalImagePixelType'] = ['float']
+    tp['MovingInternalImagePixelType'] = ['float']
+    tp['Size'] = [int(shape[0]),int(shape[1])]
+    tp['Index'] = [0,0]
+    tp['Spacing'] = [1.0,1.0]
+    tp['Origin'] = [0.0,0.0]
+    tp['Direction'] = [1.0,0.0,0.0,1.0]
+    tp['UseDirectionCosines'] = ['true']
+    if center is not None:
+        tp['CenterOfRotationPoint'] = [float(c) for c in center]
+    tp['ResampleInterpolator'] = ['FinalBSplineInterpolator']
+    tp['FinalBSplineInterpolationOrder'] = [3]
+    tp['Resampler'] = ['DefaultResampler']
+    tp['DefaultPixelValue'] = [0.0]
+    tp['ResultImageFormat'] = ['mhd']
+    tp['ResultImagePixelType'] = ['float']
+    tp['CompressResultImage'] = ['false']
+    return tp
+
+def read_affine_transform(transformation_filepath):
+    """ reads a TranslationTransform or AffineTransform TransformParameters file
+    as elastix ordered affine parameter vector and center of rotation. Initial
+    transforms (-t0) that are translations or affine themselves are composed
+    into it, as elastix does with HowToCombineTransforms Compose (see
+    transform_parameters). Returns None for all other transforms and chains """
+    try:
+        transform = transform_parameters.read(transformation_filepath)
+    except ValueError:
+        return None
+    M = transform.affine_matrix()
+    if M is None:
+        return None
+    center = getattr(transform,'center',sp.zeros(2))
+    return native_registration.matrix_parameters(M,center), center
+
+def interpolate_transform_parameters(transformation_filepath_a, transformation_filepath_b, weight, shape):
+    """ TransformParameters dict of the transform between the two transforms,
+    at weight (0: a, 1: b), for images of shape. Translation and affine
+    transforms (incl. their initial transforms, see read_affine_transform) are
+    interpolated as affine matrices, other transforms (bspline) by their
+    coefficients, which requires both to have the same grid and initial
+    transform """
+    affine_a = read_affine_transform(transformation_filepath_a)
+    affine_b = read_affine_transform(transformation_filepath_b)
+    if affine_a is not None and affine_b is not None:
+        M_a = native_registration.affine_matrix(affine_a[0],affine_a[1])
+        M_b = native_registration.affine_matrix(affine_b[0],affine_b[1])
+        parameters = native_registration.matrix_parameters((1 - weight) * M_a + weight * M_b,affine_b[1])
+        return make_transform_parameters('AffineTransform',parameters,shape,affine_b[1])
+    
+    try:
+        transform = transform_parameters.interpolate(transform_parameters.read(transformation_filepath_a),
+                                                     transform_parameters.read(transformation_filepath_b),weight)
+    except ValueError as error:
+        raise ValueError("%s: %s and %s" % (error,transformation_filepath_a,transformation_filepath_b))
+    return transform.to_dict()
+
+def transform_distance(transformation_filepath_a, transformation_filepath_b, shape):
+    """ mean distance in pixels between the points of an image of shape mapped
+    by the two transforms (incl. their initial transforms) """
+    points = transform_parameters.grid_points(shape)
+    diff = transform_parameters.read(transformation_filepath_a).transform_points(points) - transform_parameters.read(transformation_filepath_b).transform_points(points)
+    return sp.sqrt((diff**2).sum(axis=0)).mean()
+
+def write_final_metric(outpath, metric):
+    """ records the final metric value of the registration in outpath as
+    FinalMetricValue.txt (None: removes it). Each backend does this after a
+    registration, see read_final_metric """
+    metric_path = os.path.join(outpath,'FinalMetricValue.txt')
+    if metric is None:
+        if os.path.exists(metric_path):
+            os.remove(metric_path)
+        return
+    with open(metric_path,'w') as fh:
+        fh.write(repr(float(metric)))
+
+def read_final_metric(outpath):
+    """ the final metric value of the registration in outpath, lower is
+    better. Comparable between registrations of the same backend only. None if
+    the backend has none (FakeBackend) """
+    try:
+        return float(open(os.path.join(outpath,'FinalMetricValue.txt'),'r').read())
+    except (IOError, OSError, ValueError):
+        return None
+
+def read_elastix_log(log_path):
+    """ the number of iterations per resolution and the final metric value
+    (None if not found) of the registration logged in elastix.log """
+    iterations = []
+    metric = None
+    for line in open(log_path,'r'):
+        if line.startswith('1:ItNr'): # the table of a new resolution
+            iterations.append(0)
+        elif iterations and re.match('\d+\t',line):
+            iterations[-1] += 1
+        elif line.startswith('Final metric value'):
+            metric = float(line.split('=')[1])
+    return iterations, metric
+
+def to_uint16(img):
+    """ the clipping the pipeline applies to all registration results """
+    return img.clip(0.0,2.0**16).astype('uint16')
+
+#==============================================================================
+### backends
+#==============================================================================
+
+class Backend(object):
+    """ interface of a registration backend """
+    name = None
+
+    def register(self, img, ref_img, parameter_filepath, outpath, initial_transform=None):
+        """ registers img (moving) to ref_img (fixed) with the elastix
+        parameter file, writes the TransformParameters.0.txt into outpath and
+        returns the transformed img as uint16 array. initial_transform is the
+        path of a TransformParameters file the registration starts from """
+        raise NotImplementedError
+
+    def transform(self, img, transformation_filepath, outpath):
+        """ applies the transformation in the TransformParameters file to img,
+        side products go into outpath. Returns the transformed img as uint16
+        array """
+        raise NotImplementedError
+
+
+class ElastixBackend(Backend):
+    """ runs the elastix and transformix binaries. Each call is waited for,
+    and killed if it takes longer than timeout seconds (None: no limit). A
+    failed, killed or incomplete call raises a RegistrationError. """
+    name = 'elastix'
+
+    def __init__(self, elastix_bin='elastix', transformix_bin='transformix', verbose=False, artifact_level='full', timeout=None):
+        if artifact_level not in artifact_levels:
+            raise ValueError("unknown artifact level: " + str(artifact_level))
+        self.elastix_bin = elastix_bin
+        self.transformix_bin = transformix_bin
+        self.verbose = verbose
+        self.artifact_level = artifact_level
+        self.timeout = timeout
+        self.buffer = None
+
+    def keep_for_inspection(self, mhd_path):
+        """ at artifact level full, dumps the mhd as tif next to it """
+        if self.artifact_level != 'full':
+            return
+        tif_path = os.path.splitext(mhd_path)[0] + '.tif'
+        io.mhd2tiff(mhd_path,tif_path)
+        io.count_io(artifact_bytes=os.path.getsize(tif_path), artifact_files=1)
+
+    def count_deformation_field(self, outpath):
+        """ counts the deformation field written by transformix -def all """
+        for ext in ['.mhd','.raw']:
+            path = outpath + '/deformationField' + ext
+            if os.path.exists(path):
+                io.count_io(artifact_bytes=os.path.getsize(path), artifact_files=1)
+
+    def remove_images(self, outpath, names):
+        """ at artifact level none, the image files (mhd+raw) are removed from
+        outpath once they are read. The TransformParameters are kept, as later
+        steps need them. """
+        if self.artifact_level != 'none':
+            return
+        for name in names:
+            for ext in ['.mhd','.raw']:
+                path = outpath + '/' + name + ext
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def write_mhd(self, img, mhd_path):
+        """ writes img as float32 mhd/raw, as elastix reads it. The conversion
+        goes through a float32 buffer that is reused for all frames of the same
+        shape. """
+        if self.buffer is None or self.buffer.shape != img.T.shape:
+            self.buffer = sp.empty(img.T.shape,dtype='float32')
+        io.save_mhd(img,mhd_path,buffer=self.buffer)
+        # formerly, a tiff was written and read back before writing the mhd
+        io.count_io(bytes_saved=2*img.nbytes)
+
+    def call(self, command):
+        """ runs command (a list of arguments) and waits for the process to
+        exit. Returns the exit status. The call is recorded as a stage named
+        after the binary (see instrumentation) """
+        with instrumentation.stage(os.path.basename(command[0])):
+            return self.wait(command)
+
+    def wait(self, command):
+        """ runs command and waits for it, see call """
+        if self.verbose:
+            p = subprocess.Popen(command)
+        else:
+            FNULL = open(os.devnull, 'w')
+            p = subprocess.Popen(command, stdout=FNULL, stderr=subprocess.STDOUT) # silenced
+        
+        # python 2 can't wait with a timeout, a timer kills the process instead
+        timed_out = []
+        def kill():
+            timed_out.append(True)
+            try:
+                p.kill()
+            except OSError: # exited in the meantime
+                pass
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout,kill)
+            timer.start()
+        try:
+            retcode = p.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        
+        if timed_out:
+            raise RegistrationError("%s killed after %s s timeout" % (command[0],self.timeout))
+        return retcode
+
+    def check_result(self, mhd_path, command):
+        """ the process has exited, its result has to be there completely """
+        if not io.mhd_complete(mhd_path):
+            raise RegistrationError("%s exited without a complete %s" % (command[0],mhd_path))
+
+    def register(self, img, ref_img, parameter_filepath, outpath, initial_transform=None):
+        """ writes the mhd files in the directory outpath, runs elastix with
+        the parameter_file on it. input and output files are thus going to be in
+        the same directory. Then the mhd file is read again and returned as an
+        array. 
+        
+        With initial_transform, elastix is run with -t0. The resulting
+        TransformParameters.0.txt refers to the initial transform file, which
+        has to be kept for transformix """
+
+        # make the directories
+        makedirs(outpath)
+
+        # write mhd files into outpath
+        img_mhdpath = outpath + '/image.mhd'
+        self.write_mhd(img,img_mhdpath)
+
+        ref_img_mhdpath = outpath + '/ref_image.mhd'
+        self.write_mhd(ref_img,ref_img_mhdpath)
+
+        # run elastix, waiting for the process itself (formerly, the result file
+        # was polled for every 2 s)
+        command = [self.elastix_bin,'-f',ref_img_mhdpath,'-m',img_mhdpath,'-out',outpath,'-p',parameter_filepath]
+        if initial_transform is not None:
+            command += ['-t0',initial_transform]
+        retcode = self.call(command)
+
+        if retcode != 0:
+            raise RegistrationError("elastix exited with %i, see %s/elastix.log" % (retcode,outpath))
+        self.check_result(outpath + '/result.0.mhd',command)
+
+        # read elastix output, convert it to uint16 tif
+        output = to_uint16(io.read_mhd(outpath + '/result.0.mhd'))
+        try:
+            metric = read_elastix_log(outpath + '/elastix.log')[1]
+        except (IOError, OSError, ValueError):
+            metric = None
+        write_final_metric(outpath,metric)
+
+        # dump elastix output for inspection
+        self.keep_for_inspection(outpath + '/result.0.mhd')
+        self.remove_images(outpath,['image','ref_image','result.0'])
+        return output
+
+    def transform(self, img, transformation_filepath, outpath):
+        """ dumps img as mhd into outpath, executes the transformix call, reads
+        the result mhd afterwards and returns the array of the transformed data
+        """
+        makedirs(outpath)
+
+        # dumping the array to mhd
+        img_mhdpath = outpath + '/frame.mhd'
+        self.write_mhd(img,img_mhdpath)
+
+        # run transformix, the deformation field is only for inspection
+        command = [self.transformix_bin,'-in',img_mhdpath,'-out',outpath,'-tp',transformation_filepath]
+        if self.artifact_level == 'full':
+            command[1:1] = ['-def','all']
+        retcode = self.call(command)
+
+        if retcode != 0:
+            raise RegistrationError("transformix exited with %i, see %s/transformix.log" % (retcode,outpath))
+        self.check_result(outpath + '/result.mhd',command)
+
+        output = to_uint16(io.read_mhd(outpath + '/result.mhd'))
+
+        # dump transformix output for inspection
+        self.keep_for_inspection(outpath + '/result.mhd')
+        if self.artifact_level == 'full':
+            self.count_deformation_field(outpath)
+        self.remove_images(outpath,['frame','result'])
+
+        return output
+
+
+class NativeBackend(Backend):
+    """ registers with an affine parameter file in-process (see
+    native_registration) and applies translation and affine transforms
+    in-process. Everything else (bspline) is passed on to the fallback backend,
+    elastix by default. """
+    name = 'native'
+
+    def __init__(self, fallback=None):
+        if fallback is None:
+            fallback = ElastixBackend()
+        self.fallback = fallback
+
+    def register(self, img, ref_img, parameter_filepath, outpath, initial_transform=None):
+        if get_transform_name(parameter_filepath) != 'AffineTransform':
+            return self.fallback.register(img, ref_img, parameter_filepath, outpath, initial_transform)
+        
+        # the optimization starts from translation or affine initial
+        # transforms, others are left to the fallback
+        initial_parameters = None
+        if initial_transform is not None:
+            initial = read_affine_transform(initial_transform)
+            if initial is None:
+                return self.fallback.register(img, ref_img, parameter_filepath, outpath, initial_transform)
+            initial_parameters = native_registration.recenter(initial[0],initial[1],native_registration.image_center(ref_img.shape))
+
+        makedirs(outpath)
+        parameters, center, metric = native_registration.register_affine(img,ref_img,initial_parameters)
+        tp = make_transform_parameters('AffineTransform',parameters,ref_img.shape,center)
+        io.write_transform_parameters(tp,outpath + '/TransformParameters.0.txt')
+        write_final_metric(outpath,metric)
+        return to_uint16(native_registration.warp_affine(img,parameters,center))
+
+    def transform(self, img, transformation_filepath, outpath):
+        affine = read_affine_transform(transformation_filepath)
+        if affine is None:
+            return self.fallback.transform(img, transformation_filepath, outpath)
+        parameters, center = affine
+        return to_uint16(native_registration.warp_affine(img,parameters,center))
+
+
+class FakeBackend(Backend):
+    """ a stand-in for elastix that does not register, but applies known
+    shifts.
+
+    shifts is a (n,2) array with the (x,y) translation of each frame (in the
+    elastix convention, i.e. the position in the moving image of a fixed image
+    point is x + shift). It is applied to registrations of the frame_i_n
+    directories below a directory named stage, all other registrations are the
+    identity. Without shifts, all registrations are the identity. Initial
+    transforms are ignored, the known shifts are the result. """
+    name = 'fake'
+
+    def __init__(self, shifts=None, stage='affine'):
+        self.shifts = shifts
+        self.stage = stage
+
+    def get_shift(self, outpath):
+        frame = frame_index(outpath)
+        if self.shifts is None or frame is None:
+            return sp.zeros(2)
+        if os.path.basename(os.path.dirname(os.path.normpath(outpath))) != self.stage:
+            return sp.zeros(2)
+        return sp.array(self.shifts[frame],dtype='float64')
+
+    def apply(self, img, parameters, center):
+        # the identity is returned exactly, without interpolation
+        if sp.allclose(parameters,native_registration.identity_parameters()):
+            return to_uint16(img)
+        return to_uint16(native_registration.warp_affine(img,parameters,center))
+
+    def register(self, img, ref_img, parameter_filepath, outpath, initial_transform=None):
+        makedirs(outpath)
+        shift = self.get_shift(outpath)
+        tp = make_transform_parameters('TranslationTransform',shift,ref_img.shape)
+        io.write_transform_parameters(tp,outpath + '/TransformParameters.0.txt')
+        write_final_metric(outpath,None)
+        return self.apply(img,sp.hstack([[1.0,0.0,0.0,1.0],shift]),sp.zeros(2))
+
+    def transform(self, img, transformation_filepath, outpath):
+        affine = read_affine_transform(transformation_filepath)
+        if affine is None:
+            # nothing else is ever written by this backend
+            raise ValueError("FakeBackend can't apply " + transformation_filepath)
+        parameters, center = affine
+        return self.apply(img,parameters,center)
+
+
+class CachedBackend(Backend):
+    """ registrations of backend are stored in a TransformCache (or in a new
+    one at cache_path) and looked up before they are computed. Transforms are
+    cheap compared to registrations, they are always passed on.
+
+    Results of the FakeBackend depend on the frame directory, not only on the
+    images, so it should not be cached. """
+
+    def __init__(self, backend, cache=None, cache_path=None, max_bytes=10*2**30):
+        if cache is None:
+            cache = transform_cache.TransformCache(cache_path,max_bytes)
+        self.backend = backend
+        self.cache = cache
+        self.name = backend.name
+        self.artifact_level = getattr(backend,'artifact_level','none')
+
+    def register(self, img, ref_img, parameter_filepath, outpath, initial_transform=None):
+        makedirs(outpath)
+        key = self.cache.key(img,ref_img,parameter_filepath,self.name,initial_transform)
+        output = self.cache.lookup(key,outpath)
+        if output is None:
+            output = self.backend.register(img,ref_img,parameter_filepath,outpath,initial_transform)
+            self.cache.store(key,outpath,output)
+        elif initial_transform is not None:
+            # the cached TransformParameters refer to the initial transform of
+            # the run that stored them
+            tp_path = outpath + '/TransformParameters.0.txt'
+            tp = io.read_transform_parameters(tp_path)
+            if tp['InitialTransformParametersFileName'][0] != 'NoInitialTransform':
+                tp['InitialTransformParametersFileName'] = [initial_transform]
+                io.write_transform_parameters(tp,tp_path)
+        return output
+
+    def transform(self, img, transformation_filepath, outpath):
+        return self.backend.transform(img,transformation_filepath,outpath)
+
+
+class CheckpointBackend(Backend):
+    """ records each finished registration and transform of backend in its
+    output directory, and reuses it when the same frame is registered or
+    transformed again with the same inputs, e.g. when a killed or crashed run
+    is restarted.
+    
+    A frame is done if its marker checkpoint.done holds the key of the inputs
+    (a hash of the images, of the parameter or TransformParameters file and the
+    chain of initial transforms it refers to, and of the backend name). The
+    result is kept as checkpoint.npy next to it. The marker is removed before a
+    frame is computed, both are written under a temporary name and renamed,
+    the marker last, so a killed run never leaves a marker of an unfinished
+    frame. Frames whose marker, result or TransformParameters are missing, do
+    not match or can not be read are computed again.
+    
+    A registration that directly follows another one in the same directory
+    replaces its result, e.g. the fallback of a warm start (see
+    xyt_movement_correction_lib.register_chain), so its marker holds the keys of
+    both, and a rerun reuses it for the first one already. """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.artifact_level = getattr(backend,'artifact_level','none')
+        self.last_registration = None # (outpath, key) of the last registration
+
+    def key(self, images, filepaths):
+        h = hashlib.sha1()
+        for arr in images:
+            arr = sp.ascontiguousarray(arr)
+            h.update(str(arr.dtype) + str(arr.shape))
+            h.update(arr.data)
+        for filepath in filepaths:
+            h.update(open(filepath,'rb').read())
+        h.update(self.name)
+        return h.hexdigest()
+
+    def chain(self, filepath):
+        """ filepath and the initial transforms it refers to """
+        initial = io.read_transform_parameters(filepath).get('InitialTransformParametersFileName',['NoInitialTransform'])[0]
+        if initial == 'NoInitialTransform':
+            return [filepath]
+        return [filepath] + self.chain(initial)
+
+    def load(self, key, outpath, shape, registration):
+        """ the result recorded in outpath if it is valid for key, else None """
+        try:
+            if key not in open(os.path.join(outpath,'checkpoint.done'),'r').read().split():
+                return None
+            if registration:
+                tp = io.read_transform_parameters(os.path.join(outpath,'TransformParameters.0.txt'))
+                if len(tp['TransformParameters']) != tp['NumberOfParameters'][0]:
+                    return None
+            output = sp.load(os.path.join(outpath,'checkpoint.npy'))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        if output.shape != shape:
+            return None
+        io.count_io(frames_resumed=1)
+        return output
+
+    def discard(self, outpath):
+        """ removes the marker of outpath, before its result is overwritten """
+        marker = os.path.join(outpath,'checkpoint.done')
+        if os.path.exists(marker):
+            os.remove(marker)
+
+    def save(self, keys, outpath, output):
+        tmp_path = os.path.join(outpath,'.tmp_checkpoint.npy')
+        sp.save(tmp_path,output)
+        os.rename(tmp_path,os.path.join(outpath,'checkpoint.npy'))
+        tmp_path = os.path.join(outpath,'.tmp_checkpoint.done')
+        with open(tmp_path,'w') as fh:
+            fh.write('\n'.join(keys))
+        os.rename(tmp_path,os.path.join(outpath,'checkpoint.done'))
+
+    def register(self, img, ref_img, parameter_filepath, outpath, initial_transform=None):
+        makedirs(outpath)
+        filepaths = [parameter_filepath] if initial_transform is None else [parameter_filepath] + self.chain(initial_transform)
+        key = self.key([img,ref_img],filepaths)
+        output = self.load(key,outpath,img.shape,True)
+        if output is None:
+            keys = [key]
+            if self.last_registration is not None and self.last_registration[0] == outpath:
+                keys.insert(0,self.last_registration[1])
+            self.discard(outpath)
+            output = self.backend.register(img,ref_img,parameter_filepath,outpath,initial_transform)
+            self.save(keys,outpath,output)
+        self.last_registration = (outpath,key)
+        return output
+
+    def transform(self, img, transformation_filepath, outpath):
+        makedirs(outpath)
+        self.last_registration = None
+        key = self.key([img],self.chain(transformation_filepath))
+        output = self.load(key,outpath,img.shape,False)
+        if output is None:
+            self.discard(outpath)
+            output = self.backend.transform(img,transformation_filepath,outpath)
+            self.save([key],outpath,output)
+        return output
+
+
+backends = {'elastix': ElastixBackend,
+            'native': NativeBackend,
+            'fake': FakeBackend}
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Feb 17 10:12:44 2015
+
+@author: georg
+"""
+
+"""
+a submitter script for movement correction of a batch of xyt tiff stacks on a
+single node, instead of one single_stack_aligner.py process per stack. The
+trials and their frames are scheduled over the cores of the node, see
+xyt_movement_correction_lib.run_trials(). The results of each trial are saved
+as by single_stack_aligner.py.
+
+submitter is called with 
+    first argument: a file containing the paths to the tiff files, one path per
+        line. A line can give the stimulus onset frame of its file after the path
+    second argument: stimulus onset frame number, for the files without one
+"""
+
+#==============================================================================
+# IMPORTS
+#==============================================================================
+import sys
+import os
+import multiprocessing
+
+import xyt_movement_correction_lib as moco
+
+#==============================================================================
+# flags
+#==============================================================================
+tmp_mode = True # if True writes all elastix files to the scratch of the clusters node or to /tmp, if not uses the same folder as the data
+cleanup = True # if True delete all elastix generated files afterwards
+n_cores = multiprocessing.cpu_count() # number of frames registered at the same time, over all trials
+streaming = False # if True the frames are streamed through the correction, see single_stack_aligner.py
+
+#==============================================================================
+# run
+#==============================================================================
+
+if __name__ == '__main__':
+    
+    filelist_file = sys.argv[1]
+    odor_onset_frame = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    
+    trials = []
+    with open(filelist_file,'r') as fH:
+        for line in fH.readlines():
+            line = line.strip()
+            if not line:
+                continue
+            fields = line.rsplit(None,1)
+            if len(fields) == 2 and fields[1].isdigit():
+                trials.append((os.path.abspath(fields[0]), int(fields[1])))
+            elif odor_onset_frame is not None:
+                trials.append((os.path.abspath(line), odor_onset_frame))
+            else:
+                print "Error! no stimulus onset frame for", line
+                sys.exit()
+    
+    print "### batch stack align ###"
+    print len(trials), "trials on", n_cores, "cores"
+    
+    failed = moco.run_trials(trials,n_cores=n_cores,tmp_mode=tmp_mode,remove_elastix_files=cleanup,streaming=streaming)
+    
+    if failed:
+        print "Error!", len(failed), "trials failed:"
+        for data_path, error in failed:
+            print data_path
+        sys.exit(1)
@@ -0,0 +1,858 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Feb  9 16:40:05 2015
+
+@author: georg
+"""
+
+from __future__ import division
+
+"""
+benchmarks for the movement correction. The benchmarks run on synthetic xyt
+stacks with known motion, so that besides speed also the registration error can
+be reported.
+
+called with
+    first argument: name of the benchmark (see benchmarks dict at the end)
+    optional second argument: number of frames
+    optional third argument: frame size (square frames)
+    further arguments are passed on to the benchmark, e.g. the backend name
+
+Benchmarks that measure memory run each variant in a subprocess of this
+script, so that the peak memory of one variant does not hide the other.
+
+e.g. python benchmarks.py affine 20 256
+"""
+
+#==============================================================================
+# IMPORTS
+#==============================================================================
+import scipy as sp
+import scipy.ndimage as ndimage
+import scipy.linalg
+
+import sys
+import os
+import time
+import zlib
+import shutil
+import struct
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+from distutils.spawn import find_executable
+
+import IOtools as io
+import tifffile
+import xyt_movement_correction_lib as moco
+import native_registration
+import backends
+import instrumentation
+import transform_parameters
+
+#==============================================================================
+### synthetic data
+#==============================================================================
+
+def make_template(shape, seed=0):
+    """ a smooth random uint16 image with structures of a few pixels size,
+    in the intensity range of our recordings """
+    rng = sp.random.RandomState(seed)
+    img = ndimage.gaussian_filter(rng.rand(*shape),sigma=4)
+    img = (img - img.min()) / (img.max() - img.min())
+    return (img * 3000 + 500).astype('uint16')
+
+def make_affine_stack(n_frames=20, size=256, max_shift=4.0, max_rotation=0.02, max_scale=0.01, seed=0):
+    """
+    returns a xyt stack in which each frame is the reference image, moved by a
+    random affine transform, the reference image and the (n,6) array of the
+    true elastix ordered transform parameters (fixed to moving).
+
+    The frames are cut from a larger template, so that no zero borders enter the
+    registration.
+    """
+    rng = sp.random.RandomState(seed)
+    border = int(size * 0.125) + int(max_shift) + 1
+    template = make_template((size + 2*border,size + 2*border),seed=seed).astype('float64')
+    center = native_registration.image_center(template.shape)
+    crop = (slice(border,border+size),slice(border,border+size))
+
+    data = sp.zeros((size,size,n_frames),dtype='uint16')
+    parameters = sp.zeros((n_frames,6))
+    for frame in range(n_frames):
+        angle = rng.uniform(-max_rotation,max_rotation)
+        scale = 1 + rng.uniform(-max_scale,max_scale)
+        A = scale * sp.array([[sp.cos(angle),-sp.sin(angle)],[sp.sin(angle),sp.cos(angle)]])
+        t = rng.uniform(-max_shift,max_shift,2)
+        parameters[frame] = sp.hstack([A.ravel(),t])
+
+        # moving = template o T^-1, so registering moving onto template gives T
+        M = native_registration.affine_matrix(parameters[frame],center)
+        A_inv = scipy.linalg.inv(M[:,:2])
+        moved = ndimage.affine_transform(template,A_inv,offset=-sp.dot(A_inv,M[:,2]),order=3)
+        data[:,:,frame] = moved[crop].clip(0,2**16-1)
+
+    return data, template[crop].astype('uint16'), parameters
+
+def make_motion_field(shape, motion, rng, max_shift=4.0, max_rotation=0.02, max_scale=0.01, elastic_amplitude=1.5):
+    """ a random displacement field (2,x,y) of the given motion: 'translation',
+    'affine' or 'elastic' (affine plus a smooth nonlinear part of up to
+    elastic_amplitude pixels). A point p of the fixed image is at p + field(p)
+    in the moving image, as elastix defines its transforms. Returns the field
+    and the elastix ordered parameters of its affine part """
+    x, y = sp.mgrid[0:shape[0],0:shape[1]].astype('float64')
+    parameters = native_registration.identity_parameters()
+    parameters[4:6] = rng.uniform(-max_shift,max_shift,2)
+    if motion in ['affine','elastic']:
+        angle = rng.uniform(-max_rotation,max_rotation)
+        scale = 1 + rng.uniform(-max_scale,max_scale)
+        parameters[:4] = (scale * sp.array([[sp.cos(angle),-sp.sin(angle)],[sp.sin(angle),sp.cos(angle)]])).ravel()
+    M = native_registration.affine_matrix(parameters,native_registration.image_center(shape))
+    field = sp.array([M[0,0]*x + M[0,1]*y + M[0,2] - x, M[1,0]*x + M[1,1]*y + M[1,2] - y])
+    if motion == 'elastic':
+        for i in range(2):
+            smooth = ndimage.gaussian_filter(rng.randn(*shape),sigma=shape[0] / 8.0)
+            field[i] += smooth / abs(smooth).max() * elastic_amplitude
+    return field, parameters
+
+def warp_field(img, field, border, n_iterations=4):
+    """ the moving image of the (cropped) fixed image img[border:-border,
+    border:-border] under the displacement field: moving(q) = img(p) with
+    q = p + field(p). p is found by fixed point iteration, p = q - field(p) """
+    shape = field.shape[1:]
+    q = sp.mgrid[0:shape[0],0:shape[1]].astype('float64')
+    p = q - field
+    for i in range(n_iterations):
+        p = q - sp.array([ndimage.map_coordinates(f,p,order=1,mode='nearest') for f in field])
+    return ndimage.map_coordinates(img,p + border,order=3,mode='nearest')
+
+def make_synthetic_stack(n_frames=40, size=128, motion='translation', noise=0.0, bursts=False, seed=0):
+    """
+    a xyt stack of the reference image, each frame moved by a random motion
+    (see make_motion_field). noise is the standard deviation of gaussian noise
+    added to each frame. With bursts, a few spots of the tissue respond after
+    the odor onset (frame n_frames//4) with a fast rise and a slow decay, as
+    with a stimulus.
+    
+    returns the stack, the reference image, the (n,2,x,y) true displacement
+    fields, the (n,6) parameters of their affine parts, and a signal channel
+    for movement_correct_two_color: the responses alone, moved the same way
+    """
+    rng = sp.random.RandomState(seed)
+    border = int(size * 0.125) + 8
+    template = make_template((size + 2*border,size + 2*border),seed=seed).astype('float64')
+    
+    spots = sp.zeros(template.shape)
+    if bursts:
+        for i in range(5):
+            spots[tuple(rng.randint(border,border+size,2))] = 1
+        spots = ndimage.gaussian_filter(spots,sigma=3)
+        spots *= 1500 / spots.max()
+    onset = n_frames // 4
+    response = [0.0 if frame < onset else sp.exp(-(frame - onset) / (n_frames / 8.0)) * (1 - sp.exp(-(frame - onset + 1) / 2.0))
+                for frame in range(n_frames)]
+    
+    data = sp.zeros((size,size,n_frames),dtype='uint16')
+    signal = sp.zeros((size,size,n_frames),dtype='uint16')
+    fields = sp.zeros((n_frames,2,size,size))
+    parameters = sp.zeros((n_frames,6))
+    for frame in range(n_frames):
+        fields[frame], parameters[frame] = make_motion_field((size,size),motion,rng)
+        moved = warp_field(template + response[frame] * spots,fields[frame],border)
+        if noise:
+            moved += rng.randn(size,size) * noise
+        data[:,:,frame] = moved.clip(0,2**16-1)
+        signal[:,:,frame] = (warp_field(response[frame] * spots,fields[frame],border) + 200).clip(0,2**16-1)
+    
+    return data, template[border:-border,border:-border].astype('uint16'), fields, parameters, signal
+
+#==============================================================================
+### error measures
+#==============================================================================
+
+def displacement_error(parameters, center, true_parameters, shape):
+    """ mean euclidean distance (in pixels) between the points of the image
+    mapped by the estimated and by the true transform """
+    x, y = sp.mgrid[0:shape[0],0:shape[1]]
+    points = sp.vstack([x.ravel(),y.ravel()]).astype('float64')
+    M = native_registration.affine_matrix(parameters,center)
+    M_true = native_registration.affine_matrix(true_parameters,center)
+    diff = sp.dot(M[:,:2] - M_true[:,:2],points) + (M[:,2] - M_true[:,2])[:,sp.newaxis]
+    return sp.sqrt((diff**2).sum(axis=0)).mean()
+
+def field_error(tp_path, field, valid):
+    """ mean euclidean distance (in pixels, over the valid region) between the
+    displacements of the transform in the TransformParameters file (incl. its
+    initial transforms) and the true displacement field (2,x,y) """
+    diff = transform_parameters.read(tp_path).displacement_field(field.shape[1:]) - field
+    return sp.sqrt((diff**2).sum(axis=0))[valid].mean()
+
+def peak_rss(children=False):
+    """ peak resident memory of this process so far, in MB (linux). With
+    children, of its largest (finished) child process instead, e.g. a pool
+    worker or elastix """
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+def disk_usage(path):
+    """ bytes of all files below path """
+    return sum([os.path.getsize(os.path.join(root,name)) for root, dirs, names in os.walk(path) for name in names])
+
+def run_variant(name, *args):
+    """ runs the benchmark function name with args in a subprocess, returns
+    the numbers it prints on its last line """
+    command = [sys.executable,os.path.abspath(__file__),name] + [str(arg) for arg in args]
+    output = subprocess.check_output(command)
+    return [float(value) for value in output.strip().split('\n')[-1].split()]
+
+def report(name, n_frames, seconds, errors, rms):
+    print "%-16s %8.1f ms/frame %8.2f frames/s   displacement error %.4f px (max %.4f)   residual rms %.1f" % (
+        name, seconds / n_frames * 1e3, n_frames / seconds, sp.mean(errors), sp.amax(errors), rms)
+
+#==============================================================================
+### stage timing
+#==============================================================================
+
+# the pipeline functions whose instrumentation records are reported as stages
+stage_functions = ['transform_tstack','apply_transform','split_signal_background','calc_ref_stack']
+
+def report_stages(stage_records):
+    """ prints the time, frames and bytes written of each call of the
+    stage_functions among the instrumentation records, labeled by the function
+    and its output_subdir or mode """
+    for record in stage_records:
+        if record['name'] not in stage_functions:
+            continue
+        label = ' '.join([record['name'],record.get('output_subdir') or record.get('mode','')]).strip()
+        n_frames = record['data'][2] if len(record.get('data',[])) == 3 else 0
+        rate = "%8.2f frames/s" % (n_frames / record['wall']) if n_frames else " " * 17
+        print "  %-40s %5i frames %8.2f s %s %8.2f MB written" % (label, n_frames, record['wall'], rate, record['bytes_written'] / 2.0**20)
+
+#==============================================================================
+### reference implementations
+#==============================================================================
+
+def split_signal_background_reference(data_affine_transformed, ref_img_affine_transformed):
+    """ steps 3) and 4) of movement_correct_tstack as they were before
+    moco.split_signal_background, to compare against """
+    # 3) extracting the signal
+    data_signal = data_affine_transformed.astype('float') - ref_img_affine_transformed[:,:,sp.newaxis].astype('float')
+    data_signal = data_signal.clip(0,65536).astype('uint16')
+    
+    # smoothing the signal
+    data_signal_filt = sp.zeros(data_signal.shape)
+    for frame in range(data_signal.shape[2]):
+        data_signal_filt[:,:,frame] = ndimage.gaussian_filter(data_signal[:,:,frame],sigma=0.75)
+        pass
+    data_signal_filt = data_signal_filt.clip(0,65536).astype('uint16')
+    
+    # 4) extracting the background
+    data_background = data_affine_transformed.astype('float') - data_signal_filt.astype('float')
+    data_background = data_background.clip(0,65536).astype('uint16')
+    return data_signal, data_background
+
+def decodepackbits_reference(encoded):
+    """ tifffile.decodepackbits before it was vectorized, to compare against """
+    func = ord if sys.version[0] == '2' else lambda x: x
+    result = []
+    i = 0
+    try:
+        while True:
+            n = func(encoded[i]) + 1
+            i += 1
+            if n < 129:
+                result.extend(encoded[i:i+n])
+                i += n
+            elif n > 129:
+                result.extend(encoded[i:i+1] * (258-n))
+                i += 1
+    except IndexError:
+        pass
+    return b''.join(result) if sys.version[0] == '2' else bytes(result)
+
+def decodelzw_reference(encoded):
+    """ tifffile.decodelzw before it was vectorized, to compare against """
+    unpack = struct.unpack
+
+    if sys.version[0] == '2':
+        newtable = [chr(i) for i in range(256)]
+    else:
+        newtable = [bytes([i]) for i in range(256)]
+    newtable.extend((0, 0))
+
+    def next_code():
+        """Return integer of `bitw` bits at `bitcount` position in encoded."""
+        start = bitcount // 8
+        s = encoded[start:start+4]
+        try:
+            code = unpack('>I', s)[0]
+        except Exception:
+            code = unpack('>I', s + b'\x00'*(4-len(s)))[0]
+        code = code << (bitcount % 8)
+        code = code & mask
+        return code >> shr
+
+    switchbitch = {  # code: bit-width, shr-bits, bit-mask
+        255: (9, 23, int(9*'1'+'0'*23, 2)),
+        511: (10, 22, int(10*'1'+'0'*22, 2)),
+        1023: (11, 21, int(11*'1'+'0'*21, 2)),
+        2047: (12, 20, int(12*'1'+'0'*20, 2)), }
+    bitw, shr, mask = switchbitch[255]
+    bitcount = 0
+
+    if len(encoded) < 4:
+        raise ValueError("strip must be at least 4 characters long")
+
+    if next_code() != 256:
+        raise ValueError("strip must begin with CLEAR code")
+
+    code = oldcode = 0
+    result = []
+    while True:
+        code = next_code()  # ~5% faster when inlining this function
+        bitcount += bitw
+        if code == 257:  # EOI
+            break
+        if code == 256:  # CLEAR
+            table = newtable[:]
+            lentable = 258
+            bitw, shr, mask = switchbitch[255]
+            code = next_code()
+            bitcount += bitw
+            if code == 257:  # EOI
+                break
+            result.append(table[code])
+        else:
+            if code < lentable:
+                decoded = table[code]
+                newcode = table[oldcode] + decoded[:1]
+            else:
+                newcode = table[oldcode]
+                newcode += newcode[:1]
+                decoded = newcode
+            result.append(decoded)
+            table.append(newcode)
+            lentable += 1
+        oldcode = code
+        if lentable in switchbitch:
+            bitw, shr, mask = switchbitch[lentable]
+
+    if code != 257:
+        raise ValueError("unexpected end of stream (code %i)" % code)
+
+    return b''.join(result)
+
+def open_tiff_reference(path):
+    """ opens a tiff file and parses the tags of every page, as the former
+    TIFFfile._fromfile did """
+    tif = tifffile.TIFFfile(path)
+    pages = [tifffile.TIFFpage(tif,offset=offset,index=i) for i, offset in enumerate(tif.pages.offsets)]
+    return tif, pages
+
+#==============================================================================
+### encoders, to generate compressed test data
+#==============================================================================
+
+def encode_packbits(data):
+    """ PackBits encodes the byte string data: runs of 3 or more equal bytes
+    become repeat packets, everything else literal packets (both at most 128
+    bytes) """
+    data = bytearray(data)
+    result = bytearray()
+    i = 0
+    while i < len(data):
+        run = 1
+        while i + run < len(data) and run < 128 and data[i+run] == data[i]:
+            run += 1
+        if run >= 3:
+            result.append(257 - run)
+            result.append(data[i])
+            i += run
+            continue
+        start = i
+        while i < len(data) and i - start < 128:
+            if i + 2 < len(data) and data[i] == data[i+1] == data[i+2]:
+                break
+            i += 1
+        result.append(i - start - 1)
+        result += data[start:i]
+    return bytes(result)
+
+def encode_lzw(data):
+    """ LZW encodes the byte string data as a TIFF strip: starting with CLEAR,
+    ending with EOI, MSB first, with the code width growing one code early as
+    TIFF readers expect it """
+    codes = [256]
+    fresh_table = dict((chr(i), i) for i in range(256))
+    table = dict(fresh_table)
+    next_code = 258
+    w = ''
+    for c in data:
+        wc = w + c
+        if wc in table:
+            w = wc
+            continue
+        codes.append(table[w])
+        table[wc] = next_code
+        next_code += 1
+        w = c
+        if next_code == 4094: # table full, start over
+            codes.append(256)
+            table = dict(fresh_table)
+            next_code = 258
+    if w:
+        codes.append(table[w])
+    codes.append(257)
+
+    # the width of each code follows the size of the table of the decoder
+    bits = []
+    lentable = 258
+    first = True
+    for code in codes:
+        if lentable < 511:
+            bitw = 9
+        elif lentable < 1023:
+            bitw = 10
+        elif lentable < 2047:
+            bitw = 11
+        else:
+            bitw = 12
+        bits.append(format(code,'0%ib' % bitw))
+        if code == 256:
+            lentable = 258
+            first = True
+        elif first:
+            first = False
+        else:
+            lentable += 1
+    bits = ''.join(bits)
+    bits += '0' * (-len(bits) % 8)
+    return b''.join(chr(int(bits[i:i+8],2)) for i in range(0,len(bits),8))
+
+def save_compressed_tstack(data, path, codec='deflate'):
+    """ writes the (x,y,t) uint16 stack data as a little endian tiff with one
+    compressed strip per page. codec: deflate, lzw or packbits """
+    compression, encode = {'deflate': (8, zlib.compress),
+                           'lzw': (5, encode_lzw),
+                           'packbits': (32773, encode_packbits)}[codec]
+    x, y, n_frames = data.shape
+    fh = open(path,'wb')
+    try:
+        fh.write(struct.pack('<2sHI','II',42,0))
+        next_ifd_pos = 4 # where the offset of the next IFD goes
+        for frame in range(n_frames):
+            strip = encode(data[:,:,frame].T.astype('<u2').tostring())
+            strip_offset = fh.tell()
+            fh.write(strip)
+            if fh.tell() % 2: # IFDs start on a word boundary
+                fh.write('\0')
+            ifd_offset = fh.tell()
+            # (code, type (3 short, 4 long), value), sorted by code
+            tags = [(256,4,x),(257,4,y),(258,3,16),(259,3,compression),(262,3,1),
+                    (273,4,strip_offset),(277,3,1),(278,4,y),(279,4,len(strip))]
+            fh.write(struct.pack('<H',len(tags)))
+            for code, dtype, value in tags:
+                fh.write(struct.pack('<HHIH2x' if dtype == 3 else '<HHII',code,dtype,1,value))
+            fh.write(struct.pack('<I',0))
+            fh.seek(next_ifd_pos)
+            fh.write(struct.pack('<I',ifd_offset))
+            fh.seek(0,2)
+            next_ifd_pos = fh.tell() - 4
+    finally:
+        fh.close()
+
+#==============================================================================
+### benchmarks
+#==============================================================================
+
+def benchmark_affine(n_frames=20, size=256):
+    """ speed and residual error of the affine registration of each frame to
+    the reference, in-process (affine_native) vs elastix with
+    parameters_affine.txt. The elastix part is skipped if the binary is not
+    found. """
+    data, ref_img, true_parameters = make_affine_stack(n_frames,size)
+    valid = (slice(8,-8),slice(8,-8)) # ignore the borders that were moved out of the frame
+
+    print "affine registration of", n_frames, "frames of", size, "x", size
+
+    # native
+    errors = []
+    residuals = []
+    t0 = time.time()
+    for frame in range(n_frames):
+        parameters, c, metric = native_registration.register_affine(data[:,:,frame],ref_img)
+        output = native_registration.warp_affine(data[:,:,frame],parameters,c)
+        errors.append(displacement_error(parameters,c,true_parameters[frame],ref_img.shape))
+        residuals.append(output[valid] - ref_img[valid])
+    seconds = time.time() - t0
+    report('affine_native',n_frames,seconds,errors,sp.sqrt(sp.mean(sp.array(residuals)**2)))
+
+    # elastix
+    if not find_executable(moco.elastix_bin):
+        print "elastix not found at", moco.elastix_bin, "skipping"
+        return
+
+    tmpdir = tempfile.mkdtemp(prefix='moco_benchmark_')
+    errors = []
+    residuals = []
+    try:
+        t0 = time.time()
+        for frame in range(n_frames):
+            outpath = tmpdir + '/frame_' + str(frame)
+            output = moco.run_elastix(data[:,:,frame],ref_img,moco.affine_parameters_path,outpath)
+            transform = transform_parameters.read(outpath + '/TransformParameters.0.txt')
+            parameters, c = transform.parameters, transform.center
+            errors.append(displacement_error(parameters,c,true_parameters[frame],ref_img.shape))
+            residuals.append(output[valid].astype('float64') - ref_img[valid])
+        seconds = time.time() - t0
+    finally:
+        shutil.rmtree(tmpdir)
+    report('elastix',n_frames,seconds,errors,sp.sqrt(sp.mean(sp.array(residuals)**2)))
+
+def prealign_report(name, n_frames, seconds, errors, iterations, metrics=None):
+    line = "%-26s %8.1f ms/frame   iterations/frame %7.1f   displacement error %.3f px (max %.3f)" % (
+        name, seconds / n_frames * 1e3, sp.mean(iterations), sp.mean(errors), sp.amax(errors))
+    if metrics:
+        line += "   final metric %.4f" % sp.mean(metrics)
+    print line
+
+def benchmark_prealign(n_frames=20, size=128, max_shift=24):
+    """ affine registration of frames with large translations (up to max_shift
+    pixels), starting from the identity or from the translation found by phase
+    correlation (see native_registration.phase_correlation), in-process and
+    with elastix and parameters_affine.txt (-t0). Reports time, iterations
+    (elastix: from elastix.log, the adaptive stochastic gradient descent of
+    parameters_affine.txt always runs MaximumNumberOfIterations, so there the
+    difference shows in the error and the final metric) and the error against
+    the true transforms. The elastix part is skipped if the binary is not
+    found. """
+    data, ref_img, true_parameters = make_affine_stack(n_frames,size,max_shift=float(max_shift))
+    print "affine registration of", n_frames, "frames of", size, "x", size, "with shifts up to", max_shift, "px"
+    
+    t0 = time.time()
+    shifts = native_registration.phase_correlation(data,ref_img)
+    prealign_seconds = time.time() - t0 # included in the times of the prealigned registrations
+    errors = sp.sqrt(((shifts - true_parameters[:,4:6])**2).sum(axis=1))
+    print "%-26s %8.1f ms/frame   translation error %.3f px (max %.3f)" % ('phase correlation', prealign_seconds / n_frames * 1e3, errors.mean(), errors.max())
+    
+    # native
+    for prealign in [False, True]:
+        errors = []
+        iterations = []
+        t0 = time.time()
+        for frame in range(n_frames):
+            initial = sp.hstack([[1.0,0.0,0.0,1.0],shifts[frame]]) if prealign else None
+            info = {}
+            parameters, c, metric = native_registration.register_affine(data[:,:,frame],ref_img,initial,info=info)
+            errors.append(displacement_error(parameters,c,true_parameters[frame],ref_img.shape))
+            iterations.append(sum(info['iterations']))
+        seconds = time.time() - t0 + (prealign_seconds if prealign else 0)
+        prealign_report('affine_native' + (' prealigned' if prealign else ''),n_frames,seconds,errors,iterations)
+    
+    # elastix
+    if not find_executable(moco.elastix_bin):
+        print "elastix not found at", moco.elastix_bin, "skipping"
+        return
+    
+    tmpdir = tempfile.mkdtemp(prefix='moco_benchmark_')
+    try:
+        for prealign in [False, True]:
+            errors = []
+            iterations = []
+            metrics = []
+            t0 = time.time()
+            for frame in range(n_frames):
+                outpath = tmpdir + '/' + str(prealign) + '/frame_' + str(frame)
+                initial_transform = moco.write_initial_transform(shifts[frame],ref_img.shape,outpath) if prealign else None
+                moco.run_elastix(data[:,:,frame],ref_img,moco.affine_parameters_path,outpath,backend='elastix',initial_transform=initial_transform)
+                parameters, c = backends.read_affine_transform(outpath + '/TransformParameters.0.txt') # composed with the initial translation
+                errors.append(displacement_error(parameters,c,true_parameters[frame],ref_img.shape))
+                frame_iterations, metric = backends.read_elastix_log(outpath + '/elastix.log')
+                iterations.append(sum(frame_iterations))
+                if metric is not None:
+                    metrics.append(metric)
+            seconds = time.time() - t0 + (prealign_seconds if prealign else 0)
+            prealign_report('elastix' + (' prealigned' if prealign else ''),n_frames,seconds,errors,iterations,metrics)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def benchmark_pipeline(n_frames=20, size=128, backend='fake'):
+    """ throughput of the full movement_correct_tstack pipeline on a stack of
+    known translations. With the fake backend (default), the known shifts are
+    applied in the affine stage, so this runs without elastix and measures the
+    overhead of the pipeline around the registrations. Any other backend name
+    (see moco.get_backend) runs the real registrations. """
+    data, ref_img, true_parameters = make_affine_stack(n_frames,size,max_rotation=0,max_scale=0)
+    if backend == 'fake':
+        backend = backends.FakeBackend(shifts=true_parameters[:,4:6])
+    valid = (slice(8,-8),slice(8,-8))
+
+    tmpdir = tempfile.mkdtemp(prefix='moco_benchmark_')
+    try:
+        data_path = tmpdir + '/stack.tif'
+        io.save_tstack(data,data_path)
+        t0 = time.time()
+        results = moco.movement_correct_tstack(data_path,n_frames//4,ref_img=ref_img,backend=backend)
+        seconds = time.time() - t0
+    finally:
+        shutil.rmtree(tmpdir)
+
+    data_affine_transformed = results[0]
+    residual = data_affine_transformed[valid].astype('float64') - ref_img[valid][:,:,sp.newaxis]
+    print "movement_correct_tstack of", n_frames, "frames of", size, "x", size, "backend", moco.get_backend(backend).name
+    print "%.1f ms/frame %.2f frames/s   affine residual rms %.1f" % (seconds / n_frames * 1e3, n_frames / seconds, sp.sqrt(sp.mean(residual**2)))
+
+def make_split_stack(n_frames, size):
+    """ an affine registered stack with responses, and its reference image """
+    rng = sp.random.RandomState(0)
+    ref_img = make_template((size,size))
+    data = sp.empty((size,size,n_frames),dtype='uint16')
+    for frame in range(n_frames): # frame by frame, to keep the peak memory low
+        data[:,:,frame] = ref_img + (rng.rand(size,size) * 500).astype('uint16')
+    return data, ref_img
+
+def split_variant(variant, n_frames=500, size=256):
+    """ one run of a variant of the signal/background split, prints the time
+    (s) and the peak memory (MB) on top of the input data. Runs in a
+    subprocess of benchmark_split """
+    data, ref_img = make_split_stack(n_frames,size)
+    rss_before = peak_rss()
+    t0 = time.time()
+    if variant == 'reference':
+        results = split_signal_background_reference(data,ref_img)
+    else:
+        results = moco.split_signal_background(data,ref_img)
+    seconds = time.time() - t0
+    print seconds, peak_rss() - rss_before
+
+def benchmark_split(n_frames=500, size=256):
+    """ time and peak memory of the signal/background split (steps 3 and 4
+    of movement_correct_tstack) of the former implementation and the current
+    vectorized one. Checks that both give the same results. """
+    data, ref_img = make_split_stack(min(n_frames,20),size)
+    for expected, result in zip(split_signal_background_reference(data,ref_img),moco.split_signal_background(data,ref_img)):
+        if not (expected == result).all():
+            print "Error! results differ from the reference implementation"
+            sys.exit()
+    
+    print "signal/background split of", n_frames, "frames of", size, "x", size, "(input %.1f MB)" % (n_frames * size**2 * 2 / 2.0**20)
+    for variant in ['reference','vectorized']:
+        seconds, rss = run_variant('split_variant',variant,n_frames,size)
+        print "%-16s %8.1f ms/frame %8.2f frames/s   peak memory +%.1f MB" % (variant, seconds / n_frames * 1e3, n_frames / seconds, rss)
+
+def benchmark_codecs(n_frames=10, size=256):
+    """ decode throughput of tifffile.decodelzw and decodepackbits against
+    their former implementations, on one strip per frame of a smooth and of a
+    noisy stack. The strips are encoded here, and the decoded data of both
+    implementations are checked against the original data (round trip). """
+    rng = sp.random.RandomState(0)
+    smooth, ref_img, true_parameters = make_affine_stack(n_frames,size,max_rotation=0,max_scale=0)
+    noisy = smooth + (rng.rand(*smooth.shape) * 64).astype('uint16')
+    codecs = [('lzw',encode_lzw,decodelzw_reference,tifffile.decodelzw),
+              ('packbits',encode_packbits,decodepackbits_reference,tifffile.decodepackbits)]
+
+    print "decoding", n_frames, "strips of", size, "x", size, "uint16"
+    for name, data in [('smooth',smooth),('noisy',noisy)]:
+        strips = [data[:,:,frame].T.tostring() for frame in range(n_frames)]
+        MB = len(strips) * len(strips[0]) / 2.0**20
+        for codec, encode, decode_reference, decode in codecs:
+            encoded = [encode(strip) for strip in strips]
+            ratio = sum([len(e) for e in encoded]) / 2.0**20 / MB
+            for variant, func in [('reference',decode_reference),('vectorized',decode)]:
+                t0 = time.time()
+                decoded = [func(e) for e in encoded]
+                seconds = time.time() - t0
+                if decoded != strips:
+                    print "Error!", variant, codec, "decoding does not reproduce the data"
+                    sys.exit()
+                print "%-8s %-9s %-10s %8.2f MB/s   compressed to %.2f" % (name, codec, variant, MB / seconds, ratio)
+
+def benchmark_tiff_open(n_frames=None, size=64):
+    """ time to open tiff stacks of 1k, 10k and 50k pages (or n_frames pages)
+    and to get their first frame, with the lazy page index of tifffile against
+    parsing every page. Also the time to parse all pages lazily (as for
+    reading the whole stack) is reported, and the pages are checked against
+    the fully parsed ones. """
+    page_counts = [1000,10000,50000] if n_frames is None else [n_frames]
+    frame = make_template((size,size)).T
+    tmp_dir = tempfile.mkdtemp(prefix='tiff_open_')
+    try:
+        for n_pages in page_counts:
+            path = os.path.join(tmp_dir,'stack_%i.tif' % n_pages)
+            with tifffile.TiffWriter(path) as tif:
+                for i in range(n_pages):
+                    tif.save(frame)
+
+            t0 = time.time()
+            tif, pages_reference = open_tiff_reference(path)
+            t_reference = time.time() - t0
+
+            t0 = time.time()
+            tif = tifffile.TIFFfile(path)
+            t_open = time.time() - t0
+            first = tif.pages[0].asarray()
+            t_first = time.time() - t0
+            pages = list(tif.pages)
+            t_all = time.time() - t0
+
+            for page, page_reference in zip(pages,pages_reference):
+                if page.memmap_offset != page_reference.memmap_offset or str(page) != str(page_reference):
+                    print "Error! page", page.index, "differs from the fully parsed page"
+                    sys.exit()
+            if not sp.all(first == frame):
+                print "Error! first frame does not reproduce the data"
+                sys.exit()
+
+            print "%6i pages of %i x %i: open %8.3f s, first frame %8.3f s, all pages %8.3f s, parsing every page %8.3f s" % (
+                n_pages, size, size, t_open, t_first, t_all, t_reference)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def benchmark_decode_threads(n_frames=200, size=512, codec='deflate'):
+    """ time to read a compressed stack with TIFFfile.asarray by 1, 2, 4 and
+    as many threads as there are cores. The stack is written here, and the
+    data read are checked against it """
+    rng = sp.random.RandomState(0)
+    data, ref_img, true_parameters = make_affine_stack(n_frames,size,max_rotation=0,max_scale=0)
+    data += (rng.rand(*data.shape) * 64).astype('uint16')
+    tmp_dir = tempfile.mkdtemp(prefix='decode_threads_')
+    try:
+        path = os.path.join(tmp_dir,'stack.tif')
+        save_compressed_tstack(data,path,codec)
+        MB = data.nbytes / 2.0**20
+        print "decoding", n_frames, "pages of", size, "x", size, "uint16,", codec, "compressed to %.2f," % (os.path.getsize(path) / 2.0**20 / MB), multiprocessing.cpu_count(), "cores"
+        for workers in sorted(set([1,2,4,multiprocessing.cpu_count()])):
+            tif = tifffile.TIFFfile(path)
+            t0 = time.time()
+            decoded = tif.asarray(workers=workers)
+            seconds = time.time() - t0
+            if not sp.all(decoded == data.T):
+                print "Error!", workers, "workers do not reproduce the data"
+                sys.exit()
+            print "%2i workers: %8.3f s  %8.2f MB/s" % (workers, seconds, MB / seconds)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+scenarios = {'translation': dict(motion='translation'),
+             'affine': dict(motion='affine'),
+             'elastic': dict(motion='elastic'),
+             'noise': dict(motion='translation',noise=100.0),
+             'bursts': dict(motion='translation',bursts=True)}
+
+pipelines = ['movement_correct_tstack','align_tstacks','movement_correct_two_color']
+
+def suite_variant(n_frames, size, backend, scenario, pipeline):
+    """ runs one pipeline on a synthetic stack of scenario and prints the time,
+    frames/s and bytes written of each of its stages, and the peak memory, disk
+    usage and registration error of the run.
+    
+    The displacement error is the one of the affine stage of
+    movement_correct_tstack, against the true motion (the reference image is
+    the unmoved template). The residual rms is the one of the final output
+    against the template. With the fake backend, the true translations are
+    applied in the affine stage, the errors then show the part of the motion
+    that is not a translation. As it does not align trials, align_tstacks
+    reports no residual then.
+    
+    The stages are read from the instrumentation records. Only the pipeline
+    is timed, not the setup (e.g. the corrections of the trials that
+    align_tstacks aligns) """
+    data, ref_img, fields, parameters, signal = make_synthetic_stack(n_frames,size,seed=1,**scenarios[scenario])
+    onset = n_frames // 4
+    valid = (slice(8,-8),slice(8,-8))
+    
+    def get_backend(parameters):
+        if backend == 'fake':
+            return backends.FakeBackend(shifts=parameters[:,4:6])
+        return backend
+    
+    instrumentation.enabled = True
+    instrumentation.max_records = None # all stages of the run are reported
+    tmpdir = tempfile.mkdtemp(prefix='moco_benchmark_')
+    try:
+        data_path = tmpdir + '/trial0.tif'
+        io.save_tstack(data,data_path)
+        if pipeline == 'align_tstacks':
+            # a second trial of the same tissue, both corrected as by single_stack_aligner.py first
+            data_2, ref_img_2, fields_2, parameters_2, signal_2 = make_synthetic_stack(n_frames,size,seed=2,**scenarios[scenario])
+            trials = [(data_path,data,parameters),(tmpdir + '/trial1.tif',data_2,parameters_2)]
+            full_paths = []
+            for path, trial_data, trial_parameters in trials:
+                io.save_tstack(trial_data,path)
+                results = moco.movement_correct_tstack(path,onset,ref_img=ref_img,backend=get_backend(trial_parameters))
+                io.save_tstack(results[3],os.path.splitext(path)[0] + '_background_bspline.tif')
+                io.save_tstack(results[4],os.path.splitext(path)[0] + '_full.tif')
+                full_paths.append(os.path.splitext(path)[0] + '_full.tif')
+        if pipeline == 'movement_correct_two_color':
+            signal_path = tmpdir + '/trial0_signal_channel.tif'
+            io.save_tstack(signal,signal_path)
+        
+        # only the pipeline itself is timed, not the setup
+        start = instrumentation.mark()
+        io_before = io.get_io_counter()
+        t0 = time.time()
+        if pipeline == 'movement_correct_tstack':
+            results = moco.movement_correct_tstack(data_path,onset,ref_img=ref_img,backend=get_backend(parameters))
+            output = results[4]
+        if pipeline == 'align_tstacks':
+            data_affine_aligned, output, ref_img_global = moco.align_tstacks(full_paths[0],full_paths,backend=get_backend(parameters))
+        if pipeline == 'movement_correct_two_color':
+            output, output_signal = moco.movement_correct_two_color(data_path,signal_path,onset,backend=get_backend(parameters))
+        seconds = time.time() - t0
+        bytes_written = io.io_counter_diff(io.get_io_counter(),io_before)['bytes_written']
+        stage_records = instrumentation.records[start[0]:]
+        disk = disk_usage(tmpdir)
+        
+        errors = []
+        if pipeline == 'movement_correct_tstack':
+            for frame in range(n_frames):
+                tp_path = moco.get_frame_dir(data_path,'affine',frame,n_frames) + '/TransformParameters.0.txt'
+                errors.append(field_error(tp_path,fields[frame],valid))
+    finally:
+        shutil.rmtree(tmpdir)
+    
+    residual = output[valid].astype('float64') - ref_img[valid][:,:,sp.newaxis]
+    if pipeline == 'align_tstacks' and backend == 'fake':
+        residual_text = "residual not computed, the fake backend does not align trials"
+    else:
+        residual_text = "residual rms %.1f" % sp.sqrt(sp.mean(residual**2))
+    print "%s, %s: %i frames of %i x %i, backend %s" % (pipeline, scenario, n_frames, size, size, moco.get_backend(get_backend(parameters)).name)
+    report_stages(stage_records)
+    print "  total %.2f s, %.2f frames/s, peak RSS %.1f MB (largest child %.1f MB), %.2f MB written, %.2f MB on disk" % (
+        seconds, n_frames / seconds, peak_rss(), peak_rss(children=True), bytes_written / 2.0**20, disk / 2.0**20)
+    if errors:
+        print "  affine displacement error %.3f px (max %.3f), %s" % (sp.mean(errors), sp.amax(errors), residual_text)
+    else:
+        print "  " + residual_text
+
+def benchmark_suite(n_frames=40, size=128, backend='fake', scenario=None, pipeline=None):
+    """ runs each pipeline on synthetic stacks of each scenario (translation,
+    affine, elastic, noise, bursts, see make_synthetic_stack), or only the given
+    scenario and pipeline, each in a subprocess (see suite_variant). With the
+    fake backend (default), no elastix is needed """
+    for scenario_name in sorted(scenarios) if scenario is None else [scenario]:
+        for pipeline_name in pipelines if pipeline is None else [pipeline]:
+            subprocess.check_call([sys.executable] + ['-W' + w for w in sys.warnoptions] + [os.path.abspath(__file__),'suite_variant',str(n_frames),str(size),backend,scenario_name,pipeline_name])
+
+benchmarks = {'affine': benchmark_affine,
+              'prealign': benchmark_prealign,
+              'pipeline': benchmark_pipeline,
+              'split': benchmark_split,
+              'codecs': benchmark_codecs,
+              'tiff_open': benchmark_tiff_open,
+              'decode_threads': benchmark_decode_threads,
+              'suite': benchmark_suite,
+              'suite_variant': suite_variant,
+              'split_variant': split_variant}
+
+def parse_arg(arg):
+    try:
+        return int(arg)
+    except ValueError:
+        return arg
+
+if __name__ == '__main__':
+    name = sys.argv[1]
+    args = [parse_arg(arg) for arg in sys.argv[2:]]
+    benchmarks[name](*args)
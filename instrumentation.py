@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Mar  2 10:12:31 2015
+
+@author: georg
+"""
+
+from __future__ import division
+
+"""
+SUMMARY: records where the time of a correction goes. The wall time, CPU time
+and IO of each stage (elastix calls, mhd conversion, tiff reading and writing,
+the scratch copy, the pipeline functions) are recorded per call and per frame,
+and written as a JSON report next to the outputs.
+
+DETAILS: A stage is a block of code entered with the stage context manager or
+a function decorated with timed. For each stage, a record is kept with:
+
+    name: the name of the stage, e.g. 'read_mhd'
+    path: the names of the enclosing stages and its own, joined by '/', e.g.
+        'movement_correct_tstack/transform_tstack/frame/run_elastix/elastix'
+    wall: wall time in s
+    cpu: CPU time (user + system) of the process in s
+    cpu_children: CPU time of the child processes that exited during the
+        stage, in s. This is where the time of elastix and transformix shows up
+    bytes_read, bytes_written, files_read, files_written: the IO counted by
+        IOtools during the stage
+    frame: the frame, for the stages of a frame job
+
+and the keywords given to the stage. A frame job (see
+xyt_movement_correction_lib._run_frame_job) is a stage named 'frame', its
+records are taken from the worker and returned with the result of the frame,
+so the records of pool workers end up in the main process as their IO does.
+
+The records are kept per process in the list records, and summed up per path
+in totals as they finish. Only the first max_records records are kept, so that
+long and streaming runs don't grow in memory, the totals include all of them.
+write_report writes the records together with the totals (the summary) to a
+JSON file. The overhead is a few microseconds per stage, setting the
+environment variable MOCO_INSTRUMENTATION=0 (or enabled) switches the
+recording off.
+"""
+
+#==============================================================================
+# IMPORTS
+#==============================================================================
+import os
+import json
+import time
+import socket
+import inspect
+import functools
+
+import IOtools as io
+
+#==============================================================================
+### CONSTANTS DECLARATIONS
+#==============================================================================
+
+enabled = os.environ.get('MOCO_INSTRUMENTATION','1') == '1'
+
+# the IO counter keys that are recorded per stage
+io_keys = ['bytes_read','bytes_written','files_read','files_written']
+
+# the values that are summed up per path in the summary
+summary_keys = ['wall','cpu','cpu_children'] + io_keys
+
+# the number of records that are kept per process, None keeps all
+max_records = 10000
+
+records = [] # finished stages of this process, in the order they finished
+totals = {} # path: totals of summary_keys and the number of calls, of all records
+dropped = 0 # records that were not kept, see max_records
+_stack = [] # names of the stages that are currently entered
+_isolated = [] # the stack detached by isolate, while a frame job runs
+
+#==============================================================================
+### stages
+#==============================================================================
+
+class stage(object):
+    """ context manager recording the block as a stage named name, the keyword
+    arguments are added to the record, e.g.
+
+        with stage('scratch copy', path=data_path):
+            ...
+    """
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+
+    def __enter__(self):
+        if enabled:
+            _stack.append(self.name)
+            self.io_before = io.get_io_counter()
+            self.times_before = os.times()
+            self.t_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if enabled:
+            wall = time.time() - self.t_start
+            times = os.times()
+            io_stage = io.io_counter_diff(io.get_io_counter(),self.io_before)
+            record = dict(self.info)
+            record.update(name=self.name, path='/'.join(_stack), wall=wall,
+                          cpu=(times[0] + times[1]) - (self.times_before[0] + self.times_before[1]),
+                          cpu_children=(times[2] + times[3]) - (self.times_before[2] + self.times_before[3]))
+            for key in io_keys:
+                record[key] = io_stage[key]
+            if exc_type is not None:
+                record['error'] = exc_type.__name__
+            _stack.pop()
+            keep(record)
+        return False
+
+def timed(name=None, args=()):
+    """ decorator recording each call of the function as a stage, named after
+    the function if name is None. The values of the arguments named in args
+    are added to the record, of arrays their shape """
+    def decorator(func):
+        stage_name = func.__name__ if name is None else name
+        @functools.wraps(func)
+        def wrapper(*func_args, **func_kwargs):
+            info = {}
+            if enabled and args:
+                call_args = inspect.getcallargs(func,*func_args,**func_kwargs)
+                for arg in args:
+                    value = call_args[arg]
+                    info[arg] = list(value.shape) if hasattr(value,'shape') else value
+            with stage(stage_name,**info):
+                return func(*func_args, **func_kwargs)
+        return wrapper
+    return decorator
+
+def keep(record):
+    """ adds the record to records and totals. Beyond max_records, it is only
+    added to the totals, except within a frame job, whose records are taken
+    (see take) and added again in the main process """
+    global dropped
+    path_totals = totals.setdefault(record['path'],dict([(key,0) for key in summary_keys],calls=0))
+    path_totals['calls'] += 1
+    for key in summary_keys:
+        path_totals[key] += record[key]
+    if max_records is None or len(records) < max_records or _isolated:
+        records.append(record)
+    else:
+        dropped += 1
+
+def copy_totals(path_totals):
+    return dict([(path,dict(values)) for path, values in path_totals.items()])
+
+def mark():
+    """ the current state of records and totals, for take and write_report """
+    return len(records), copy_totals(totals), dropped
+
+def take(start):
+    """ removes the records since mark() returned start from records and
+    totals and returns them """
+    global dropped
+    taken = records[start[0]:]
+    del records[start[0]:]
+    totals.clear()
+    totals.update(copy_totals(start[1]))
+    dropped = start[2]
+    return taken
+
+def add(stage_records, **info):
+    """ adds records of another process (see take), as if their stages had run
+    within the currently entered stages. info is added to each record """
+    prefix = '/'.join(_stack)
+    for record in stage_records:
+        record = dict(record)
+        record.update(info)
+        if prefix:
+            record['path'] = prefix + '/' + record['path']
+        keep(record)
+
+def isolate():
+    """ detaches the currently entered stages, e.g. for a frame job that runs
+    in the main process, so its records have the same paths as in a pool
+    worker. Returns what restore needs """
+    stack = list(_stack)
+    del _stack[:]
+    _isolated.append(stack)
+    return stack
+
+def restore(stack):
+    """ undoes isolate """
+    _isolated.pop()
+    _stack[:] = stack
+
+#==============================================================================
+### report
+#==============================================================================
+
+def summarize(start=None):
+    """ the totals per path since mark() returned start (default: of this
+    process), as a dict path: totals """
+    if start is None:
+        return copy_totals(totals)
+    summary = {}
+    for path, path_totals in totals.items():
+        before = start[1].get(path)
+        if before is None:
+            summary[path] = dict(path_totals)
+        elif path_totals['calls'] > before['calls']:
+            summary[path] = dict([(key,path_totals[key] - before[key]) for key in path_totals])
+    return summary
+
+def get_report_path(output_path):
+    """ the report for the outputs output_path + '_affine.tif' etc. """
+    return output_path + '_report.json'
+
+def write_report(path, start=None, **info):
+    """ writes the records and their summary since mark() returned start
+    (default: all of this process) to path as JSON, with info. Does nothing if
+    instrumentation is disabled """
+    if not enabled:
+        return
+    stage_records = records if start is None else records[start[0]:]
+    report = dict(info)
+    report.update(created=time.strftime('%Y-%m-%d %H:%M:%S'), host=socket.gethostname(), pid=os.getpid(),
+                  summary=summarize(start), records=stage_records,
+                  dropped_records=dropped if start is None else dropped - start[2])
+    with open(path,'w') as fH:
+        json.dump(report,fH,indent=1,sort_keys=True,default=float)
+    print "instrumentation report written to", path
@@ -23,6 +23,7 @@ import sys
 import os
 
 import IOtools as io
+import instrumentation
 import xyt_movement_correction_lib as moco
 
 
@@ -31,6 +32,7 @@ import xyt_movement_correction_lib as moco
 #==============================================================================
 tmp_mode = True # writes all elastix files to the scratch of the clusters node or to /tmp
 cleanup = True # if True delete all elastix generated files afterwards
+n_workers = 1 # number of frames registered in parallel, set to the number of cores of the node
 verbose = True
 
 if __name__ == '__main__':
@@ -69,11 +71,11 @@ if __name__ == '__main__':
         # also copying the background_bspline to scratch. it needs to be in the same folder
 #        bspline_path = os.path.splitext(data_path_orig)[0][:-5] + '_background_bspline.tif'  # FIXME: hardcoded -5 remove a '_full'
         bspline_path = '_'.join(data_path_orig.split('_')[:-1]) + '_background_bspline.tif' # fix       
-        bspline_path = moco.make_tmp_dir(bspline_path) # the bpline file is copied into the same folder than the data (PID named)
+        bspline_path = moco.make_tmp_dir(bspline_path,os.path.dirname(data_path)) # the bpline file is copied into the same folder than the data (PID named)
     
     if verbose:
         print "running align ... "
-    data_affine_aligned, data_bspline_aligned, ref_img_global = moco.align_tstacks(data_path,tstack_paths)
+    data_affine_aligned, data_bspline_aligned, ref_img_global = moco.align_tstacks(data_path,tstack_paths,n_workers=n_workers)
     
     # output path generation:
     if subdir:
@@ -102,6 +104,10 @@ if __name__ == '__main__':
         if verbose:
             print "running cleanup"
         moco.cleanup(data_path)
+    
+    # time and IO of the stages, see the instrumentation module
+    instrumentation.write_report(instrumentation.get_report_path(os.path.join(outdir,os.path.splitext(os.path.basename(data_path_orig))[0] + 'global')),
+                                 data_path=data_path_orig,tstack_paths=tstack_paths)
 
     if verbose:
         print "all done!"
@@ -27,6 +27,7 @@ import sys
 import os
 
 import IOtools as io
+import instrumentation
 import xyt_movement_correction_lib as moco
 
 
@@ -35,6 +36,7 @@ import xyt_movement_correction_lib as moco
 #==============================================================================
 tmp_mode = True # writes all elastix files to the scratch of the clusters node or to /tmp
 cleanup = True # if True delete all elastix generated files afterwards
+n_workers = 1 # number of frames registered in parallel, set to the number of cores of the node
 
 #==============================================================================
 # run
@@ -55,10 +57,14 @@ if __name__ == '__main__':
         data_bg_path = moco.make_tmp_dir(data_bg_path)
         data_sg_path = moco.make_tmp_dir(data_sg_path)        
         
-    data_bg_transformed, data_sg_transformed = moco.movement_correct_two_color(data_bg_path, data_sg_path, odor_onset_frame)
+    data_bg_transformed, data_sg_transformed = moco.movement_correct_two_color(data_bg_path, data_sg_path, odor_onset_frame, n_workers=n_workers)
     io.save_tstack(data_bg_transformed,os.path.splitext(data_bg_path_orig)[0] + '_bg_moco.tif')
     io.save_tstack(data_sg_transformed,os.path.splitext(data_sg_path_orig)[0] + '_sg_moco.tif')   
     
     if cleanup:
         moco.cleanup(data_bg_path)
-        moco.cleanup(data_sg_path) # only one needed? TEST 
\ No newline at end of file
+        moco.cleanup(data_sg_path) # only one needed? TEST
+    
+    # time and IO of the stages, see the instrumentation module
+    instrumentation.write_report(instrumentation.get_report_path(os.path.splitext(data_sg_path_orig)[0] + '_moco'),
+                                 data_bg_path=data_bg_path_orig,data_sg_path=data_sg_path_orig,odor_onset_frame=int(odor_onset_frame)) 
\ No newline at end of file
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Feb  9 10:12:31 2015
+
+@author: georg
+"""
+
+from __future__ import division
+
+"""
+SUMMARY: an in-process affine registration engine for single xy frames, as an
+alternative to running elastix with parameters_affine.txt on every frame. No
+files are written, no processes are spawned.
+
+DETAILS: The transform follows the elastix AffineTransform convention, so that
+the results can be compared to (and written as) elastix TransformParameters:
+a fixed image point x is mapped into the moving image by
+
+    T(x) = A (x - c) + c + t
+
+with A the 2x2 matrix, t the translation and c the center of rotation (the
+image center). The parameters are stored in the elastix order
+a11 a12 a21 a22 tx ty. Arrays are indexed (x,y), as everywhere in this package.
+
+The parameters are found by a Gauss-Newton minimization of the sum of squared
+differences of the intensity normalized images on a multi resolution pyramid,
+similar to the schedule in parameters_affine.txt (8 4 2 1). The final warp uses
+cubic interpolation, as FinalBSplineInterpolationOrder 3 does in elastix.
+
+phase_correlation estimates the translation of all frames of a stack at once
+from the FFTs of the frames and of the reference image. It is used to
+initialize the affine registrations (see transform_tstack, prealign), so that
+large shifts don't have to be found by the optimizer.
+"""
+
+#==============================================================================
+# IMPORTS
+#==============================================================================
+import scipy as sp
+import scipy.ndimage as ndimage
+import scipy.linalg
+import scipy.fftpack as fftpack
+
+#==============================================================================
+### CONSTANTS DECLARATIONS
+#==============================================================================
+
+pyramid_schedule = (8,4,2,1) # downsampling factor of each resolution level
+max_iterations = 50 # Gauss-Newton iterations per resolution level
+max_samples = 20000 # number of pixels used per level, more are subsampled
+tolerance = 1e-4 # stop iterating once the update moves no point more than this (in pixels)
+phase_correlation_chunk_size = 64 # frames transformed at a time by phase_correlation
+
+#==============================================================================
+### HELPERS
+#==============================================================================
+
+def identity_parameters():
+    """ the elastix parameter vector of the identity transform """
+    return sp.array([1.0,0.0,0.0,1.0,0.0,0.0])
+
+def image_center(shape):
+    """ center of rotation for an image of shape, in pixel coordinates. Elastix
+    uses the center of the fixed image as well """
+    return (sp.array(shape[:2],dtype='float64') - 1) / 2.0
+
+def affine_matrix(parameters, center):
+    """ returns the 2x3 matrix M = [A | o] of the transform, so that a point x
+    of the fixed image maps to A x + o in the moving image """
+    A = sp.reshape(parameters[:4],(2,2))
+    o = parameters[4:6] + center - sp.dot(A,center)
+    return sp.hstack([A,o[:,sp.newaxis]])
+
+def matrix_parameters(M, center):
+    """ the elastix parameter vector of the 2x3 matrix M (see affine_matrix)
+    for the center of rotation center """
+    A = M[:,:2]
+    t = M[:,2] - center + sp.dot(A,center)
+    return sp.hstack([A.ravel(),t])
+
+def recenter(parameters, center, new_center):
+    """ the parameters of the same transform for the center of rotation
+    new_center instead of center """
+    A = sp.reshape(parameters[:4],(2,2))
+    t = parameters[4:6] + sp.dot(A - sp.eye(2),new_center - center)
+    return sp.hstack([parameters[:4],t])
+
+def normalize(img):
+    """ zero mean and unit variance float64 copy of img """
+    img = img.astype('float64')
+    std = img.std()
+    if std == 0:
+        std = 1.0
+    return (img - img.mean()) / std
+
+def downsample(img, factor):
+    """ smooths and subsamples an image by an integer factor """
+    if factor == 1:
+        return img
+    img = ndimage.gaussian_filter(img,sigma=factor/2.0)
+    return img[::factor,::factor]
+
+def sample_points(shape, n_max, seed=0):
+    """ returns the (2,n) coordinates of all pixels of an image of shape, or a
+    fixed random subset of n_max of them. The subset is seeded, so repeated
+    registrations of the same frame are deterministic """
+    x, y = sp.mgrid[0:shape[0],0:shape[1]]
+    points = sp.vstack([x.ravel(),y.ravel()]).astype('float64')
+    if n_max is not None and points.shape[1] > n_max:
+        rng = sp.random.RandomState(seed)
+        points = points[:,rng.choice(points.shape[1],n_max,replace=False)]
+    return points
+
+#==============================================================================
+### registration
+#==============================================================================
+
+def register_affine(img, ref_img, initial_parameters=None, info=None):
+    """
+    finds the affine transform that maps img (moving) onto ref_img (fixed).
+
+    initial_parameters: elastix ordered parameter vector to start from, identity
+    if not given
+    
+    info: if a dict is given, the number of iterations done per resolution
+    level is stored in it as 'iterations'
+
+    returns the parameter vector, the center of rotation and the final metric
+    value (the mean squared difference of the normalized images)
+    """
+    fixed = normalize(ref_img)
+    moving = normalize(img)
+    center = image_center(fixed.shape)
+
+    if initial_parameters is None:
+        parameters = identity_parameters()
+    else:
+        parameters = sp.array(initial_parameters,dtype='float64')
+
+    metric = sp.inf
+    iterations = []
+    for factor in pyramid_schedule:
+        fixed_l = downsample(fixed,factor)
+        moving_l = downsample(moving,factor)
+        center_l = center / factor
+
+        grad_x, grad_y = sp.gradient(moving_l)
+        points = sample_points(fixed_l.shape,max_samples)
+        fixed_values = ndimage.map_coordinates(fixed_l,points,order=1)
+        dx = points - center_l[:,sp.newaxis] # derivatives of T wrt the matrix entries
+
+        # at this level, translations are in units of downsampled pixels
+        p = parameters.copy()
+        p[4:6] = p[4:6] / factor
+
+        n_iterations = 0
+        for iteration in range(max_iterations):
+            n_iterations += 1
+            A = sp.reshape(p[:4],(2,2))
+            mapped = sp.dot(A,dx) + center_l[:,sp.newaxis] + p[4:6,sp.newaxis]
+
+            # only points that land inside of the moving image contribute
+            inside = ((mapped[0] >= 0) & (mapped[0] <= moving_l.shape[0]-1) &
+                      (mapped[1] >= 0) & (mapped[1] <= moving_l.shape[1]-1))
+            if inside.sum() < 6:
+                break
+            mapped_in = mapped[:,inside]
+            dx_in = dx[:,inside]
+
+            residual = ndimage.map_coordinates(moving_l,mapped_in,order=1) - fixed_values[inside]
+            gx = ndimage.map_coordinates(grad_x,mapped_in,order=1)
+            gy = ndimage.map_coordinates(grad_y,mapped_in,order=1)
+            metric = sp.mean(residual**2)
+
+            J = sp.vstack([gx*dx_in[0],gx*dx_in[1],gy*dx_in[0],gy*dx_in[1],gx,gy]).T
+            H = sp.dot(J.T,J)
+            H[sp.diag_indices(6)] *= 1.0 + 1e-3 # Levenberg damping
+            try:
+                update = scipy.linalg.solve(H,-sp.dot(J.T,residual))
+            except scipy.linalg.LinAlgError:
+                break
+            p = p + update
+
+            # largest displacement of any sampled point caused by the update
+            step = sp.absolute(sp.dot(sp.reshape(update[:4],(2,2)),dx_in)).max() + sp.absolute(update[4:6]).max()
+            if step * factor < tolerance:
+                break
+
+        p[4:6] = p[4:6] * factor
+        parameters = p
+        iterations.append(n_iterations)
+
+    if info is not None:
+        info['iterations'] = iterations
+    return parameters, center, metric
+
+def warp_affine(img, parameters, center, order=3):
+    """ applies the transform to img, returns a float64 array of the same
+    shape. Pixels mapped from outside of img are 0, as DefaultPixelValue 0 """
+    M = affine_matrix(parameters,center)
+    return ndimage.affine_transform(img.astype('float64'),M[:,:2],offset=M[:,2],order=order,mode='constant',cval=0.0)
+
+def register_frame(img, ref_img, initial_parameters=None):
+    """ registers and warps a single frame, returns the warped frame (uint16,
+    clipped the same way as run_elastix does) and its 2x3 affine matrix.
+    initial_parameters as in register_affine """
+    parameters, center, metric = register_affine(img,ref_img,initial_parameters)
+    output = warp_affine(img,parameters,center)
+    output = output.clip(0.0,2.0**16).astype('uint16')
+    return output, affine_matrix(parameters,center)
+
+def warp_tstack(data, matrices, order=3):
+    """ applies the (n,2,3) affine matrices of a registration to each frame of
+    the xyt stack data, e.g. to transfer the transforms of one channel to
+    another """
+    data_transformed = sp.zeros(data.shape,dtype='uint16')
+    for frame in range(data.shape[2]):
+        M = matrices[frame]
+        output = ndimage.affine_transform(data[:,:,frame].astype('float64'),M[:,:2],offset=M[:,2],order=order,mode='constant',cval=0.0)
+        data_transformed[:,:,frame] = output.clip(0.0,2.0**16)
+    return data_transformed
+
+#==============================================================================
+### phase correlation
+#==============================================================================
+
+def phase_correlation_reference(ref_img):
+    """ the window and the conjugated spectrum of the windowed ref_img, which
+    phase_correlation needs for every chunk of frames """
+    window = sp.outer(sp.hanning(ref_img.shape[0]),sp.hanning(ref_img.shape[1])).astype('float32')
+    ref = ref_img.astype('float32')
+    ref_fft = fftpack.fft2((ref - ref.mean()) * window)
+    return window, sp.conj(ref_fft)
+
+def peak_offset(left, center, right):
+    """ sub pixel position of the maximum of a parabola through three
+    neighbouring values, relative to the center one """
+    denominator = left - 2 * center + right
+    offset = sp.zeros(center.shape)
+    nonzero = denominator != 0
+    offset[nonzero] = 0.5 * (left[nonzero] - right[nonzero]) / denominator[nonzero]
+    return offset.clip(-0.5,0.5)
+
+def phase_correlation(data, ref_img, reference=None, chunk_size=None):
+    """
+    estimates the translation of each frame of the xyt stack data against
+    ref_img by phase correlation: the peak of the inverse FFT of the normalized
+    cross power spectrum of frame and reference is at the shift of the frame.
+    The frames and the reference are windowed, to suppress the image borders.
+    
+    The spectrum of the reference is computed once (or taken from reference,
+    see phase_correlation_reference), the frames are transformed in chunks of
+    chunk_size (default phase_correlation_chunk_size) frames at a time, as one
+    array. data can be memory mapped, only a chunk is read at a time.
+    
+    returns the (n,2) array of the (x,y) shifts in the elastix convention (the
+    parameters of a TranslationTransform: a point x of the reference is at
+    x + shift in the frame), with sub pixel precision. Shifts are found up to
+    half the frame size.
+    """
+    if reference is None:
+        reference = phase_correlation_reference(ref_img)
+    if chunk_size is None:
+        chunk_size = phase_correlation_chunk_size
+    window, ref_fft_conj = reference
+    nx, ny = ref_img.shape
+    n_frames = data.shape[2]
+    
+    shifts = sp.zeros((n_frames,2))
+    for start in range(0,n_frames,chunk_size):
+        chunk = sp.array(data[:,:,start:start+chunk_size],dtype='float32')
+        chunk -= chunk.mean(axis=(0,1))
+        chunk *= window[:,:,sp.newaxis]
+        cross = fftpack.fft2(chunk,axes=(0,1)) * ref_fft_conj[:,:,sp.newaxis]
+        cross /= sp.absolute(cross) + 1e-12
+        correlation = fftpack.ifft2(cross,axes=(0,1)).real
+        
+        # integer peak, then a parabola through its neighbours in x and y
+        frames = sp.arange(chunk.shape[2])
+        peak = sp.argmax(correlation.reshape(nx*ny,-1),axis=0)
+        px, py = sp.unravel_index(peak,(nx,ny))
+        dx = peak_offset(correlation[(px-1) % nx,py,frames],correlation[px,py,frames],correlation[(px+1) % nx,py,frames])
+        dy = peak_offset(correlation[px,(py-1) % ny,frames],correlation[px,py,frames],correlation[px,(py+1) % ny,frames])
+        
+        # peaks beyond half the size are negative shifts
+        px = sp.where(px > nx // 2, px - nx, px)
+        py = sp.where(py > ny // 2, py - ny, py)
+        shifts[start:start+chunk.shape[2]] = sp.vstack([px + dx, py + dy]).T
+    return shifts
@@ -23,7 +23,6 @@ import scipy as sp
 import sys
 import os
 
-import IOtools as io
 import xyt_movement_correction_lib as moco
 
 #==============================================================================
@@ -31,6 +30,8 @@ import xyt_movement_correction_lib as moco
 #==============================================================================
 tmp_mode = True # if True writes all elastix files to the scratch of the clusters node or to /tmp, if not uses the same folder as the data
 cleanup = True # if True delete all elastix generated files afterwards
+n_workers = 1 # number of frames registered in parallel, set to the number of cores of the node
+streaming = False # if True the frames are streamed through the correction and the results written as they are computed, for recordings that don't fit into memory
 
 #==============================================================================
 # run
@@ -46,21 +47,5 @@ if __name__ == '__main__':
 #    data_path = '/home/georg/python/xyt_movement_correction/test_data/stack_trunc.tif'    
 #    odor_onset_frame = 5
     
-    ### preparations
-    data_path_orig = data_path
-    if tmp_mode:
-        data_path = moco.make_tmp_dir(data_path) 
-    
-    ### run
-    data_affine_transformed, data_signal, data_background, data_background_bspline_transformed, data_bspline_transformed = moco.movement_correct_tstack(data_path,odor_onset_frame)
-    
-    ### save
-    io.save_tstack(data_affine_transformed,os.path.splitext(data_path_orig)[0] + '_affine.tif')
-    io.save_tstack(data_signal,os.path.splitext(data_path_orig)[0] + '_signal.tif')
-    io.save_tstack(data_background,os.path.splitext(data_path_orig)[0] + '_background.tif')
-    io.save_tstack(data_background_bspline_transformed,os.path.splitext(data_path_orig)[0] + '_background_bspline.tif') # this one is needed for multicolor correction!
-    io.save_tstack(data_bspline_transformed,os.path.splitext(data_path_orig)[0] + '_full.tif')
-    
-    ### cleanup
-    if cleanup:
-        moco.cleanup(data_path)
+    ### run, the results are saved next to the data
+    moco.movement_correct_file(data_path,odor_onset_frame,n_workers=n_workers,tmp_mode=tmp_mode,remove_elastix_files=cleanup,streaming=streaming)
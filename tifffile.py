@@ -119,12 +119,14 @@ import time
 import struct
 import warnings
 import datetime
+import threading
 import collections
+from multiprocessing.pool import ThreadPool
 from xml.etree import cElementTree as ElementTree
 
 import numpy
 
-__all__ = ['imsave', 'imread', 'imshow', 'TIFFfile']
+__all__ = ['imsave', 'imread', 'imshow', 'TIFFfile', 'TiffWriter']
 
 
 def imsave(filename, data, photometric=None, planarconfig=None,
@@ -381,6 +383,195 @@ def imsave(filename, data, photometric=None, planarconfig=None,
     fd.close()
 
 
+class TiffWriter(object):
+    """Write image pages to a TIFF file one at a time.
+
+    The file is opened once, and the data of each page is appended to it as
+    soon as it is saved, so the pages never need to be in memory at the same
+    time. Only the position, shape and type of each page are kept. The IFDs
+    of all pages are written after the data when the file is closed, in the
+    standard TIFF format, or in BigTIFF format if the file would pass the 4 GB
+    that standard TIFF offsets can address.
+
+    Pages are written uncompressed in one strip each, one after the other, so
+    that TIFFfile.asarray(memmap=True) can map the file.
+
+    TiffWriter instances must be closed using the close method, which is
+    automatically called when used in a 'with' statement.
+
+    Examples
+    --------
+    >>> with TiffWriter('temp.tif') as tif:
+    ...     for i in range(10):
+    ...         tif.save(numpy.random.rand(301, 219))
+
+    """
+    TAGS = {'new_subfile_type': 254, 'image_width': 256,
+            'image_length': 257, 'bits_per_sample': 258, 'compression': 259,
+            'photometric': 262, 'strip_offsets': 273,
+            'samples_per_pixel': 277, 'rows_per_strip': 278,
+            'strip_byte_counts': 279, 'software': 305, 'datetime': 306,
+            'sample_format': 339}
+    TYPES = {'B': 1, 's': 2, 'H': 3, 'I': 4, 'Q': 16}
+    CLASSIC_LIMIT = 2**32  # file size standard TIFF offsets can address
+
+    def __init__(self, filename, bigtiff=None, byteorder=None,
+                 software='tifffile.py'):
+        """Open file for writing.
+
+        Parameters
+        ----------
+        filename : str
+            Name of file to write.
+        bigtiff : bool
+            If True the BigTIFF format is used, if False the standard TIFF
+            format (and close fails if the file gets too large for it).
+            By default BigTIFF is used only if needed.
+        byteorder : {'<', '>'}
+            The endianness of the data in the file.
+            By default this is the system's native byte order.
+        software : str
+            Name of the software used to create the image.
+            Saved with the first page only.
+
+        """
+        assert(byteorder in (None, '<', '>'))
+        if byteorder is None:
+            byteorder = '<' if sys.byteorder == 'little' else '>'
+        self.byteorder = byteorder
+        self.bigtiff = bigtiff
+        self.software = software
+        self.pages = []  # (offset, shape, dtype) of each page
+        self._fd = open(filename, 'wb')
+        # room for either header, the data start behind it
+        self._fd.write(b'\0' * 16)
+
+    def save(self, data):
+        """Append image data to file.
+
+        data : array_like
+            A single page (height, width) or a sequence of pages
+            (pages, height, width).
+
+        """
+        data = numpy.asarray(data)
+        if data.ndim == 2:
+            data = data[numpy.newaxis]
+        if data.ndim != 3:
+            raise ValueError("data must be a page or a sequence of pages")
+        dtype = numpy.dtype(self.byteorder + data.dtype.char)
+        for page in data:
+            page = numpy.asarray(page, dtype=dtype, order='C')
+            self.pages.append((self._fd.tell(), page.shape, dtype))
+            page.tofile(self._fd)
+
+    def close(self):
+        """Write the IFDs of all pages and close the file."""
+        if self._fd is None:
+            return
+        fd = self._fd
+        fd.seek(0, 2)
+        if fd.tell() % 2:
+            fd.write(b'\0')  # IFDs start on a word boundary
+        first_ifd = fd.tell()
+
+        bigtiff = self.bigtiff
+        if bigtiff is None:
+            ifds_size = sum(len(self._ifd(i, 0, False)) for i in
+                            range(len(self.pages)))
+            bigtiff = first_ifd + ifds_size >= self.CLASSIC_LIMIT
+
+        offset = first_ifd
+        for i in range(len(self.pages)):
+            ifd = self._ifd(i, offset, bigtiff)
+            fd.write(ifd)
+            offset += len(ifd)
+        if not bigtiff and offset >= self.CLASSIC_LIMIT:
+            raise ValueError("file too large for standard TIFF")
+
+        fd.seek(0)
+        fd.write({'<': b'II', '>': b'MM'}[self.byteorder])
+        if bigtiff:
+            fd.write(self._pack('HHHQ', 43, 8, 0,
+                                first_ifd if self.pages else 0))
+        else:
+            fd.write(self._pack('HI', 42, first_ifd if self.pages else 0))
+        fd.close()
+        self._fd = None
+
+    def _pack(self, fmt, *values):
+        return struct.pack(self.byteorder + fmt, *values)
+
+    def _ifd(self, index, offset, bigtiff):
+        """Return the IFD of page index as written at offset in file."""
+        data_offset, shape, dtype = self.pages[index]
+        offset_format = 'Q' if bigtiff else 'I'
+        offset_size = 8 if bigtiff else 4
+        tags = [('new_subfile_type', 'I', 0 if len(self.pages) == 1 else 2),
+                ('image_width', 'I', shape[1]),
+                ('image_length', 'I', shape[0]),
+                ('bits_per_sample', 'H', dtype.itemsize * 8),
+                ('compression', 'H', 1),
+                ('photometric', 'H', 1),
+                ('strip_offsets', offset_format, data_offset),
+                ('samples_per_pixel', 'H', 1),
+                ('rows_per_strip', 'I', shape[0]),
+                ('strip_byte_counts', offset_format,
+                 shape[0] * shape[1] * dtype.itemsize),
+                ('sample_format', 'H',
+                 {'u': 1, 'i': 2, 'f': 3, 'c': 6}[dtype.kind])]
+        if index == 0:
+            if self.software:
+                tags.append(('software', 's', self.software))
+            tags.append(('datetime', 's', datetime.datetime.now().strftime(
+                "%Y:%m:%d %H:%M:%S")))
+        tags.sort(key=lambda tag: self.TAGS[tag[0]])
+
+        if bigtiff:
+            head = self._pack('Q', len(tags))
+            entry_size = 20
+        else:
+            head = self._pack('H', len(tags))
+            entry_size = 12
+        # tag values that don't fit into an entry follow the IFD
+        extra_offset = offset + len(head) + entry_size * len(tags) + \
+            offset_size
+        entries = []
+        extra = []
+        for name, dtype_code, value in tags:
+            if dtype_code == 's':
+                value = (value if isinstance(value, bytes)
+                         else value.encode('ascii')) + b'\0'
+                count = len(value)
+            else:
+                count = 1
+                value = self._pack(dtype_code, value)
+            entry = self._pack('HH', self.TAGS[name], self.TYPES[dtype_code])
+            entry += self._pack(offset_format, count)
+            if len(value) <= offset_size:
+                entry += value + b'\0' * (offset_size - len(value))
+            else:
+                entry += self._pack(offset_format, extra_offset)
+                if len(value) % 2:
+                    value += b'\0'
+                extra.append(value)
+                extra_offset += len(value)
+            entries.append(entry)
+
+        if index == len(self.pages) - 1:
+            next_ifd = 0
+        else:
+            next_ifd = extra_offset
+        return (head + b''.join(entries) +
+                self._pack(offset_format, next_ifd) + b''.join(extra))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def imread(filename, *args, **kwargs):
     """Return image data from TIFF file as numpy array.
 
@@ -424,8 +615,8 @@ class TIFFfile(object):
 
     Attributes
     ----------
-    pages : list
-        All TIFFpages in file.
+    pages : TIFFpages
+        All TIFFpages in file, read on first access.
     series : list of Records(shape, dtype, axes, TIFFpages)
         TIFF pages with compatible shapes and types.
 
@@ -451,6 +642,7 @@ class TIFFfile(object):
         self._tiffs = {self.fname: self}  # cache of TIFFfiles
         self.offset_size = None
         self.pages = []
+        self._lock = threading.Lock()  # serializes reads of page data
         try:
             self._fromfile()
         except Exception:
@@ -483,16 +675,45 @@ class TIFFfile(object):
             self.offset_size = 4
         else:
             raise ValueError("not a TIFF file")
-        self.pages = []
-        while True:
-            try:
-                page = TIFFpage(self)
-                self.pages.append(page)
-            except StopIteration:
-                break
+        self.pages = TIFFpages(self, self._ifd_offsets())
         if not self.pages:
             raise ValueError("empty TIFF file")
 
+    def _ifd_offsets(self):
+        """Return file offsets of all IFDs.
+
+        Only the number of tags and the offset to the next IFD are read.
+        File cursor must be at storage position of first IFD offset.
+
+        """
+        fd = self._fd
+        byte_order = self.byte_order
+        offset_size = self.offset_size
+        offset_fmt = byte_order + {4: 'I', 8: 'Q'}[offset_size]
+        numtags_fmt, numtags_size = {4: ('H', 2), 8: ('Q', 8)}[offset_size]
+        numtags_fmt = byte_order + numtags_fmt
+        tag_size = {4: 12, 8: 20}[offset_size]
+        fsize = self.fstat[6]
+
+        offsets = []
+        seen = set()
+        offset = struct.unpack(offset_fmt, fd.read(offset_size))[0]
+        while offset:
+            if offset in seen or offset + numtags_size > fsize:
+                warnings.warn("corrupted page list")
+                break
+            seen.add(offset)
+            fd.seek(offset)
+            numtags = struct.unpack(numtags_fmt, fd.read(numtags_size))[0]
+            fd.seek(offset + numtags_size + numtags*tag_size)
+            data = fd.read(offset_size)
+            if len(data) != offset_size:
+                warnings.warn("corrupted page list")
+                break
+            offsets.append(offset)
+            offset = struct.unpack(offset_fmt, data)[0]
+        return offsets
+
     @lazyattr
     def series(self):
         """Return series of TIFFpage with compatible shape and properties."""
@@ -560,7 +781,7 @@ class TIFFfile(object):
                       for s in shapes]
         return series
 
-    def asarray(self, key=None, series=None):
+    def asarray(self, key=None, series=None, memmap=False, workers=1):
         """Return image data of multiple TIFF pages as numpy array.
 
         By default the first image series is returned.
@@ -571,6 +792,15 @@ class TIFFfile(object):
             Defines which pages to return as array.
         series : int
             Defines which series of pages to return as array.
+        memmap : bool
+            If True return a read-only view of the memory-mapped file instead
+            of decoding the pages, if the image data are uncompressed and
+            evenly spaced in the file (see _memmap_pages). Else the pages are
+            decoded as if memmap was False.
+        workers : int
+            Number of threads decoding pages in parallel into one
+            preallocated array (see _decode_pages). Reading from the file is
+            serialized, decompression and unpacking run in parallel.
 
         """
         if key is None and series is None:
@@ -591,6 +821,15 @@ class TIFFfile(object):
         else:
             raise TypeError('key must be an int, slice, or sequence')
 
+        if memmap:
+            result = self._memmap_pages(pages)
+            if result is not None:
+                if len(pages) == 1:
+                    return result[0]
+                if key is not None or (tuple(self.series[series].shape) ==
+                                       result.shape):
+                    return result
+
         if len(pages) == 1:
             return pages[0].asarray()
         elif self.is_nih:
@@ -604,8 +843,11 @@ class TIFFfile(object):
                 firstpage = next(p for p in pages if p)
                 nopage = numpy.zeros_like(
                     firstpage.asarray())
-            result = numpy.vstack((p.asarray() if p else nopage)
-                                  for p in pages)
+            if workers > 1 and all(pages):
+                result = self._decode_pages(pages, workers)
+            else:
+                result = numpy.vstack((p.asarray() if p else nopage)
+                                      for p in pages)
         if key is None:
             try:
                 result.shape = self.series[series].shape
@@ -617,6 +859,68 @@ class TIFFfile(object):
             result.shape = (-1,) + pages[0].shape
         return result
 
+    def _decode_pages(self, pages, workers):
+        """Return image data of pages, decoded by a pool of threads.
+
+        The first page is decoded to allocate the result, an array of shape
+        (len(pages),) + page shape. The other pages are decoded into it by
+        workers threads. zlib and most of the NumPy code of the decoders
+        release the GIL. Pages of different shapes are stacked as without
+        workers.
+
+        """
+        first = pages[0].asarray()
+        if any(p.shape != pages[0].shape for p in pages):
+            return numpy.vstack([first] + [p.asarray() for p in pages[1:]])
+        result = numpy.empty((len(pages), ) + first.shape, first.dtype)
+        result[0] = first
+
+        def decode(index):
+            result[index] = pages[index].asarray()
+
+        pool = ThreadPool(workers)
+        try:
+            pool.map(decode, range(1, len(pages)))
+        finally:
+            pool.close()
+            pool.join()
+        return result
+
+    def _memmap_pages(self, pages):
+        """Return read-only memory-mapped array of the image data in pages.
+
+        The array has the shape (len(pages),) + page shape and is a view of
+        the file, nothing is read until it is accessed. Return None if the
+        pages can not be mapped as one array: all pages must be memmappable
+        (see TIFFpage.memmap_offset), of the same shape and data type, and
+        evenly spaced in the file, e.g. with an IFD before each page as
+        written by imsave.
+
+        """
+        if not pages or any(p is None for p in pages):
+            return None
+        page = pages[0]
+        offsets = [p.memmap_offset for p in pages]
+        if None in offsets:
+            return None
+        if any(p.shape != page.shape or p._dtype != page._dtype
+               for p in pages):
+            return None
+        dtype = numpy.dtype(self.byte_order + page._dtype)
+        size = int(numpy.prod(page.shape)) * dtype.itemsize
+        stride = offsets[1] - offsets[0] if len(pages) > 1 else size
+        if stride < size or any(offsets[i+1] - offsets[i] != stride
+                                for i in range(len(offsets)-1)):
+            return None
+        mapped = numpy.memmap(os.path.join(self.fpath, self.fname),
+                              dtype=numpy.uint8, mode='r', offset=offsets[0],
+                              shape=(stride * (len(pages)-1) + size, ))
+        strides = [dtype.itemsize]
+        for i in reversed(page.shape[1:]):
+            strides.insert(0, strides[0] * i)
+        return numpy.ndarray((len(pages), ) + page.shape, dtype, mapped,
+                             strides=(stride, ) + tuple(strides))
+
     def _omeseries(self):
         """Return image series in OME-TIFF files."""
         root = ElementTree.XML(self.pages[0].tags['image_description'].value)
@@ -779,6 +1083,98 @@ class TIFFfile(object):
         return self.pages[0].is_ome
 
 
+class TIFFpages(object):
+    """Sequence of the TIFFpages in a file, read on first access.
+
+    Only the IFD offsets are read when the file is opened. The tags of a page
+    are read when the page is first accessed. Pages, whose IFDs differ only
+    in the location of their image data (strip and tile offsets and byte
+    counts), share all other tags and attributes with the first of them.
+    Uniform stacks thus parse their tags only once.
+
+    """
+    # strip_offsets, strip_byte_counts, tile_offsets, tile_byte_counts
+    DATA_TAGS = (273, 279, 324, 325)
+
+    def __init__(self, parent, offsets):
+        """Initialize instance from IFD offsets."""
+        self.parent = parent
+        self.offsets = offsets
+        self._pages = [None] * len(offsets)
+        self._templates = {}
+
+    def __len__(self):
+        """Return number of pages."""
+        return len(self.offsets)
+
+    def __getitem__(self, key):
+        """Return specified page(s)."""
+        if isinstance(key, slice):
+            return [self._getpage(i) for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("page index out of range")
+        return self._getpage(key)
+
+    def __iter__(self):
+        """Return iterator over pages."""
+        for index in range(len(self)):
+            yield self._getpage(index)
+
+    def _getpage(self, index):
+        """Return page, read it from file if necessary."""
+        page = self._pages[index]
+        if page is None:
+            page = self._pages[index] = self._readpage(index)
+        return page
+
+    def _readpage(self, index):
+        """Read page from file, copy a template page if the IFD matches."""
+        parent = self.parent
+        fd = parent._fd
+        byte_order = parent.byte_order
+        offset_size = parent.offset_size
+        numtags_fmt, numtags_size = {4: ('H', 2), 8: ('Q', 8)}[offset_size]
+        tag_size = {4: 12, 8: 20}[offset_size]
+
+        offset = self.offsets[index]
+        fd.seek(offset)
+        numtags = struct.unpack(byte_order + numtags_fmt,
+                                fd.read(numtags_size))[0]
+        data = fd.read(numtags * tag_size)
+
+        # signature of IFD without the data location values
+        signature = []
+        data_tags = []
+        for i in range(numtags):
+            entry = data[i*tag_size:(i+1)*tag_size]
+            if struct.unpack(byte_order + 'H', entry[:2])[0] in self.DATA_TAGS:
+                entry = entry[:-offset_size]
+                data_tags.append(offset + numtags_size + i*tag_size)
+            signature.append(entry)
+        signature = b''.join(signature)
+
+        template = self._templates.get(signature)
+        if template is None:
+            page = TIFFpage(parent, offset=offset, index=index)
+            self._templates[signature] = page
+            return page
+
+        page = TIFFpage.__new__(TIFFpage)
+        page.__dict__.update(template.__dict__)
+        page.index = index
+        page.tags = TiffTags(template.tags)
+        for name in ('memmap_offset', 'strip_offsets', 'strip_byte_counts',
+                     'tile_offsets', 'tile_byte_counts'):
+            page.__dict__.pop(name, None)
+        for pos in data_tags:
+            fd.seek(pos)
+            tag = TIFFtag(parent)
+            page.tags[tag.name] = tag
+        return page
+
+
 class TIFFpage(object):
     """A TIFF image file directory (IFD).
 
@@ -810,23 +1206,27 @@ class TIFFpage(object):
     All attributes are read-only.
 
     """
-    def __init__(self, parent):
-        """Initialize instance from file."""
+    def __init__(self, parent, offset=None, index=None):
+        """Initialize instance from file.
+
+        If offset is None, the IFD offset is read at the file cursor.
+
+        """
         self.parent = parent
-        self.index = len(parent.pages)
+        self.index = len(parent.pages) if index is None else index
         self.shape = self._shape = ()
         self.dtype = self._dtype = None
         self.axes = ""
         self.tags = TiffTags()
 
-        self._fromfile()
+        self._fromfile(offset)
         self._process_tags()
 
-    def _fromfile(self):
+    def _fromfile(self, offset=None):
         """Read TIFF IFD structure and its tags from file.
 
-        File cursor must be at storage position of IFD offset and is left at
-        offset to next IFD.
+        If offset is None, file cursor must be at storage position of IFD
+        offset. File cursor is left at offset to next IFD.
 
         Raises StopIteration if offset (first bytes read) is 0.
 
@@ -835,8 +1235,9 @@ class TIFFpage(object):
         byte_order = self.parent.byte_order
         offset_size = self.parent.offset_size
 
-        fmt = {4: 'I', 8: 'Q'}[offset_size]
-        offset = struct.unpack(byte_order + fmt, fd.read(offset_size))[0]
+        if offset is None:
+            fmt = {4: 'I', 8: 'Q'}[offset_size]
+            offset = struct.unpack(byte_order + fmt, fd.read(offset_size))[0]
         if not offset:
             raise StopIteration()
 
@@ -1070,8 +1471,9 @@ class TIFFpage(object):
             and all(offsets[i] == offsets[i+1] - byte_counts[i]
                     for i in range(len(offsets)-1))))):
             # contiguous data
-            fd.seek(offsets[0], 0)
-            result = numpy.fromfile(fd, typecode, numpy.prod(shape))
+            with self.parent._lock:
+                fd.seek(offsets[0], 0)
+                result = numpy.fromfile(fd, typecode, numpy.prod(shape))
             result = result.astype('=' + dtype)
         else:
             if self.planar_configuration == 'contig':
@@ -1090,8 +1492,10 @@ class TIFFpage(object):
                 result = numpy.empty(shape, dtype)
                 tw, tl, pl = 0, 0, 0
                 for offset, bytecount in zip(offsets, byte_counts):
-                    fd.seek(offset, 0)
-                    tile = unpack(decompress(fd.read(bytecount)))
+                    with self.parent._lock:
+                        fd.seek(offset, 0)
+                        data = fd.read(bytecount)
+                    tile = unpack(decompress(data))
                     tile.shape = tile_shape
                     result[0, pl, tl:tl+tile_length,
                            tw:tw+tile_width, :] = tile
@@ -1106,8 +1510,10 @@ class TIFFpage(object):
                 result = numpy.empty(shape, dtype).reshape(-1)
                 index = 0
                 for offset, bytecount in zip(offsets, byte_counts):
-                    fd.seek(offset, 0)
-                    stripe = unpack(decompress(fd.read(bytecount)))
+                    with self.parent._lock:
+                        fd.seek(offset, 0)
+                        data = fd.read(bytecount)
+                    stripe = unpack(decompress(data))
                     size = min(result.size, stripe.size)
                     result[index:index+size] = stripe[:size]
                     del stripe
@@ -1150,6 +1556,36 @@ class TIFFpage(object):
 
         return result
 
+    @lazyattr
+    def memmap_offset(self):
+        """Return offset of the image data in file if they can be memory-mapped.
+
+        Return None if the data are compressed, tiled, not contiguous, need
+        processing after reading (predictor, color map, extra samples), or if
+        the sample size is not 8, 16, 32, or 64 bits.
+
+        """
+        if (self.compression or self.is_tiled or self.is_stk or
+            self.is_palette or self.dtype is None or
+            self.bits_per_sample not in (8, 16, 32, 64) or
+            self.predictor == 'horizontal' or
+            (self.is_rgb and 'extra_samples' in self.tags)):
+            return None
+        offsets = self.strip_offsets
+        byte_counts = self.strip_byte_counts
+        try:
+            offsets[0]
+        except TypeError:
+            offsets = (offsets, )
+            byte_counts = (byte_counts, )
+        if any(offsets[i] + byte_counts[i] != offsets[i+1]
+               for i in range(len(offsets)-1)):
+            return None
+        if (sum(byte_counts) <
+                numpy.prod(self.shape) * (self.bits_per_sample // 8)):
+            return None
+        return offsets[0]
+
     def __str__(self):
         """Return string containing information about page."""
         s = ', '.join(s for s in (
@@ -1537,23 +1973,93 @@ def decodepackbits(encoded):
 
     PackBits is a simple byte-oriented run-length compression scheme.
 
+    The loop runs over the packets, each literal or repeated run is copied
+    as a whole.
+
     """
-    func = ord if sys.version[0] == '2' else lambda x: x
-    result = []
+    data = bytearray(encoded)
+    size = len(data)
+    result = bytearray()
     i = 0
-    try:
-        while True:
-            n = func(encoded[i]) + 1
+    while i < size:
+        n = data[i]
+        i += 1
+        if n < 128:
+            result += data[i:i+n+1]
+            i += n + 1
+        elif n > 128:
+            result += data[i:i+1] * (257-n)
             i += 1
-            if n < 129:
-                result.extend(encoded[i:i+n])
-                i += n
-            elif n > 129:
-                result.extend(encoded[i:i+1] * (258-n))
-                i += 1
-    except IndexError:
-        pass
-    return b''.join(result) if sys.version[0] == '2' else bytes(result)
+    return bytes(result)
+
+
+def _decodelzw_codes(codes):
+    """Return byte string of LZW codes between two CLEAR codes (numpy array).
+
+    The table is not built code by code. Code j >= 258 refers to the table
+    entry added at code j-257, i.e. to the string of code k = j-258 plus the
+    first byte of the string of code k+1. The first bytes and the lengths of
+    all strings, and then all bytes of the output are resolved along these
+    references with numpy, by pointer jumping. Only for long strings (highly
+    compressed data), the table is built code by code.
+
+    """
+    n = len(codes)
+    if not n:
+        return b''
+    index = numpy.arange(n)
+    codes = codes.astype(numpy.intp)
+    root = codes < 256
+    if codes[0] >= 256 or numpy.any(codes[1:] >= index[1:] + 258):
+        raise ValueError("corrupted LZW strip")
+    parent = numpy.where(root, index, codes - 258)
+
+    # first byte and length of the string of each code
+    depth = (~root).astype(numpy.intp)
+    pointer = parent
+    while numpy.any(~root[pointer]):
+        depth = depth + depth[pointer]
+        pointer = pointer[pointer]
+    first = codes[pointer]
+    length = depth + 1
+
+    if length.sum() > 32 * n:
+        # few codes for long strings: building the table is faster
+        if sys.version[0] == '2':
+            table = [chr(i) for i in range(256)]
+        else:
+            table = [bytes([i]) for i in range(256)]
+        table.extend((0, 0))
+        codes = codes.tolist()
+        oldcode = codes[0]
+        result = [table[oldcode]]
+        for code in codes[1:]:
+            if code < len(table):
+                decoded = table[code]
+                table.append(table[oldcode] + decoded[:1])
+            else:
+                decoded = table[oldcode] + table[oldcode][:1]
+                table.append(decoded)
+            result.append(decoded)
+            oldcode = code
+        return b''.join(result)
+
+    # the last byte of each string is known, the other bytes are copies of
+    # the string of the parent code, which was decoded before. Each byte
+    # points to the byte it is a copy of, until a known byte is reached.
+    last = numpy.where(root, codes, first[numpy.minimum(parent + 1, n - 1)])
+    start = numpy.cumsum(length) - length
+    code = numpy.repeat(index, length)
+    offset = numpy.arange(len(code)) - start[code]
+    known = offset == length[code] - 1
+    source = numpy.where(known, numpy.arange(len(code)),
+                         start[parent[code]] + offset)
+    while True:
+        next_source = source[source]
+        if numpy.array_equal(next_source, source):
+            break
+        source = next_source
+    return last[code[source]].astype(numpy.uint8).tostring()
 
 
 @_replace_by('_tifffile.decodelzw')
@@ -1565,74 +2071,67 @@ def decodelzw(encoded):
     This is an implementation of the LZW decoding algorithm described in (1).
     It is not compatible with old style LZW compressed files like quad-lzw.tif.
 
-    """
-    unpack = struct.unpack
-
-    if sys.version[0] == '2':
-        newtable = [chr(i) for i in range(256)]
-    else:
-        newtable = [bytes([i]) for i in range(256)]
-    newtable.extend((0, 0))
-
-    def next_code():
-        """Return integer of `bitw` bits at `bitcount` position in encoded."""
-        start = bitcount // 8
-        s = encoded[start:start+4]
-        try:
-            code = unpack('>I', s)[0]
-        except Exception:
-            code = unpack('>I', s + b'\x00'*(4-len(s)))[0]
-        code = code << (bitcount % 8)
-        code = code & mask
-        return code >> shr
-
-    switchbitch = {  # code: bit-width, shr-bits, bit-mask
-        255: (9, 23, int(9*'1'+'0'*23, 2)),
-        511: (10, 22, int(10*'1'+'0'*22, 2)),
-        1023: (11, 21, int(11*'1'+'0'*21, 2)),
-        2047: (12, 20, int(12*'1'+'0'*20, 2)), }
-    bitw, shr, mask = switchbitch[255]
-    bitcount = 0
+    The codes are unpacked from the bit stream with numpy, in runs of codes
+    of the same bit width, and decoded with numpy between CLEAR codes (see
+    _decodelzw_codes).
 
+    """
     if len(encoded) < 4:
         raise ValueError("strip must be at least 4 characters long")
 
-    if next_code() != 256:
+    # 3 padding bytes, so that each code can be read from 3 bytes
+    data = numpy.frombuffer(encoded + b'\x00' * 3, numpy.uint8)
+    data = data.astype(numpy.int32)
+    bitsize = len(encoded) * 8
+
+    def unpack_codes(bitcount, bitw, count):
+        """Return array of count integers of bitw bits from bitcount on."""
+        position = bitcount + bitw * numpy.arange(count)
+        index = position >> 3
+        value = (data[index] << 16) | (data[index+1] << 8) | data[index+2]
+        value >>= 24 - bitw - (position & 7)
+        return value & ((1 << bitw) - 1)
+
+    if unpack_codes(0, 9, 1)[0] != 256:
         raise ValueError("strip must begin with CLEAR code")
 
-    code = oldcode = 0
     result = []
-    while True:
-        code = next_code()  # ~5% faster when inlining this function
-        bitcount += bitw
-        if code == 257:  # EOI
-            break
-        if code == 256:  # CLEAR
-            table = newtable[:]
-            lentable = 258
-            bitw, shr, mask = switchbitch[255]
-            code = next_code()
-            bitcount += bitw
-            if code == 257:  # EOI
-                break
-            result.append(table[code])
+    segment = []  # runs of codes since the last CLEAR
+    ncodes = 0  # number of codes since the last CLEAR
+    bitcount = 0
+    code = 0
+    while code != 257:
+        # the code width grows with the table, which grows by one entry per
+        # code except for CLEAR and the first code after it
+        lentable = 258 + max(0, ncodes - 1)
+        if lentable < 511:
+            bitw, limit = 9, 511
+        elif lentable < 1023:
+            bitw, limit = 10, 1023
+        elif lentable < 2047:
+            bitw, limit = 11, 2047
         else:
-            if code < lentable:
-                decoded = table[code]
-                newcode = table[oldcode] + decoded[:1]
-            else:
-                newcode = table[oldcode]
-                newcode += newcode[:1]
-                decoded = newcode
-            result.append(decoded)
-            table.append(newcode)
-            lentable += 1
-        oldcode = code
-        if lentable in switchbitch:
-            bitw, shr, mask = switchbitch[lentable]
-
-    if code != 257:
-        raise ValueError("unexpected end of stream (code %i)" % code)
+            bitw, limit = 12, lentable + 4096
+        count = limit - lentable + (1 if ncodes == 0 else 0)
+        count = min(count, (bitsize - bitcount) // bitw)
+        if count < 1:
+            raise ValueError("unexpected end of stream (code %i)" % code)
+
+        codes = unpack_codes(bitcount, bitw, count)
+        special = numpy.flatnonzero((codes == 256) | (codes == 257))
+        if not len(special):
+            segment.append(codes)
+            ncodes += count
+            bitcount += bitw * count
+            continue
+        i = special[0]
+        code = codes[i]
+        segment.append(codes[:i])
+        bitcount += bitw * (i + 1)
+        # CLEAR or EOI: the table starts over
+        result.append(_decodelzw_codes(numpy.concatenate(segment)))
+        segment = []
+        ncodes = 0
 
     return b''.join(result)
 
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Feb 12 09:47:15 2015
+
+@author: georg
+"""
+
+from __future__ import division
+
+"""
+SUMMARY: a persistent cache for per-frame registrations. Rerunning a trial
+(after a crash, or for a different output choice) then does not recompute the
+registrations, they are looked up.
+
+DETAILS: An entry is keyed by a hash of the moving frame, the fixed image, the
+contents of the parameter file (and of the initial transform, if any) and the
+name of the backend. It holds the resulting TransformParameters.0.txt, the
+final metric value (if the backend recorded one) and the registered frame (as
+.npy):
+
+    cache_path/ab/abcdef.../TransformParameters.0.txt
+    cache_path/ab/abcdef.../FinalMetricValue.txt
+    cache_path/ab/abcdef.../result.npy
+
+The cache is bounded in size, the least recently used entries are removed
+first. The last use is the modification time of the entry directory, which is
+updated on every hit, so this works across processes and runs. Each process
+scans the cache once for its size and then adds the entries it stores, the
+cache is only scanned again for eviction once that exceeds the bound. Entries
+stored by other processes in the meantime are seen by the next scan, so the
+cache can exceed the bound by them for a while. Entries are
+written to a temporary directory first and then renamed, so concurrent workers
+never see half written entries.
+
+Hits and misses are counted in the IO counter of IOtools (cache_hits,
+cache_misses), so they are summed over pool workers as the IO is.
+"""
+
+#==============================================================================
+# IMPORTS
+#==============================================================================
+import scipy as sp
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+import IOtools as io
+
+#==============================================================================
+### cache
+#==============================================================================
+
+# size in bytes of each cache (by path) as seen by this process: of its last
+# scan plus the entries stored since. Kept per process, not per TransformCache,
+# as the backends (and their caches) are pickled into each frame job
+sizes = {}
+
+# an eviction removes entries until the cache is below this fraction of its
+# bound, so that the following stores don't scan it again right away
+evict_fraction = 0.9
+
+class TransformCache(object):
+    """ content addressed cache of TransformParameters and registered frames,
+    located at path and bounded to max_bytes """
+
+    def __init__(self, path, max_bytes=10*2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+
+    def key(self, img, ref_img, parameter_filepath, backend_name='', initial_transform=None):
+        """ hash of everything that determines the result of a registration """
+        h = hashlib.sha1()
+        for arr in [img, ref_img]:
+            arr = sp.ascontiguousarray(arr)
+            h.update(str(arr.dtype) + str(arr.shape))
+            h.update(arr.data)
+        h.update(open(parameter_filepath,'rb').read())
+        h.update(backend_name)
+        if initial_transform is not None:
+            h.update(open(initial_transform,'rb').read())
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path,key[:2],key)
+
+    def lookup(self, key, outpath):
+        """ on a hit, copies the TransformParameters.0.txt and the final
+        metric value into outpath and returns the registered frame. Returns None
+        on a miss """
+        entry = self.entry_path(key)
+        try:
+            output = sp.load(os.path.join(entry,'result.npy'))
+            shutil.copy(os.path.join(entry,'TransformParameters.0.txt'),outpath)
+            if os.path.exists(os.path.join(entry,'FinalMetricValue.txt')):
+                shutil.copy(os.path.join(entry,'FinalMetricValue.txt'),outpath)
+            elif os.path.exists(os.path.join(outpath,'FinalMetricValue.txt')):
+                os.remove(os.path.join(outpath,'FinalMetricValue.txt'))
+            os.utime(entry,None) # most recently used
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            io.count_io(cache_misses=1)
+            return None
+        self.hits += 1
+        io.count_io(cache_hits=1)
+        return output
+
+    def store(self, key, outpath, output):
+        """ adds the TransformParameters.0.txt and the final metric value of
+        outpath and the registered frame output to the cache """
+        entry = self.entry_path(key)
+        if os.path.exists(entry):
+            return
+        try:
+            os.makedirs(os.path.dirname(entry))
+        except OSError:
+            pass
+        tmp_entry = tempfile.mkdtemp(prefix='.tmp_',dir=os.path.dirname(entry))
+        shutil.copy(os.path.join(outpath,'TransformParameters.0.txt'),tmp_entry)
+        if os.path.exists(os.path.join(outpath,'FinalMetricValue.txt')):
+            shutil.copy(os.path.join(outpath,'FinalMetricValue.txt'),tmp_entry)
+        sp.save(os.path.join(tmp_entry,'result.npy'),output)
+        size = sum([os.path.getsize(os.path.join(tmp_entry,f)) for f in os.listdir(tmp_entry)])
+        try:
+            os.rename(tmp_entry,entry)
+        except OSError: # stored by another worker in the meantime
+            shutil.rmtree(tmp_entry,ignore_errors=True)
+            return
+        path = os.path.abspath(self.path)
+        if path not in sizes:
+            sizes[path] = sum([e[1] for e in self.entries()]) # incl. the new entry
+        else:
+            sizes[path] += size
+        if sizes[path] > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """ list of (last use, size in bytes, path) of all entries """
+        entries = []
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path,prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for name in os.listdir(prefix_path):
+                if name.startswith('.tmp_'):
+                    continue
+                entry = os.path.join(prefix_path,name)
+                try:
+                    size = sum([os.path.getsize(os.path.join(entry,f)) for f in os.listdir(entry)])
+                    entries.append((os.path.getmtime(entry),size,entry))
+                except OSError: # evicted by another worker
+                    pass
+        return entries
+
+    def evict(self):
+        """ removes the least recently used entries if the cache is larger than
+        max_bytes, until it is smaller than evict_fraction of it """
+        entries = sorted(self.entries())
+        total = sum([size for last_use, size, entry in entries])
+        if total > self.max_bytes:
+            for last_use, size, entry in entries:
+                if total <= evict_fraction * self.max_bytes:
+                    break
+                shutil.rmtree(entry,ignore_errors=True)
+                total -= size
+        sizes[os.path.abspath(self.path)] = total
+
+    def __str__(self):
+        entries = self.entries()
+        return "transform cache %s: %i entries, %.1f MB, %i hits, %i misses" % (
+            self.path, len(entries), sum([e[1] for e in entries]) / 2.0**20, self.hits, self.misses)
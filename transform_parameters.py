@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Mar 10 14:21:07 2015
+
+@author: georg
+"""
+
+from __future__ import division
+
+"""
+SUMMARY: elastix TransformParameters files as python objects. The transforms
+of a run can be evaluated, warped with and compared in-process, without going
+through transformix, and the transforms of all frames of a run can be loaded
+into one array.
+
+DETAILS: read() parses a TransformParameters.*.txt into one of
+
+    TranslationTransform: parameters (tx,ty)
+    AffineTransform: parameters (a11 a12 a21 a22 tx ty), center
+    BSplineTransform: coefficients (2,gx,gy), the displacements of the control
+        points of the grid (GridSize, GridSpacing, GridOrigin, GridDirection)
+
+The initial transform of a file (InitialTransformParametersFileName, e.g. of
+elastix -t0) is parsed as well and kept as .initial, so a transform is the
+whole chain. It is combined as HowToCombineTransforms says: Compose applies
+the initial transform to a point first, Add adds the displacements of both.
+
+As everywhere in this package, images are indexed (x,y) and pixel spacing is
+1, so a pixel index is the elastix physical point. Points are (2,n) arrays.
+
+For each transform:
+    transform_points(points): where the points of the fixed image are in the
+        moving image
+    displacement_field(shape): the (2,x,y) displacement of each pixel
+    warp(img): the moving image img resampled onto the fixed image, as
+        transformix does
+    affine_matrix(): the 2x3 matrix of the whole chain (see
+        native_registration.affine_matrix), None if it is not affine
+    to_dict(): the entries for IOtools.write_transform_parameters
+
+Bulk loading: load_matrices and load_coefficients stack the transforms of many
+files (e.g. frame_paths of a stage of a run) into one array, load_run picks the
+one that fits the run. The (n,2,3) matrices of load_matrices can be applied to
+a stack with native_registration.warp_tstack.
+"""
+
+#==============================================================================
+# IMPORTS
+#==============================================================================
+import scipy as sp
+import scipy.ndimage as ndimage
+import scipy.linalg
+
+import os
+import re
+import collections
+
+import IOtools as io
+import native_registration
+
+#==============================================================================
+### transforms
+#==============================================================================
+
+class Transform(object):
+    """ a transform of an elastix TransformParameters file, and its initial
+    transform. tp is the dict as read by IOtools.read_transform_parameters, its
+    entries are kept for to_dict """
+    name = None
+
+    def __init__(self, tp, initial=None):
+        self.tp = tp
+        self.parameters = sp.array(tp['TransformParameters'],dtype='float64')
+        self.initial = initial
+        self.combination = tp.get('HowToCombineTransforms',['Compose'])[0]
+
+    def map_points(self, points):
+        """ the mapping of this transform alone, without the initial one """
+        raise NotImplementedError
+
+    def transform_points(self, points):
+        """ maps the (2,n) points of the fixed image into the moving image """
+        if self.initial is None:
+            return self.map_points(points)
+        if self.combination == 'Compose':
+            return self.map_points(self.initial.transform_points(points))
+        return self.initial.transform_points(points) + self.map_points(points) - points
+
+    def displacement_field(self, shape):
+        """ the (2,x,y) displacement of each pixel of an image of shape """
+        points = grid_points(shape)
+        return (self.transform_points(points) - points).reshape((2,) + tuple(shape[:2]))
+
+    def warp(self, img, order=3):
+        """ resamples the moving image img onto the fixed image (of the same
+        shape), as transformix with FinalBSplineInterpolationOrder order.
+        Points mapped from outside of img are 0, as DefaultPixelValue 0 """
+        mapped = self.transform_points(grid_points(img.shape))
+        return ndimage.map_coordinates(img.astype('float64'),mapped,order=order,mode='constant',cval=0.0).reshape(img.shape)
+
+    def own_matrix(self):
+        """ the 2x3 matrix of this transform alone, None if it is not affine """
+        return None
+
+    def affine_matrix(self):
+        """ the 2x3 matrix of the whole chain, None if it is not affine """
+        M = self.own_matrix()
+        if M is None or self.initial is None:
+            return M
+        M_initial = self.initial.affine_matrix()
+        if M_initial is None or self.combination != 'Compose':
+            return None
+        return sp.hstack([sp.dot(M[:,:2],M_initial[:,:2]),(sp.dot(M[:,:2],M_initial[:,2]) + M[:,2])[:,sp.newaxis]])
+
+    def chain(self):
+        """ the transforms of the chain, the first applied first """
+        if self.initial is None:
+            return [self]
+        return self.initial.chain() + [self]
+
+    def to_dict(self):
+        tp = collections.OrderedDict(self.tp)
+        tp['TransformParameters'] = [float(p) for p in self.parameters]
+        return tp
+
+
+class TranslationTransform(Transform):
+    name = 'TranslationTransform'
+
+    def own_matrix(self):
+        return sp.hstack([sp.eye(2),self.parameters[:,sp.newaxis]])
+
+    def map_points(self, points):
+        return points + self.parameters[:,sp.newaxis]
+
+
+class AffineTransform(Transform):
+    name = 'AffineTransform'
+
+    def __init__(self, tp, initial=None):
+        Transform.__init__(self, tp, initial)
+        self.center = sp.array(tp['CenterOfRotationPoint'],dtype='float64')
+
+    def own_matrix(self):
+        return native_registration.affine_matrix(self.parameters,self.center)
+
+    def map_points(self, points):
+        M = self.own_matrix()
+        return sp.dot(M[:,:2],points) + M[:,2][:,sp.newaxis]
+
+
+class BSplineTransform(Transform):
+    name = 'BSplineTransform'
+
+    def __init__(self, tp, initial=None):
+        Transform.__init__(self, tp, initial)
+        self.grid_size = tuple(int(n) for n in tp['GridSize'])
+        self.grid_spacing = sp.array(tp['GridSpacing'],dtype='float64')
+        self.grid_origin = sp.array(tp['GridOrigin'],dtype='float64')
+        self.grid_direction = sp.reshape(sp.array(tp.get('GridDirection',[1.0,0.0,0.0,1.0]),dtype='float64'),(2,2)).T # column major
+        self.order = int(tp.get('BSplineTransformSplineOrder',[3])[0])
+
+    @property
+    def coefficients(self):
+        """ (2,gx,gy) view of the parameters, the x and the y displacement of
+        each control point """
+        # elastix stores all x, then all y coefficients, x running fastest
+        return self.parameters.reshape((2,self.grid_size[1],self.grid_size[0])).swapaxes(1,2)
+
+    def map_points(self, points):
+        # continuous grid index of the points, the coefficients are those of a
+        # B-spline, so they are interpolated without prefilter
+        index = sp.dot(scipy.linalg.inv(self.grid_direction),points - self.grid_origin[:,sp.newaxis]) / self.grid_spacing[:,sp.newaxis]
+        coefficients = self.coefficients
+        displacement = sp.array([ndimage.map_coordinates(coefficients[d],index,order=self.order,prefilter=False,mode='nearest') for d in range(2)])
+        # as in elastix, points whose support reaches beyond the grid are not
+        # moved. Grids of elastix registrations cover the whole image
+        offset = (self.order - 1) // 2
+        valid = sp.logical_and(index >= offset,index < sp.array(self.grid_size)[:,sp.newaxis] - offset - 1).all(axis=0)
+        return points + displacement * valid
+
+
+models = dict([(model.name,model) for model in [TranslationTransform,AffineTransform,BSplineTransform]])
+
+#==============================================================================
+### reading
+#==============================================================================
+
+def grid_points(shape):
+    """ the (2,n) coordinates of all pixels of an image of shape """
+    x, y = sp.mgrid[0:shape[0],0:shape[1]]
+    return sp.vstack([x.ravel(),y.ravel()]).astype('float64')
+
+def read(path, cache=None):
+    """ parses the TransformParameters file at path, with its chain of initial
+    transforms. Raises ValueError for transforms other than translation, affine
+    and bspline. cache: a dict path: transform, for reading many files that
+    share initial transforms """
+    if cache is not None and path in cache:
+        return cache[path]
+    tp = io.read_transform_parameters(path)
+    name = tp['Transform'][0]
+    if name not in models:
+        raise ValueError("unsupported transform %s in %s" % (name,path))
+    initial_path = tp.get('InitialTransformParametersFileName',['NoInitialTransform'])[0]
+    initial = None if initial_path == 'NoInitialTransform' else read(initial_path,cache)
+    transform = models[name](tp,initial)
+    if cache is not None:
+        cache[path] = transform
+    return transform
+
+def interpolate(a, b, weight):
+    """ the transform between the transforms a and b at weight (0: a, 1: b),
+    by interpolating their parameters. Both have to be of the same kind, with
+    the same entries (e.g. the grid of a bspline) and initial transform """
+    if type(a) != type(b):
+        raise ValueError("can't interpolate a %s and a %s" % (a.name,b.name))
+    for key in set(a.tp.keys()) | set(b.tp.keys()):
+        if key != 'TransformParameters' and a.tp.get(key) != b.tp.get(key):
+            raise ValueError("can't interpolate transforms that differ in " + key)
+    transform = type(a)(a.tp,a.initial)
+    transform.parameters = (1 - weight) * a.parameters + weight * b.parameters
+    return transform
+
+#==============================================================================
+### bulk loading
+#==============================================================================
+
+def frame_paths(stage_dir, name='TransformParameters.0.txt'):
+    """ the paths of the TransformParameters of all frame_i_n folders in
+    stage_dir (e.g. .../elastix/exp_name/affine), in frame order """
+    frames = []
+    for folder in os.listdir(stage_dir):
+        match = re.match('frame_(\d+)_\d+$',folder)
+        if match and os.path.exists(os.path.join(stage_dir,folder,name)):
+            frames.append((int(match.group(1)),os.path.join(stage_dir,folder,name)))
+    return [path for frame, path in sorted(frames)]
+
+def load_matrices(paths):
+    """ the (n,2,3) array of the affine matrices of the transforms in paths
+    (translations and affine chains). Raises ValueError for others """
+    cache = {}
+    matrices = sp.zeros((len(paths),2,3))
+    for i, path in enumerate(paths):
+        M = read(path,cache).affine_matrix()
+        if M is None:
+            raise ValueError("not an affine transform: " + path)
+        matrices[i] = M
+    return matrices
+
+def load_coefficients(paths):
+    """ the (n,2,gx,gy) array of the coefficients of the bspline transforms in
+    paths, which need to have the same grid. Their initial transforms are not
+    included. Raises ValueError for others """
+    cache = {}
+    coefficients = None
+    for i, path in enumerate(paths):
+        transform = read(path,cache)
+        if not isinstance(transform,BSplineTransform):
+            raise ValueError("not a bspline transform: " + path)
+        if coefficients is None:
+            coefficients = sp.zeros((len(paths),) + transform.coefficients.shape)
+        if transform.coefficients.shape != coefficients.shape[1:]:
+            raise ValueError("the grid of %s differs from the others" % path)
+        coefficients[i] = transform.coefficients
+    return coefficients
+
+def load_run(stage_dir):
+    """ the transforms of all frames of a stage of a run (see frame_paths) as
+    one array: the (n,2,3) affine matrices for translation and affine stages,
+    the (n,2,gx,gy) coefficients for bspline stages """
+    paths = frame_paths(stage_dir)
+    if paths and isinstance(read(paths[0]),BSplineTransform):
+        return load_coefficients(paths)
+    return load_matrices(paths)
@@ -36,10 +36,19 @@ import scipy as sp
 import sys
 import time
 import os
+import Queue
+import shutil
+import hashlib
 import subprocess
+import itertools
+import traceback
+import multiprocessing
 import scipy.ndimage as ndimage
 import tifffile as tifffile
 import IOtools as io
+import instrumentation
+import native_registration
+import backends
 
 #==============================================================================
 ### CONSTANTS DECLARATIONS
@@ -49,6 +58,11 @@ import IOtools as io
 cluster = True # configured for the hpc2
 testing = False  # runs with low res/few iterations
 verbose = False # for full elastix output
+n_workers = 1 # number of frames registered/transformed at the same time, 1 runs serial
+
+# in the trial processes of run_trials: the semaphore of the cores of the node,
+# each frame job holds one of them while it runs (see _run_frame_job)
+node_slots = None
 
 toplevel_dir = os.path.split(os.path.realpath(__file__))[0]
 
@@ -78,6 +92,63 @@ if not(cluster):
 #    transformix_bin = '/home/georg/programs/elastix/bin/elastix/transformix'
     tmp_path = '/tmp'
 
+# registration backend: elastix, native or fake, see the backends module
+default_backend = os.environ.get('MOCO_BACKEND','elastix')
+
+# side products of elastix/transformix: none, transforms or full, see the 
+# backends module. full keeps tif dumps and deformation fields for inspection
+artifact_level = os.environ.get('MOCO_ARTIFACTS','full')
+
+# persistent cache of registrations, see the transform_cache module. Disabled if
+# None. Repeated registrations of the same frames (reruns of a trial) are then
+# looked up instead of computed. Size limit in bytes, least recently used
+# entries are removed first.
+transform_cache_path = os.environ.get('MOCO_CACHE',None)
+transform_cache_size = 10 * 2**30
+
+# checkpoints of the per frame registrations and transforms, see
+# backends.CheckpointBackend. A rerun of a killed or crashed trial then only
+# computes the frames that are missing. The scratch folder (see make_tmp_dir) is
+# then named after the data instead of the process ID, so that the rerun finds
+# the frames of the killed run.
+resume = os.environ.get('MOCO_RESUME','0') == '1'
+
+# the affine registrations start from the translation of each frame found by
+# FFT phase correlation against the reference (see
+# native_registration.phase_correlation), instead of the identity. Large
+# shifts then don't have to be found by the optimizer.
+prealign = os.environ.get('MOCO_PREALIGN','0') == '1'
+
+# the affine registration of each frame starts from the transform of the
+# previous frame, with warm_start_budget times the iterations of the parameter
+# file. If the final metric of a frame is worse than that of the previous one by
+# more than warm_start_tolerance (relative), it is registered again with the
+# full budget. The frames are registered in one chain per worker, over
+# consecutive blocks of frames. See register_chain
+warm_start = os.environ.get('MOCO_WARM_START','0') == '1'
+warm_start_budget = 0.25
+warm_start_tolerance = 0.05
+
+# keyframe registration, for recordings with slow motion: only every
+# keyframe_interval-th frame is registered (or with keyframe_average, the
+# average of each block of keyframe_interval frames), the transforms of the
+# frames in between are interpolated and applied with transformix. The
+# midpoints between keyframes are registered in keyframe_checks places, where
+# the interpolation is off by more than keyframe_tolerance pixels, the interval
+# and its neighbours are refined. 1: every frame is registered. See
+# register_keyframes
+keyframe_interval = int(os.environ.get('MOCO_KEYFRAMES',1))
+keyframe_average = False
+keyframe_checks = 4
+keyframe_tolerance = 0.5
+
+# number of frames the signal/background split works on at a time
+split_chunk_size = 64
+
+# elastix/transformix calls running longer than this (in s) are killed and the
+# frame fails. None: no limit
+elastix_timeout = None
+
 
 #==============================================================================
 ### MISC HELPERS
@@ -90,18 +161,69 @@ def calc_ref_img(data,odor_onset_frame):
     ref_img = ref_img.astype('uint16')
     return ref_img
 
+def average_frames(frames, n_frames):
+    """ the same average as calc_ref_img, of an iterable of (x,y) frames (e.g.
+    a generator reading them from disk), without holding them in memory """
+    frame_sum = None
+    for frame in frames:
+        if frame_sum is None:
+            frame_sum = sp.zeros(frame.shape)
+        frame_sum += frame
+    return (frame_sum / n_frames).astype('uint16')
+
+@instrumentation.timed(args=('data',))
+def split_signal_background(data, ref_img, chunk_size=None):
+    """ steps 3) and 4) of movement_correct_tstack: returns the signal and the
+    background (both uint16) of the affine registered xyt stack data, or of a
+    single (x,y) frame.
+    
+    The stack is processed in chunks of chunk_size frames (default
+    split_chunk_size), with a float32
+    buffer for the differences that is reused and modified in place. The
+    smoothing of the signal is one gaussian filter over x and y of the whole
+    chunk. The results are the same as of the former frame by frame version
+    (the filter output is uint16 as before). """
+    if data.ndim == 2:
+        signal, background = split_signal_background(data[:,:,sp.newaxis],ref_img)
+        return signal[:,:,0], background[:,:,0]
+    if chunk_size is None:
+        chunk_size = split_chunk_size
+    
+    signal = sp.empty(data.shape,dtype='uint16')
+    background = sp.empty(data.shape,dtype='uint16')
+    ref = ref_img.astype('float32')[:,:,sp.newaxis]
+    
+    for start in range(0,data.shape[2],chunk_size):
+        chunk = slice(start,min(start+chunk_size,data.shape[2]))
+        img = data[:,:,chunk]
+        buf = img.astype('float32') # differences of uint16 are exact in float32
+        
+        # 3) signal
+        buf -= ref
+        buf.clip(0,65535,out=buf)
+        signal[:,:,chunk] = buf
+        signal_filt = ndimage.gaussian_filter(signal[:,:,chunk],sigma=(0.75,0.75,0))
+        
+        # 4) background
+        sp.subtract(img,signal_filt,out=buf,dtype='float32')
+        buf.clip(0,65535,out=buf)
+        background[:,:,chunk] = buf
+    
+    return signal, background
+
 def makedirs(path):
     try:
         os.makedirs(path)
     except OSError:
         pass
     
+@instrumentation.timed()
 def calc_ref_stack(tstack_paths,odor_onset_frame=None):
     """ for aligning multiple, tstack_paths is a list containing the paths to the
     individual stacks """
     
     # allocate
-    x,y,z = io.read_tiffstack(tstack_paths[0]).shape
+    (x,y,z), dtype = io.probe_tiffstack(tstack_paths[0])
     n = len(tstack_paths)
     ref_stack = sp.zeros((x,y,n))
     
@@ -112,29 +234,37 @@ def calc_ref_stack(tstack_paths,odor_onset_frame=None):
         if _background_bspline.tif doesn't exist, use regular calculation"""
         bspline_path = os.path.splitext(path)[0][:-5] + '_background_bspline.tif'  # HARDCODED: the -5 remove a '_full' FIXME
         if os.path.exists(bspline_path):
-            ref_stack[:,:,i] = sp.average(io.read_tiffstack(bspline_path),axis=2)
+            ref_stack[:,:,i] = sp.average(io.read_tiffstack(bspline_path,memmap=True),axis=2)
         else:
-            ref_stack[:,:,i] = calc_ref_img(io.read_tiffstack(path),odor_onset_frame)
+            # only the frames before the odor onset are read
+            ref_stack[:,:,i] = calc_ref_img(io.read_tiffstack(path,frames=slice(0,odor_onset_frame)),odor_onset_frame)
         pass
     
     return ref_stack.astype('uint16')
     
-def make_tmp_dir(data_path):
-    """ copies the data to scratch into folder named with the processes ID """
-    tmpdir_path = tmp_path + '/' + str(os.getpid())
+@instrumentation.timed()
+def make_tmp_dir(data_path, tmpdir_path=None):
+    """ copies the data to scratch into folder named with the processes ID, or
+    into tmpdir_path if given. With resume, the folder is named after the data
+    and its path, so a rerun uses the same folder, and the data are only
+    copied if the copy there is not up to date """
+    if tmpdir_path is None:
+        if resume:
+            tmpdir_path = tmp_path + '/' + get_exp_name(data_path) + '_' + hashlib.sha1(os.path.abspath(data_path)).hexdigest()[:8]
+        else:
+            tmpdir_path = tmp_path + '/' + str(os.getpid())
     makedirs(tmpdir_path)
-    command = ' '.join(['cp',data_path,tmpdir_path])
-    subprocess.call(command,shell=True)
-    
     data_path_tmp = tmpdir_path + '/' + os.path.basename(data_path)
-    
-    # FIXME dirty workaround again, see run elastix for possible solution
-    while not(os.path.exists(data_path_tmp)):
-        time.sleep(1)
-        pass    
-    
+    if resume and os.path.exists(data_path_tmp):
+        stat, stat_tmp = os.stat(data_path), os.stat(data_path_tmp)
+        if stat.st_size == stat_tmp.st_size and stat.st_mtime == stat_tmp.st_mtime:
+            return data_path_tmp
+    shutil.copy2(data_path,data_path_tmp) # returns when the copy is complete, keeps the modification time
+    size = os.path.getsize(data_path_tmp)
+    io.count_io(bytes_read=size, bytes_written=size, files_read=1, files_written=1)
     return data_path_tmp
     
+@instrumentation.timed()
 def cleanup(data_path):
     """ removing all elastix generated files, which are placed under 
     data_path/elastix/exp_name by convention """
@@ -149,104 +279,410 @@ def cleanup(data_path):
 def get_exp_name(path):
     """ this corresponds to the name of the experiment file e.g. '../../testdata.tif' -> 'testdata' """
     return os.path.splitext(os.path.basename(path))[0]
+
+def get_frame_dir(data_path, output_subdir, frame, n_frames):
+    """ the directory for the elastix files of a frame, as transform_tstack
+    and apply_transform name them """
+    frame_i_of_n = 'frame_' + str(frame) + '_' + str(n_frames)
+    return os.path.dirname(data_path) + '/elastix/' + get_exp_name(data_path) + '/' + output_subdir + '/' + frame_i_of_n
     
 #==============================================================================
 ### HELPERS elastix
 #==============================================================================
 
-def run_elastix(img,ref_img,parameter_filepath,outpath):
-    """ this function recieves the data as np arrays, generates the mhd files in 
-    the directory outpath, runs elastix with the parameter_file on it. input
-    and output files are thus going to be in the same directory.
-    Then the mhd file is read again and returned as an array """
+def get_backend(backend=None):
+    """ returns the registration backend (see the backends module). backend can
+    be a backends.Backend instance or one of the names 'elastix', 'native',
+    'fake'. If None, the module wide default backend is used, which can be set
+    by the environment variable MOCO_BACKEND.
+    
+    If transform_cache_path is set, the backend (except fake) is wrapped in a
+    backends.CachedBackend, and if resume is set in a
+    backends.CheckpointBackend. Instances that are wrapped already are
+    returned as they are """
+    if backend is None:
+        backend = default_backend
+    elastix = backends.ElastixBackend(elastix_bin,transformix_bin,verbose=verbose,artifact_level=artifact_level,timeout=elastix_timeout)
+    if isinstance(backend,backends.Backend):
+        engine = backend
+    elif backend == 'elastix':
+        engine = elastix
+    elif backend == 'native':
+        engine = backends.NativeBackend(fallback=elastix)
+    elif backend == 'fake':
+        engine = backends.FakeBackend()
+    else:
+        raise ValueError("unknown backend: " + str(backend))
+    if isinstance(engine,backends.CheckpointBackend):
+        return engine
+    if transform_cache_path is not None and not isinstance(engine,(backends.FakeBackend,backends.CachedBackend)):
+        engine = backends.CachedBackend(engine,cache_path=transform_cache_path,max_bytes=transform_cache_size)
+    if resume:
+        engine = backends.CheckpointBackend(engine)
+    return engine
+
+@instrumentation.timed()
+def run_elastix(img,ref_img,parameter_filepath,outpath,backend=None,initial_transform=None):
+    """ this function recieves the data as np arrays and registers img to 
+    ref_img with the parameter_file. All files are written into outpath, 
+    including the TransformParameters.0.txt. The transformed img is returned as
+    an array. 
+    
+    backend: see get_backend, by default elastix is run
+    initial_transform: path to a TransformParameters file the registration
+    starts from (elastix -t0), see write_initial_transform """
+    return get_backend(backend).register(img,ref_img,parameter_filepath,outpath,initial_transform)
 
-    # make the directories
+def write_warm_start_parameters(parameter_filepath, outpath):
+    """ writes a copy of the parameter file with warm_start_budget times its
+    MaximumNumberOfIterations into outpath, returns its path """
+    parameters = io.read_transform_parameters(parameter_filepath)
+    if 'MaximumNumberOfIterations' in parameters:
+        parameters['MaximumNumberOfIterations'] = [max(1,int(round(n * warm_start_budget))) for n in parameters['MaximumNumberOfIterations']]
     makedirs(outpath)
-    
-    # write tiffs into outpath
-    img_tiffpath = outpath + '/image.tif'
-    io.save_tiff(img,img_tiffpath)    
-    
-    ref_img_tiffpath = outpath + '/ref_image.tif'       
-    io.save_tiff(ref_img,ref_img_tiffpath)
+    path = outpath + '/parameters_warm_start.txt'
+    io.write_transform_parameters(parameters,path)
+    return path
 
-    # generate mhd files
-    img_mhdpath = os.path.splitext(img_tiffpath)[0] + '.mhd'
-    io.tiff2mhd(img_tiffpath,outpath=img_mhdpath,dtype='float32')
-    
-    ref_img_mhdpath = os.path.splitext(ref_img_tiffpath)[0] + '.mhd'
-    io.tiff2mhd(ref_img_tiffpath,ref_img_mhdpath,dtype='float32')
-    
-    # run elastix  
-    command = ' '.join([elastix_bin,'-f','\''+ref_img_mhdpath+'\'','-m','\''+img_mhdpath+'\'','-out','\''+outpath+'\'','-p','\''+parameter_filepath+'\''])
-    
-    # silencing output: http://stackoverflow.com/questions/11269575/how-to-hide-output-of-subprocess-in-python-2-7
-    if verbose:
-        retcode = subprocess.call(command, shell=True)
+def write_warm_start_transform(transformation_filepath, shape, outpath):
+    """ writes the transform of a previous frame (including its initial
+    transforms) as a single AffineTransform into outpath, as initial transform
+    of the next frame. The chain of initial transforms thus does not grow from
+    frame to frame. Returns the path of the file """
+    affine = backends.read_affine_transform(transformation_filepath)
+    if affine is None:
+        raise ValueError("warm start needs translation or affine transforms: " + transformation_filepath)
+    makedirs(outpath)
+    path = outpath + '/WarmStartTransformParameters.txt'
+    io.write_transform_parameters(backends.make_transform_parameters('AffineTransform',affine[0],shape,affine[1]),path)
+    return path
+
+def register_chain(frame_args, warm_parameter_filepath):
+    """ registers consecutive frames one after another, as a time block of
+    transform_tstack with warm_start. frame_args are the run_elastix arguments
+    of each frame. 
+    
+    Each frame but the first starts from the transform of the previous frame,
+    with the reduced iteration budget of warm_parameter_filepath (see
+    write_warm_start_parameters). If its final metric (as recorded by the
+    backend, see backends.read_final_metric) is worse than the one of the
+    previous frame by more than warm_start_tolerance, it is registered again as
+    without warm start, from its own initial transform and with the full
+    budget. The FakeBackend records no metric, its frames never fall back.
+    Returns the list of the outputs """
+    outputs = []
+    previous = None # TransformParameters and final metric of the previous frame
+    for img, ref_img, parameter_filepath, outpath, backend, initial_transform in frame_args:
+        output = None
+        if previous is not None:
+            warm_initial_transform = write_warm_start_transform(previous[0],ref_img.shape,outpath)
+            output = run_elastix(img,ref_img,warm_parameter_filepath,outpath,backend,warm_initial_transform)
+            metric = backends.read_final_metric(outpath)
+            io.count_io(frames_warm_started=1)
+            if metric is not None and previous[1] is not None and metric > previous[1] + warm_start_tolerance * abs(previous[1]):
+                io.count_io(warm_start_fallbacks=1)
+                output = None
+        if output is None:
+            output = run_elastix(img,ref_img,parameter_filepath,outpath,backend,initial_transform)
+            metric = backends.read_final_metric(outpath)
+        outputs.append(output)
+        previous = (outpath + '/TransformParameters.0.txt', metric)
+    return outputs
+
+def register_keyframes(data, ref_img, parameter_filepath, frame_dirs, stage_dir, interval, shifts=None, n_workers=None, backend=None):
+    """
+    keyframe registration of the xyt stack data (see keyframe_interval):
+    
+    1) every interval-th frame and the last frame are registered to ref_img
+    into their frame_dirs, or with keyframe_average, the average of each block
+    of interval frames into stage_dir/keyframe_i_n, at the time of its center
+    2) in keyframe_checks intervals between keyframes (evenly spaced), the
+    middle frame is registered and compared to the transform interpolated from
+    the keyframes (see backends.transform_distance). If they differ by more
+    than keyframe_tolerance pixels, both halves of the interval and the
+    neighbouring intervals are checked as well, and so on. All registered
+    frames become keyframes.
+    3) the transforms of the other frames are interpolated between the
+    keyframes before and after them (affine matrices or bspline coefficients,
+    see backends.interpolate_transform_parameters, extrapolated at the ends of
+    the stack), written to the
+    TransformParameters.0.txt of their frame_dirs and applied with transformix.
+    
+    shifts: the translations of the frames found by phase correlation, the
+    keyframe registrations then start from them (see transform_tstack)
+    
+    Returns the transformed stack.
+    """
+    n_frames = data.shape[2]
+    shape = ref_img.shape
+    keys = {} # time: TransformParameters of the keyframe
+    registered = {} # frame: output, of the frames registered on their own
+    
+    def keyframe_args(frames, outpath):
+        img = data[:,:,frames[0]] if len(frames) == 1 else sp.average(data[:,:,frames],axis=2)
+        initial_transform = None
+        if shifts is not None:
+            initial_transform = write_initial_transform(shifts[frames].mean(axis=0),shape,outpath)
+        return (img,ref_img,parameter_filepath,outpath,backend,initial_transform)
+    
+    # 1) keyframes
+    if keyframe_average:
+        blocks = [range(start,min(start+interval,n_frames)) for start in range(0,n_frames,interval)]
+        items = [(sp.mean(block),block,stage_dir + '/keyframe_' + str(i) + '_' + str(len(blocks))) for i, block in enumerate(blocks)]
     else:
-        FNULL = open(os.devnull, 'w')
-        retcode = subprocess.call(command, shell=True, stdout=FNULL, stderr=subprocess.STDOUT) # silenced shell
-    
-    if retcode != 0:
-        print "Elastix error! ", retcode
-        sys.exit()
+        key_frames = range(0,n_frames,interval)
+        if key_frames[-1] != n_frames - 1:
+            key_frames.append(n_frames - 1)
+        items = [(frame,[frame],frame_dirs[frame]) for frame in key_frames]
+    outputs = run_frame_jobs(run_elastix, [keyframe_args(frames,outpath) for key_time, frames, outpath in items], n_workers=n_workers)
+    for (key_time, frames, outpath), output in zip(items,outputs):
+        keys[key_time] = outpath + '/TransformParameters.0.txt'
+        if not keyframe_average:
+            registered[frames[0]] = output
+    
+    # 2) checks of the interpolation and local refinement
+    times = sorted(keys)
+    intervals = zip(times[:-1],times[1:])
+    n_checks = min(keyframe_checks,len(intervals))
+    to_check = [intervals[i] for i in sp.unique(sp.linspace(0,len(intervals)-1,n_checks).round().astype('int'))] if n_checks else []
+    checked = set()
+    n_registrations = len(items)
+    n_refined = 0
+    while to_check:
+        checks = []
+        for a, b in to_check:
+            checked.add((a,b))
+            inner = [frame for frame in range(int(sp.floor(a)) + 1,int(sp.ceil(b))) if a < frame < b and frame not in registered]
+            if inner:
+                checks.append((a,b,inner[len(inner) // 2]))
+        outputs = run_frame_jobs(run_elastix, [keyframe_args([mid],frame_dirs[mid]) for a, b, mid in checks], n_workers=n_workers)
+        n_registrations += len(checks)
         
-    # FIXME needed
-    # Problem: the cluster seems to start the processes completely detached
-    # so the script continues to run here and then read_mhd fails because
-    # there is nothing yet to read
-    # dirty hack with sleep
+        to_check = []
+        failed = []
+        for (a, b, mid), output in zip(checks,outputs):
+            registered[mid] = output
+            tp_path = frame_dirs[mid] + '/InterpolatedTransformParameters.txt'
+            io.write_transform_parameters(backends.interpolate_transform_parameters(keys[a],keys[b],(mid - a) / float(b - a),shape),tp_path)
+            keys[mid] = frame_dirs[mid] + '/TransformParameters.0.txt'
+            if backends.transform_distance(tp_path,keys[mid],shape) > keyframe_tolerance:
+                failed.append((a,b))
+                to_check += [(a,mid),(mid,b)]
+        n_refined += len(failed)
         
-    while not(os.path.exists(outpath + '/result.0.mhd')):
-        time.sleep(2)
-        pass
+        # the motion that the interpolation missed may extend to the neighbours
+        times = sorted(keys)
+        for a, b in failed:
+            i, j = times.index(a), times.index(b)
+            neighbours = ([(times[i-1],a)] if i > 0 else []) + ([(b,times[j+1])] if j + 1 < len(times) else [])
+            for neighbour in neighbours:
+                if neighbour not in checked and neighbour not in to_check:
+                    to_check.append(neighbour)
+    
+    # 3) interpolation of all other frames
+    times = sorted(keys)
+    frame_args = []
+    interpolated = [frame for frame in range(n_frames) if frame not in registered]
+    for frame in interpolated:
+        # frames before the first or after the last keyframe (keyframe_average)
+        # are extrapolated from the first or last two
+        i = min(max(sp.searchsorted(times,frame),1),len(times)-1)
+        a, b = times[max(i-1,0)], times[i]
+        weight = (frame - a) / float(b - a) if b > a else 0.0
+        tp_path = frame_dirs[frame] + '/TransformParameters.0.txt'
+        makedirs(frame_dirs[frame])
+        io.write_transform_parameters(backends.interpolate_transform_parameters(keys[a],keys[b],weight,shape),tp_path)
+        frame_args.append((data[:,:,frame],tp_path,frame_dirs[frame],backend))
+    outputs = run_frame_jobs(run_transformix, frame_args, n_workers=n_workers) if frame_args else []
+    
+    data_transformed = sp.zeros(data.shape,dtype='uint16')
+    for frame, output in registered.items() + zip(interpolated,outputs):
+        data_transformed[:,:,frame] = output
+    print "keyframes: %i registrations for %i frames, %i intervals refined, %i frames interpolated" % (
+        n_registrations, n_frames, n_refined, len(interpolated))
+    return data_transformed
 
-    # possible solution from http://stackoverflow.com/questions/4965159/python-how-to-redirect-output-with-subprocess
-    # needs to be tested on cluster!
-#    p = subprocess.Popen(my_cmd, shell=True)
-#    os.waitpid(p.pid, 0)    
-    
-    # read elastix output, convert it to uint16 tif
-    output = io.read_mhd(outpath + '/result.0.mhd')
-    output = output.clip(0.0,2.0**16).astype('uint16')
-    
-    # dump elastix output for inspection
-    io.mhd2tiff(outpath + '/result.0.mhd')
-    return output
+def write_initial_transform(shift, shape, outpath):
+    """ writes the translation shift (x,y) as TranslationTransform parameters
+    for images of shape into outpath, as initial transform for run_elastix.
+    Returns the path of the file """
+    makedirs(outpath)
+    path = outpath + '/InitialTransformParameters.txt'
+    io.write_transform_parameters(backends.make_transform_parameters('TranslationTransform',shift,shape),path)
+    return path
 
-def run_transformix(img_mhdpath,transformation_filepath,outpath):
+@instrumentation.timed()
+def run_transformix(img,transformation_filepath,outpath,backend=None):
     """
-    executes the transformix call, reads the result mhd afterwards and returns
-    the array of the transformed data
-    """
-    # run transformix
-    command = ' '.join([transformix_bin,'-def all -in','\''+img_mhdpath+'\'','-out','\''+outpath+'\'','-tp','\''+transformation_filepath+'\''])
-    
-    if verbose:
-        retcode = subprocess.call(command, shell=True)
-    else:
-        FNULL = open(os.devnull, 'w')
-        retcode = subprocess.call(command, shell=True, stdout=FNULL, stderr=subprocess.STDOUT) # silenced
-       
-    
-    if retcode != 0:
-        print "Transformix error! ", retcode
-        sys.exit()    
-    
-    output = io.read_mhd(outpath + '/result.mhd').clip(0.0,2.0**16).astype('uint16')
+    applies the transformation in transformation_filepath to the array img,
+    all files are written into outpath. Returns the array of the transformed 
+    data. 
     
-    # dump transformix output for inspection
-    io.mhd2tiff(outpath + '/result.mhd')
-    
-    return output
+    backend: see get_backend, by default transformix is run
+    """
+    return get_backend(backend).transform(img,transformation_filepath,outpath)
 
+def print_stack_report(backend, io_before, t_start):
+    """ prints the IO and the time spent on a stack since io_before and t_start
+    were taken. The artifact level is included, so runs at different levels
+    can be compared """
+    io_stack = io.io_counter_diff(io.get_io_counter(),io_before)
+    level = getattr(backend,'artifact_level','none')
+    print "IO:", io.format_io_counter(io_stack)
+    print "time: %.1f s, artifact level: %s" % (time.time() - t_start, level)
+
+#==============================================================================
+### HELPERS parallel
+#==============================================================================
+
+def get_n_workers(n=None):
+    """ returns n if given, else the module wide default n_workers """
+    if n is None:
+        n = n_workers
+    return max(1,int(n))
+
+def get_prealign(p=None):
+    """ returns p if given, else the module wide default prealign """
+    if p is None:
+        p = prealign
+    return bool(p)
+
+def get_warm_start(w=None):
+    """ returns w if given, else the module wide default warm_start """
+    if w is None:
+        w = warm_start
+    return bool(w)
+
+def get_keyframe_interval(k=None):
+    """ returns k if given, else the module wide default keyframe_interval """
+    if k is None:
+        k = keyframe_interval
+    return max(1,int(k))
+
+def _run_frame_job(job):
+    """ executes one frame job in a worker. Exceptions (and the sys.exit of the
+    elastix helpers) are caught and returned, so a failing frame does not take
+    down the pool and can be reported with its frame number. The IO done for 
+    the frame is returned as well, as the IO counter of a pool worker is not
+    the one of the main process, and the latency of the frame in s. For the
+    same reason, the instrumentation records of the frame are returned, the
+    frame being a stage named 'frame' """
+    func, frame, args = job
+    if node_slots is not None:
+        node_slots.acquire()
+    io_before = io.get_io_counter()
+    stack = instrumentation.isolate() # same paths serial and in a pool
+    start = instrumentation.mark()
+    t_start = time.time()
+    try:
+        with instrumentation.stage('frame'):
+            output, error = func(*args), None
+    except (Exception, SystemExit):
+        output, error = None, traceback.format_exc()
+    finally:
+        if node_slots is not None:
+            node_slots.release()
+    latency = time.time() - t_start
+    frame_records = instrumentation.take(start)
+    instrumentation.restore(stack)
+    return frame, output, error, io.io_counter_diff(io.get_io_counter(),io_before), latency, frame_records
+
+def print_latency_histogram(latencies, n_bins=10, width=40):
+    """ text histogram of the per frame latencies (in s) """
+    latencies = sp.array(latencies)
+    print "latency per frame: min %.3f s, median %.3f s, max %.3f s" % (latencies.min(), sp.median(latencies), latencies.max())
+    counts, edges = sp.histogram(latencies,bins=n_bins)
+    for count, left, right in zip(counts,edges[:-1],edges[1:]):
+        print "%8.3f - %8.3f s %5i %s" % (left, right, count, '#' * int(round(width * count / float(counts.max()))))
+
+def iter_frame_jobs(func, frame_args, n_workers=None, n_frames=None, chunk_size=None):
+    """ generator version of run_frame_jobs: frame_args can be any iterable,
+    e.g. a generator that reads the frames one by one, and the outputs are
+    yielded in frame order. Only chunk_size frames (default: 2 per worker) are
+    taken from frame_args at a time, so that only a few frames are in memory.
+    n_frames is only used for the progress report.
+    
+    If any frame fails, the errors of the chunk are printed and the process
+    exits as in run_frame_jobs. When all frames are done, a histogram of their
+    latencies is printed. """
+    n_workers = get_n_workers(n_workers)
+    if chunk_size is None:
+        chunk_size = 2 * n_workers
+    if n_frames is not None:
+        n_workers = max(1,min(n_workers,n_frames))
+    total = '?' if n_frames is None else str(n_frames)
+    
+    pool = None
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers)
+    
+    frame_args = iter(frame_args)
+    latencies = []
+    n_done = 0
+    try:
+        while True:
+            jobs = [(func, n_done + i, args) for i, args in enumerate(itertools.islice(frame_args,chunk_size))]
+            if not jobs:
+                break
+            
+            results = {}
+            failed = []
+            if pool is not None:
+                # unordered, so progress is reported as frames finish
+                for i, (frame, output, error, frame_io, latency, frame_records) in enumerate(pool.imap_unordered(_run_frame_job,jobs)):
+                    print "frame ", str(frame), "done,", str(n_done+i+1), "/", total
+                    io.count_io(**frame_io)
+                    instrumentation.add(frame_records,frame=frame)
+                    results[frame] = output
+                    latencies.append(latency)
+                    if error is not None:
+                        failed.append((frame,error))
+            else:
+                for job in jobs:
+                    frame, output, error, frame_io, latency, frame_records = _run_frame_job(job)
+                    print "frame ", str(frame), "/", total
+                    instrumentation.add(frame_records,frame=frame)
+                    results[frame] = output
+                    latencies.append(latency)
+                    if error is not None:
+                        failed.append((frame,error))
+            n_done += len(jobs)
+            
+            if failed:
+                for frame, error in sorted(failed):
+                    print "frame", str(frame), "failed:"
+                    print error
+                print "Error!", len(failed), "of", str(n_done), "frames failed"
+                sys.exit()
+            
+            for job in jobs:
+                yield results.pop(job[1])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    if latencies:
+        print_latency_histogram(latencies)
+
+def run_frame_jobs(func, frame_args, n_workers=None):
+    """ calls func(*args) for each args in frame_args, the i-th entry being 
+    frame i. With n_workers > 1, the frames are distributed over a process pool
+    and processed at the same time. Results are returned in frame order.
+    
+    If any frame fails, the error of each failed frame is printed and the
+    process exits, as the serial elastix helpers do. Otherwise, a histogram of
+    the latencies of the frames is printed. """
+    n_frames = len(frame_args)
+    return list(iter_frame_jobs(func, frame_args, n_workers=n_workers, n_frames=n_frames, chunk_size=max(1,n_frames)))
 
 #==============================================================================
 ### transformations
 #==============================================================================
     
     
-def transform_tstack(data, data_path, ref_img, output_subdir='', mode='affine'):
+@instrumentation.timed(args=('data','output_subdir','mode'))
+def transform_tstack(data, data_path, ref_img, output_subdir='', mode='affine', n_workers=None, return_matrices=False, backend=None, prealign=None, warm_start=None, keyframes=None):
     """
     loops over the frames in a xyt stack and applies the specified transform in
     the kwarg mode to the ref_img. This generates also the transform_parameters
@@ -258,7 +694,34 @@ def transform_tstack(data, data_path, ref_img, output_subdir='', mode='affine'):
     
     output_subdir is the name of the output directory under .../elastix/'exp_name'/output_subdir
     
-    mode is either affine or bspline
+    mode is either affine, bspline, bspline_lowres or affine_native. 
+    affine_native registers in-process with the native_registration module
+    instead of elastix, nothing is written to disk in this mode.
+    
+    n_workers is the number of frames registered at the same time, if not given
+    the module wide n_workers is used
+    
+    if return_matrices is True (only for affine_native), the (n,2,3) array of
+    the per-frame affine matrices is returned as well. See
+    native_registration.affine_matrix for their definition.
+    
+    backend is the registration backend, see get_backend
+    
+    if prealign is True (default: the module wide prealign), the affine
+    registrations (modes affine and affine_native) start from the translation
+    of each frame found by phase correlation. For elastix, it is written to
+    InitialTransformParameters.txt in the frame directory and passed as -t0.
+    
+    if warm_start is True (default: the module wide warm_start), the
+    registrations of mode affine start from the transform of the previous
+    frame, with a reduced iteration budget (see register_chain). The frames
+    are split into one block of consecutive frames per worker, each block is
+    registered as one chain.
+    
+    if keyframes is larger than 1 (default: the module wide keyframe_interval),
+    only every keyframes-th frame is registered, the transforms of the others
+    are interpolated, see register_keyframes. This takes precedence over
+    warm_start. Not in mode affine_native.
         
     infos on inverse transform
     http://lists.bigr.nl/pipermail/elastix/2012-August/000892.html
@@ -276,7 +739,36 @@ def transform_tstack(data, data_path, ref_img, output_subdir='', mode='affine'):
         parameters_path = bspline_parameters_path
     if mode == 'bspline_lowres':
         parameters_path = bspline_lowres_parameters_path
-        
+    
+    if return_matrices and mode != 'affine_native':
+        raise ValueError("affine matrices are only returned in mode affine_native")
+    
+    shifts = None
+    if get_prealign(prealign) and mode in ['affine','affine_native']:
+        t_start = time.time()
+        shifts = native_registration.phase_correlation(data,ref_img)
+        print "phase correlation prealignment: %.2f s, median shift %.1f px, max %.1f px" % (
+            time.time() - t_start, sp.median(sp.sqrt((shifts**2).sum(axis=1))), sp.sqrt((shifts**2).sum(axis=1)).max())
+    
+    if mode == 'affine_native':
+        if shifts is None:
+            frame_args = [(data[:,:,frame],ref_img) for frame in range(data.shape[2])]
+        else:
+            frame_args = [(data[:,:,frame],ref_img,sp.hstack([[1.0,0.0,0.0,1.0],shifts[frame]])) for frame in range(data.shape[2])]
+        outputs = run_frame_jobs(native_registration.register_frame, frame_args, n_workers=n_workers)
+        matrices = sp.zeros((data.shape[2],2,3))
+        for frame, (output, matrix) in enumerate(outputs):
+            data_transformed[:,:,frame] = output
+            matrices[frame] = matrix
+        data_transformed = data_transformed.clip(0,65536).astype('uint16')
+        if return_matrices:
+            return data_transformed, matrices
+        return data_transformed
+    
+    backend = get_backend(backend)
+    io_before = io.get_io_counter()
+    t_start = time.time()
+    frame_args = []
     for frame in range(data.shape[2]):
         elastix_subdir = os.path.dirname(data_path) + '/elastix'
         exp_name = get_exp_name(data_path) 
@@ -285,14 +777,34 @@ def transform_tstack(data, data_path, ref_img, output_subdir='', mode='affine'):
         tempdir = elastix_subdir + '/' + exp_name + '/' + output_subdir + '/' + frame_i_of_n
         makedirs(tempdir)
         
-        print "frame ", str(frame), "/",str(data.shape[2])
-        output = run_elastix(data[:,:,frame],ref_img,parameters_path,tempdir)
-        
+        initial_transform = None
+        if shifts is not None:
+            initial_transform = write_initial_transform(shifts[frame],ref_img.shape,tempdir)
+        frame_args.append((data[:,:,frame],ref_img,parameters_path,tempdir,backend,initial_transform))
+    
+    if get_keyframe_interval(keyframes) > 1:
+        data_transformed = register_keyframes(data, ref_img, parameters_path, [args[3] for args in frame_args], elastix_subdir + '/' + exp_name + '/' + output_subdir,
+                                              get_keyframe_interval(keyframes), shifts=shifts, n_workers=n_workers, backend=backend)
+        print_stack_report(backend, io_before, t_start)
+        return data_transformed
+    
+    if get_warm_start(warm_start) and mode == 'affine':
+        warm_parameters_path = write_warm_start_parameters(parameters_path,elastix_subdir + '/' + exp_name + '/' + output_subdir)
+        blocks = sp.array_split(sp.arange(data.shape[2]),min(get_n_workers(n_workers),data.shape[2]))
+        print "warm start: %i chains of up to %i frames" % (len(blocks), max([len(block) for block in blocks]))
+        block_args = [([frame_args[frame] for frame in block],warm_parameters_path) for block in blocks]
+        outputs = list(itertools.chain(*run_frame_jobs(register_chain, block_args, n_workers=n_workers)))
+    else:
+        outputs = run_frame_jobs(run_elastix, frame_args, n_workers=n_workers)
+    for frame, output in enumerate(outputs):
         data_transformed[:,:,frame] = output 
+    
+    print_stack_report(backend, io_before, t_start)
         
     return data_transformed.clip(0,65536).astype('uint16')
 
-def apply_transform(data, data_path, tp_paths, output_subdir=''):
+@instrumentation.timed(args=('data','output_subdir'))
+def apply_transform(data, data_path, tp_paths, output_subdir='', n_workers=None, backend=None):
     """
     applies transforms from another elastix run to a xyt stack using transformix
     
@@ -306,7 +818,7 @@ def apply_transform(data, data_path, tp_paths, output_subdir=''):
     tp_paths is a list of paths to each individual tp file. This allows to have
     one transformation applied to different frames    
     
-    output_subdir has the same behaviour as in transform_tstack
+    output_subdir, n_workers and backend have the same behaviour as in transform_tstack
     """
     
     
@@ -319,28 +831,29 @@ def apply_transform(data, data_path, tp_paths, output_subdir=''):
     
     print "running transformix: ", data_path
     
+    backend = get_backend(backend)
+    io_before = io.get_io_counter()
+    t_start = time.time()
+    
+    frame_args = []
     for frame in range(data.shape[2]):
 
         ## folder for thie iteration        
         frame_i_of_n = 'frame_' + str(frame) + '_' + str(data.shape[2])
         tempdir = elastix_subdir + '/' + exp_name + '/' + output_subdir + '/' + frame_i_of_n 
         makedirs(tempdir)
-
-        # dumping the array to tiff and convert to mhd
-        tifpath = tempdir + '/frame.tif'
-#        tifffile.imsave(tifpath,data[:,:,frame]) # FIXME kickme
-        io.save_tiff(data[:,:,frame],tifpath)
-        mhd_path = os.path.splitext(tifpath)[0] + '.mhd'
-        io.tiff2mhd(tifpath,mhd_path,dtype='float32')
         
         transform_parameter_filepath = tp_paths[frame]
-                
-        # run transformix
-        output = run_transformix(mhd_path, transform_parameter_filepath,tempdir)
-        
+        frame_args.append((data[:,:,frame],transform_parameter_filepath,tempdir,backend))
+    
+    # run transformix
+    outputs = run_frame_jobs(run_transformix, frame_args, n_workers=n_workers)
+    for frame, output in enumerate(outputs):
         data_transformed[:,:,frame] = output
         pass
     
+    print_stack_report(backend, io_before, t_start)
+    
     return data_transformed.clip(0,65536).astype('uint16')
 
        
@@ -354,11 +867,15 @@ def apply_transform(data, data_path, tp_paths, output_subdir=''):
 #==============================================================================
 # single
 #==============================================================================
-def movement_correct_tstack(data_path, odor_onset_frame, ref_img=None):
+@instrumentation.timed()
+def movement_correct_tstack(data_path, odor_onset_frame, ref_img=None, n_workers=None, affine_mode='affine', backend=None):
     """
     data_path: the full absolute path to the xyt tiff stack
     odor_onset_frame: an int defining the last frame without response
     ref_img: if provided, align to this
+    n_workers: number of frames processed in parallel, see transform_tstack
+    affine_mode: 'affine' (elastix) or 'affine_native' (in-process) for step 2)
+    backend: the registration backend, see get_backend
     
     The movement correction procedure takes the following steps:
     1) An average frame of the first frames before odor onset is computed. This
@@ -380,38 +897,26 @@ def movement_correct_tstack(data_path, odor_onset_frame, ref_img=None):
     can also lead to a significant improvement.
     """
     
-    data = io.read_tiffstack(data_path)
+    data = io.read_tiffstack(data_path,memmap=True) # frames are read as they are registered
          
     # 1) generating a reference image out of the first few images from the stack
-    if ref_img == None:
+    if ref_img is None:
         ref_img = calc_ref_img(data,odor_onset_frame)
     
     # 2) registering all images to the reference image using affine transform
-    data_affine_transformed = transform_tstack(data, data_path, ref_img, output_subdir='affine', mode='affine')
+    data_affine_transformed = transform_tstack(data, data_path, ref_img, output_subdir='affine', mode=affine_mode, n_workers=n_workers, backend=backend)
     
     # generating a new (better) reference image
     ref_img_affine_transformed = calc_ref_img(data_affine_transformed,odor_onset_frame)
     
-    # 3) extracting the signal
-    data_signal = data_affine_transformed.astype('float') - ref_img_affine_transformed[:,:,sp.newaxis].astype('float')
-    data_signal = data_signal.clip(0,65536).astype('uint16')
-    
-    # smoothing the signal
-    data_signal_filt = sp.zeros(data_signal.shape)
-    for frame in range(data_signal.shape[2]):
-        data_signal_filt[:,:,frame] = ndimage.gaussian_filter(data_signal[:,:,frame],sigma=0.75)
-        pass
-    data_signal_filt = data_signal_filt.clip(0,65536).astype('uint16')
-    
-    # 4) extracting the background
-    data_background = data_affine_transformed.astype('float') - data_signal_filt.astype('float')
-    data_background = data_background.clip(0,65536).astype('uint16')
+    # 3) extracting the signal, smoothing it and 4) extracting the background
+    data_signal, data_background = split_signal_background(data_affine_transformed,ref_img_affine_transformed)
 
     # 5) generating average background image
     ref_img_background = calc_ref_img(data_background,data.shape[2])
     
     # 6) finding bspline transform for each background image to the average
-    data_background_bspline_transformed = transform_tstack(data_background, data_path, ref_img_background, output_subdir='bspline', mode='bspline')
+    data_background_bspline_transformed = transform_tstack(data_background, data_path, ref_img_background, output_subdir='bspline', mode='bspline', n_workers=n_workers, backend=backend)
     """just for completeness: in this call, the data_path is not the path of data, as data doesn't have a path. 
     However, it is kept because inside the function the exp name is deduced from data_path"""
         
@@ -424,18 +929,242 @@ def movement_correct_tstack(data_path, odor_onset_frame, ref_img=None):
         tp_path =  os.path.dirname(data_path) + '/elastix/' + exp_name + '/bspline/' + frame_i_of_n + '/TransformParameters.0.txt'
         tp_paths.append(tp_path)
     
-    data_bspline_transformed = apply_transform(data_affine_transformed, data_path, tp_paths, output_subdir='bspline_on_signal')
+    data_bspline_transformed = apply_transform(data_affine_transformed, data_path, tp_paths, output_subdir='bspline_on_signal', n_workers=n_workers, backend=backend)
     """ the same as above applies here. data_path is the path to the original data, what is transformed here is data_affine_transformed"""
                 
         
     return data_affine_transformed, data_signal, data_background, data_background_bspline_transformed, data_bspline_transformed
 
 
+def register_and_transform(background, img, ref_img_background, bspline_outpath, transform_outpath, backend=None):
+    """ steps 6) and 7) of movement_correct_tstack for a single frame: the
+    bspline registration of the background frame, and its application to the
+    affine registered frame img. Returns both results """
+    background_bspline_transformed = run_elastix(background,ref_img_background,bspline_parameters_path,bspline_outpath,backend=backend)
+    bspline_transformed = run_transformix(img,bspline_outpath + '/TransformParameters.0.txt',transform_outpath,backend=backend)
+    return background_bspline_transformed, bspline_transformed
+
+@instrumentation.timed()
+def movement_correct_tstack_streaming(data_path, odor_onset_frame, output_path, ref_img=None, n_workers=None, affine_mode='affine', backend=None):
+    """
+    the same movement correction as movement_correct_tstack, but the frames are
+    streamed through the steps instead of holding the full stacks in memory.
+    The stack is read frame by frame, each result is appended to its output file
+    as soon as it is computed, and read back (memory mapped) by the steps that
+    need it. Only the reference images are kept in memory and only a few frames
+    (2 per worker) are in flight, so the memory needed does not grow with the
+    length of the recording.
+    
+    output_path: the results are written as tiff stacks to
+    output_path + '_affine.tif', '_signal.tif', '_background.tif',
+    '_background_bspline.tif' and '_full.tif', as single_stack_aligner.py
+    saves them. Existing files are replaced.
+    
+    all other arguments as in movement_correct_tstack. Returns the list of the
+    paths of the results, in the order movement_correct_tstack returns them.
+    
+    The steps of movement_correct_tstack are done in three passes:
+    1) affine registration of each frame (step 2), the reference image of step 1)
+    is averaged from the first frames before.
+    2) signal and background of each frame (steps 3 and 4), while the average
+    background image (step 5) is accumulated.
+    3) bspline registration of each background frame and its application to the
+    affine registered frame (steps 6 and 7)
+    """
+    output_paths = [output_path + '_' + name + '.tif' for name in ['affine','signal','background','background_bspline','full']]
+    affine_path, signal_path, background_path, background_bspline_path, full_path = output_paths
+    
+    n_frames = len(tifffile.TIFFfile(data_path).pages)
+    backend = get_backend(backend)
+    io_before = io.get_io_counter()
+    t_start = time.time()
+    
+    # 1) generating a reference image out of the first few images from the stack
+    if ref_img is None:
+        ref_img = average_frames(io.iter_tiffstack(data_path,range(odor_onset_frame)),odor_onset_frame)
+    
+    # pass 1: registering all images to the reference image using affine transform
+    print "streaming affine registration:", data_path
+    reference = None
+    if get_prealign():
+        reference = native_registration.phase_correlation_reference(ref_img)
+    
+    def affine_frame_args():
+        """ the arguments of the frame jobs of pass 1, with the shift of each
+        frame found by phase correlation as initial transform if prealign """
+        for frame, img in enumerate(io.iter_tiffstack(data_path)):
+            shift = None
+            if reference is not None:
+                shift = native_registration.phase_correlation(img[:,:,sp.newaxis],ref_img,reference)[0]
+            if affine_mode == 'affine_native':
+                yield (img,ref_img,None if shift is None else sp.hstack([[1.0,0.0,0.0,1.0],shift]))
+            else:
+                frame_dir = get_frame_dir(data_path,'affine',frame,n_frames)
+                yield (img,ref_img,affine_parameters_path,frame_dir,backend,None if shift is None else write_initial_transform(shift,ref_img.shape,frame_dir))
+    
+    func = native_registration.register_frame if affine_mode == 'affine_native' else run_elastix
+    frame_args = affine_frame_args()
+    with io.TstackWriter(affine_path) as affine_writer:
+        for output in iter_frame_jobs(func, frame_args, n_workers=n_workers, n_frames=n_frames):
+            if affine_mode == 'affine_native':
+                output = output[0]
+            affine_writer.append(output)
+    
+    # generating a new (better) reference image
+    data_affine_transformed = io.read_tiffstack(affine_path,memmap=True)
+    ref_img_affine_transformed = average_frames((data_affine_transformed[:,:,frame] for frame in range(odor_onset_frame)),odor_onset_frame)
+    
+    # pass 2: extracting signal and background, averaging the background
+    print "streaming signal and background extraction"
+    background_sum = sp.zeros(ref_img.shape)
+    with io.TstackWriter(signal_path) as signal_writer, io.TstackWriter(background_path) as background_writer:
+        for start in range(0,n_frames,split_chunk_size):
+            chunk = slice(start,min(start+split_chunk_size,n_frames))
+            signal, background = split_signal_background(data_affine_transformed[:,:,chunk],ref_img_affine_transformed)
+            signal_writer.append(signal)
+            background_writer.append(background)
+            background_sum += background.sum(axis=2) # exact, any order
+    ref_img_background = (background_sum / n_frames).astype('uint16')
+    
+    # pass 3: bspline registration of the background, applied to the affine registered data
+    print "streaming bspline registration:", data_path
+    data_background = io.read_tiffstack(background_path,memmap=True)
+    frame_args = ((sp.array(data_background[:,:,frame]),sp.array(data_affine_transformed[:,:,frame]),ref_img_background,
+                   get_frame_dir(data_path,'bspline',frame,n_frames),get_frame_dir(data_path,'bspline_on_signal',frame,n_frames),backend)
+                  for frame in range(n_frames))
+    with io.TstackWriter(background_bspline_path) as background_bspline_writer, io.TstackWriter(full_path) as full_writer:
+        for background_bspline_transformed, bspline_transformed in iter_frame_jobs(register_and_transform, frame_args, n_workers=n_workers, n_frames=n_frames):
+            background_bspline_writer.append(background_bspline_transformed)
+            full_writer.append(bspline_transformed)
+    
+    print_stack_report(backend, io_before, t_start)
+    return output_paths
+
+
+#==============================================================================
+# batch
+#==============================================================================
+
+def movement_correct_file(data_path, odor_onset_frame, n_workers=None, tmp_mode=True, remove_elastix_files=True, streaming=False, backend=None):
+    """ what single_stack_aligner.py does for a trial: corrects the stack at
+    data_path (copied to the scratch first if tmp_mode) and saves the results
+    next to it, as data_affine.tif, data_signal.tif, data_background.tif,
+    data_background_bspline.tif and data_full.tif. If streaming, with
+    movement_correct_tstack_streaming. The elastix generated files are removed
+    afterwards if remove_elastix_files.
+    
+    The time and IO of the stages of the correction are written to
+    data_report.json, see the instrumentation module """
+    data_path_orig = data_path
+    output_path = os.path.splitext(data_path_orig)[0]
+    start = instrumentation.mark()
+    
+    with instrumentation.stage('movement_correct_file'):
+        if tmp_mode:
+            data_path = make_tmp_dir(data_path)
+        
+        if streaming:
+            movement_correct_tstack_streaming(data_path,odor_onset_frame,output_path,n_workers=n_workers,backend=backend)
+        else:
+            results = movement_correct_tstack(data_path,odor_onset_frame,n_workers=n_workers,backend=backend)
+            for name, data in zip(['affine','signal','background','background_bspline','full'],results):
+                io.save_tstack(data,output_path + '_' + name + '.tif') # background_bspline is needed for multicolor correction!
+        
+        if remove_elastix_files:
+            cleanup(data_path)
+    
+    instrumentation.write_report(instrumentation.get_report_path(output_path),start,
+                                 data_path=data_path_orig,odor_onset_frame=int(odor_onset_frame),n_workers=get_n_workers(n_workers),streaming=streaming)
+    instrumentation.take(start) # reported, a process correcting many files does not keep them
+
+def _run_trial(trial, data_path, odor_onset_frame, n_workers, slots, kwargs, results):
+    """ runs movement_correct_file in a trial process of run_trials and puts
+    the outcome into the results queue. Its frame jobs share the slots with the
+    other trials (see node_slots). As in _run_frame_job, exceptions and the
+    sys.exit of the helpers are caught and returned """
+    global node_slots
+    node_slots = slots
+    try:
+        movement_correct_file(data_path,odor_onset_frame,n_workers=n_workers,**kwargs)
+        error = None
+    except (Exception, SystemExit):
+        error = traceback.format_exc()
+    results.put((trial, error))
+
+def run_trials(trials, n_cores=None, **kwargs):
+    """ movement correction of a batch of trials on one node. trials is a list
+    of (data_path, odor_onset_frame), kwargs are passed on to
+    movement_correct_file. At most n_cores (default: all cores of the node)
+    frames are registered at the same time.
+    
+    Each trial runs in its own process, with its frames distributed over a
+    pool of up to n_cores workers. The cores are shared by all trials: a frame
+    job takes one of n_cores slots of a semaphore while it runs (see
+    node_slots), so the cores that a finished trial frees are used by the
+    trials that are still running. The trials are started longest first (by
+    x*y*t of the stack), at most n_cores at the same time, so that the short
+    trials fill up the end of the batch and the last long trial gets the whole
+    node once they are done.
+    
+    The time and frames/s of each trial and of the whole batch are printed.
+    Returns the list of the failed trials as (data_path, error) """
+    if n_cores is None:
+        n_cores = multiprocessing.cpu_count()
+    n_cores = get_n_workers(n_cores)
+    
+    pending = []
+    for trial, (data_path, odor_onset_frame) in enumerate(trials):
+        shape, dtype = io.probe_tiffstack(data_path)
+        pending.append((int(sp.prod(shape)), trial, data_path, odor_onset_frame, shape[2]))
+    pending.sort(key=lambda p: (-p[0], p[1])) # longest first
+    
+    results = multiprocessing.Queue()
+    slots = multiprocessing.Semaphore(n_cores)
+    running = {} # trial: (process, data_path, n_frames, t_start)
+    failed = []
+    frames_done = 0
+    t_batch = time.time()
+    
+    while pending or running:
+        # start trials up to one per core
+        while pending and len(running) < n_cores:
+            cost, trial, data_path, odor_onset_frame, n_frames = pending.pop(0)
+            process = multiprocessing.Process(target=_run_trial,args=(trial,data_path,odor_onset_frame,n_cores,slots,kwargs,results))
+            process.start()
+            running[trial] = (process, data_path, n_frames, time.time())
+            print "trial started:", data_path, n_frames, "frames"
+        
+        try:
+            finished = [results.get(timeout=1)]
+        except Queue.Empty:
+            # trial processes that died without reporting (e.g. killed)
+            finished = [(trial, "trial process exited with code " + str(running[trial][0].exitcode))
+                        for trial in running if running[trial][0].exitcode not in (None, 0)]
+        
+        for trial, error in finished:
+            process, data_path, n_frames, t_start = running.pop(trial)
+            process.join()
+            seconds = time.time() - t_start
+            if error is not None:
+                print "Error! trial", data_path, "failed:"
+                print error
+                failed.append((data_path, error))
+            else:
+                frames_done += n_frames
+                print "trial done: %s, %i frames in %.1f s, %.2f frames/s" % (data_path, n_frames, seconds, n_frames / seconds)
+    
+    seconds = time.time() - t_batch
+    print "batch done: %i of %i trials, %i frames in %.1f s, %.2f frames/s on %i cores" % (
+        len(trials) - len(failed), len(trials), frames_done, seconds, frames_done / seconds, n_cores)
+    return failed
+
+
 #==============================================================================
 # multiple
 #==============================================================================
 
-def align_tstacks(data_path,tstack_paths,reference_mode='first'):
+@instrumentation.timed()
+def align_tstacks(data_path,tstack_paths,reference_mode='first',n_workers=None,backend=None):
     """ this function is used to align a single trial to a set of other tirals to
     a common reference. This reference is chosen depending on the keyword
     reference_mode: if 'first', the time average of the first trial in the 
@@ -444,6 +1173,8 @@ def align_tstacks(data_path,tstack_paths,reference_mode='first'):
     
     data_path: path to the tstack that will be aligned
     tstack_paths: a list with paths to the other tstacks of the experiment
+    n_workers: number of frames processed in parallel, see transform_tstack
+    backend: the registration backend, see get_backend
     
     the alignment is computed as a 2 step process, first affine 
     and then bspline. Both are returned
@@ -471,7 +1202,7 @@ def align_tstacks(data_path,tstack_paths,reference_mode='first'):
     # this block is hacked in to deal with the aljas dataset, can be ignored in all others:
     # if existing, use the bspline_background as a basis to calculate the reference
     if os.path.exists(bspline_path):
-        data_avg = sp.average(io.read_tiffstack(bspline_path),axis=2)
+        data_avg = sp.average(io.read_tiffstack(bspline_path,memmap=True),axis=2)
     else:
         data_avg = calc_ref_img(data,20)
         pass    
@@ -485,13 +1216,13 @@ def align_tstacks(data_path,tstack_paths,reference_mode='first'):
     # find transform ...    
     outpath = os.path.split(data_path)[0] + '/elastix/' + exp_name + '/global_affine'
     makedirs(outpath)
-    run_elastix(data_avg,ref_img_global,affine_parameters_path,outpath)
+    run_elastix(data_avg,ref_img_global,affine_parameters_path,outpath,backend=backend)
     
     # ... and apply to each frame
     transform_parameters_filepath = outpath + '/TransformParameters.0.txt'
     tp_paths = [transform_parameters_filepath] * data.shape[2]
-    data_affine_aligned = apply_transform(data, data_path, tp_paths, output_subdir='affine_aligned')
-    bspline_data_affine_aligned = apply_transform(io.read_tiffstack(bspline_path), bspline_path, tp_paths, output_subdir='bspline_affine_aligned')
+    data_affine_aligned = apply_transform(data, data_path, tp_paths, output_subdir='affine_aligned', n_workers=n_workers, backend=backend)
+    bspline_data_affine_aligned = apply_transform(io.read_tiffstack(bspline_path), bspline_path, tp_paths, output_subdir='bspline_affine_aligned', n_workers=n_workers, backend=backend)
     
     # generate new avg
     data_avg_after_affine = sp.average(bspline_data_affine_aligned,axis=2)
@@ -500,13 +1231,13 @@ def align_tstacks(data_path,tstack_paths,reference_mode='first'):
     # find transform ...    
     outpath = os.path.split(data_path)[0] + '/elastix/' + exp_name + '/global_bspline'
     makedirs(outpath)
-    run_elastix(data_avg_after_affine,ref_img_global,bspline_lowres_parameters_path,outpath)
+    run_elastix(data_avg_after_affine,ref_img_global,bspline_lowres_parameters_path,outpath,backend=backend)
     
     # ... and apply to each frame
     transform_parameters_filepath = outpath + '/TransformParameters.0.txt'
     tp_paths = [transform_parameters_filepath] * data.shape[2]
         
-    data_bspline_aligned = apply_transform(data_affine_aligned, data_path, tp_paths, output_subdir='bspline_aligned')
+    data_bspline_aligned = apply_transform(data_affine_aligned, data_path, tp_paths, output_subdir='bspline_aligned', n_workers=n_workers, backend=backend)
     
     return data_affine_aligned, data_bspline_aligned, ref_img_global
 
@@ -515,12 +1246,17 @@ def align_tstacks(data_path,tstack_paths,reference_mode='first'):
 # 2 channel, one ref
 #==============================================================================
 
-def movement_correct_two_color(data_bg_path,data_sg_path,odor_onset_frame):
+@instrumentation.timed()
+def movement_correct_two_color(data_bg_path,data_sg_path,odor_onset_frame,n_workers=None,affine_mode='affine',backend=None):
     """
     ARGUMENTS:
     data_bg_path: absolute path to the xyt stack with the background/reference channel
     data_sg_path: absolute path to the xyt stack with the signal, that will receive all transformations
     odor_onset_frame: last frame without a repsonse
+    n_workers: number of frames processed in parallel, see transform_tstack
+    affine_mode: 'affine' (elastix) or 'affine_native' (in-process, the affine
+        matrices are then applied to the signal channel directly)
+    backend: the registration backend, see get_backend
 
     DESCRIPTION:
     Corrects for movement in two seperate files, one being a background/reference
@@ -548,7 +1284,12 @@ def movement_correct_two_color(data_bg_path,data_sg_path,odor_onset_frame):
     ref_img = calc_ref_img(data_bg, odor_onset_frame)
     
     # registering all images to the reference image using affine transform
-    data_bg_transformed = transform_tstack(data_bg, data_bg_path, ref_img, output_subdir='affine', mode='affine')
+    if affine_mode == 'affine_native':
+        data_bg_transformed, matrices = transform_tstack(data_bg, data_bg_path, ref_img, mode='affine_native', n_workers=n_workers, return_matrices=True, backend=backend)
+        data_sg_transformed = native_registration.warp_tstack(data_sg, matrices)
+        return data_bg_transformed, data_sg_transformed
+    
+    data_bg_transformed = transform_tstack(data_bg, data_bg_path, ref_img, output_subdir='affine', mode='affine', n_workers=n_workers, backend=backend)
 
     # applying the same transform to the signal channel
     exp_name = get_exp_name(data_bg_path)
@@ -559,7 +1300,7 @@ def movement_correct_two_color(data_bg_path,data_sg_path,odor_onset_frame):
         tp_path =  os.path.dirname(data_bg_path) + '/elastix/' + exp_name + '/affine/' + frame_i_of_n + '/TransformParameters.0.txt'
         tp_paths.append(tp_path)
     
-    data_sg_transformed = apply_transform(data_sg, data_sg_path, tp_paths, output_subdir='affine_from_bg_on_signal')
+    data_sg_transformed = apply_transform(data_sg, data_sg_path, tp_paths, output_subdir='affine_from_bg_on_signal', n_workers=n_workers, backend=backend)
     
     return data_bg_transformed, data_sg_transformed
 